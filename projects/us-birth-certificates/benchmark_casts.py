@@ -0,0 +1,163 @@
+"""Checks the fused cast kernel against the reference and compares their speed.
+
+For each kind of column, prepare_parquet.constrain_and_cast_uint (which uses the fused kernel in
+cast_kernels) and the reference constrain_and_cast_uint_robust are run on the same input, and
+their results and stats must be identical. Edge cases (and random mixtures of them) are checked
+first, including inputs the kernel hands back to the reference. Dictionary-encoded inputs (as
+prepare_parquet reads string columns) are compared with the reference on the decoded values.
+
+Usage: python benchmark_casts.py [rows]
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import prepare_parquet
+
+EDGE_CASES = [
+    "1", "2", "9", "0", "00", "012", "+5", "1.0", "1.000", "1.5", "0.001", "12.", ".5", "1..2",
+    "1 2", " 7", "7 ", "  8  ", "", " ", "Y", "N", "U", "X", "+", "++1", "1+", "255", "256", "9999",
+    "99999", "65535", "65536", "-1", "-0", "1e2", "1E400", "e", "\t3", "\x1c4", "café", None,
+]
+
+SPECS = [
+    (pa.uint8(), 1, 14),
+    (pa.uint8(), 0, None),
+    (pa.uint8(), None, None),
+    (pa.uint16(), 0, 9999),
+    (pa.uint16(), 1989, None),
+]
+
+
+def run_both(arr: pa.Array, dtype: pa.DataType, mn, mx):
+    fused_stats, reference_stats = {}, {}
+    kwargs = {"min": mn, "max": mx, "non_integer": "null", "range_invalid": "null", "stat_key": "col"}
+
+    start = time.perf_counter()
+    fused = prepare_parquet.constrain_and_cast_uint(arr, dtype, stats=fused_stats, **kwargs)
+    fused_seconds = time.perf_counter() - start
+
+    if pa.types.is_dictionary(arr.type):
+        arr = arr.dictionary_decode()
+
+    start = time.perf_counter()
+    reference = prepare_parquet.constrain_and_cast_uint_robust(arr, dtype, stats=reference_stats, **kwargs)
+    reference_seconds = time.perf_counter() - start
+
+    return fused, fused_stats, fused_seconds, reference, reference_stats, reference_seconds
+
+
+def check(arr: pa.Array, dtype: pa.DataType, mn, mx, label: str) -> bool:
+    fused, fused_stats, _, reference, reference_stats, _ = run_both(arr, dtype, mn, mx)
+
+    same = (
+        fused.type == reference.type
+        and fused.equals(reference)
+        and fused_stats == reference_stats
+        and list(fused_stats["col"]) == list(reference_stats["col"])
+    )
+
+    if not same:
+        print(f"MISMATCH {label} {dtype} min={mn} max={mx}")
+        print(f"  fused:     {fused.to_pylist()[:20]} {fused_stats}")
+        print(f"  reference: {reference.to_pylist()[:20]} {reference_stats}")
+
+    return same
+
+
+def check_edge_cases() -> bool:
+    rng = np.random.default_rng(0)
+    ok = True
+
+    for dtype, mn, mx in SPECS:
+        for value in EDGE_CASES:
+            ok &= check(pa.array([value, "1"], type=pa.string()), dtype, mn, mx, repr(value))
+
+        numbers = [0.0, 1.0, 2.5, -1.0, -0.0, 300.0, 70000.0, float("nan"), float("inf"), None]
+        for value in numbers:
+            ok &= check(pa.array([value, 1.0], type=pa.float64()), dtype, mn, mx, repr(value))
+
+        # random mixtures, including sliced arrays
+        for _ in range(200):
+            values = list(rng.choice(np.array(EDGE_CASES[:-8] + [None], dtype=object), 50))
+            arr = pa.array(values, type=pa.string())
+            ok &= check(arr, dtype, mn, mx, "mixture")
+            ok &= check(arr.slice(7, 30), dtype, mn, mx, "sliced mixture")
+            ok &= check(pc.dictionary_encode(arr), dtype, mn, mx, "dictionary mixture")
+            ok &= check(pc.dictionary_encode(arr).slice(7, 30), dtype, mn, mx, "sliced dictionary mixture")
+
+        ok &= check(pa.array([1, 2, None, 14, 200], type=pa.uint8()), dtype, mn, mx, "uint8")
+        ok &= check(pa.array([], type=pa.string()), dtype, mn, mx, "empty")
+        ok &= check(pa.nulls(5, type=pa.string()), dtype, mn, mx, "all null")
+        ok &= check(pc.dictionary_encode(pa.nulls(5, type=pa.string())), dtype, mn, mx, "all null dictionary")
+
+    return ok
+
+
+def benchmark(rows: int) -> bool:
+    rng = np.random.default_rng(1)
+    ok = True
+
+    columns = {
+        "string codes ('1'-'9', blank, null)": (
+            pa.array(rng.choice(np.array(["1", "2", "3", "9", "", None], dtype=object), rows), type=pa.string()),
+            pa.uint8(), 1, 9,
+        ),
+        "string codes with junk": (
+            pa.array(rng.choice(np.array(["1", "2", "9", "X", "1.5", " 3 ", "300", None], dtype=object), rows),
+                     type=pa.string()),
+            pa.uint8(), 1, 14,
+        ),
+        "string numbers (0-9999)": (
+            pa.array(rng.integers(0, 10000, rows).astype(str), type=pa.string()),
+            pa.uint16(), 0, 9999,
+        ),
+        "dictionary string codes with junk": (
+            pc.dictionary_encode(
+                pa.array(rng.choice(np.array(["1", "2", "9", "X", "1.5", " 3 ", "300", None], dtype=object), rows),
+                         type=pa.string())
+            ),
+            pa.uint8(), 1, 14,
+        ),
+        "dictionary string numbers (0-9999)": (
+            pc.dictionary_encode(pa.array(rng.integers(0, 10000, rows).astype(str), type=pa.string())),
+            pa.uint16(), 0, 9999,
+        ),
+        "float64 codes (SAS numeric)": (
+            pa.array(rng.choice(np.array([1.0, 2.0, 9.0, 2.5, np.nan]), rows), type=pa.float64()),
+            pa.uint8(), 1, 9,
+        ),
+        "float64 numbers (0-9999)": (
+            pa.array(rng.integers(0, 10000, rows).astype(np.float64), type=pa.float64()),
+            pa.uint16(), 0, 9999,
+        ),
+    }
+
+    print(f"{'column':<40}{'reference (s)':>15}{'fused (s)':>12}{'speedup':>10}")
+
+    for label, (arr, dtype, mn, mx) in columns.items():
+        fused, fused_stats, fused_seconds, reference, reference_stats, reference_seconds = run_both(arr, dtype, mn, mx)
+        same = fused.equals(reference) and fused_stats == reference_stats
+        ok &= same
+        print(
+            f"{label:<40}{reference_seconds:>15.3f}{fused_seconds:>12.3f}{reference_seconds / fused_seconds:>9.1f}x"
+            f"{'' if same else '  MISMATCH'}"
+        )
+
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the fused cast kernel against the reference and times both.")
+    parser.add_argument("rows", nargs="?", type=int, default=2_000_000, help="rows per benchmarked column")
+    benchmark_rows = parser.parse_args().rows
+
+    edge_cases_ok = check_edge_cases()
+    print(f"Edge cases: {'OK' if edge_cases_ok else 'MISMATCH'}")
+
+    benchmark_ok = benchmark(benchmark_rows)
+
+    sys.exit(0 if edge_cases_ok and benchmark_ok else 1)
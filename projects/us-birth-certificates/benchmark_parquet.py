@@ -0,0 +1,142 @@
+"""Compares the bytes read by typical notebook queries on the prepared dataset, before and after
+clustering.
+
+Each year's combined partition is prepared twice into a temporary directory: clustered (rows sorted
+by prepare_parquet.CLUSTER_COLUMNS; see prepare_parquet.cluster_partition) and as before (rows in
+combined order). Both are written with the same writer options (page indexes)
+and row group size, so only the row order differs. Each query is run on both with DuckDB and pyarrow, and the
+file sizes, bytes read (by this process, from psutil's I/O counters) and times are reported. Both
+must return the same number of rows.
+
+Usage: python benchmark_parquet.py [year ...] (default: all years in the combined dataset)
+"""
+
+import pathlib
+import sys
+import tempfile
+import time
+import duckdb
+import psutil
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import build_utils
+import prepare_parquet
+from variables import ANOMALY_CODES, Variables as vars
+
+COLUMNS = [vars.DOB_YY, vars.MAGER, vars.MRACEHISP, vars.CA_DOWN, vars.DBWT]
+"""Columns selected by each query."""
+
+QUERIES = {
+    f"{vars.DOB_YY} >= 2016": ds.field(vars.DOB_YY) >= 2016,
+    f"{vars.MAGER} >= 35": ds.field(vars.MAGER) >= 35,
+    f"{vars.MAGER} >= 40 AND {vars.MRACEHISP} = 1": (ds.field(vars.MAGER) >= 40) & (ds.field(vars.MRACEHISP) == 1),
+    f"{vars.MAGER} < 20": ds.field(vars.MAGER) < 20,
+    f"{vars.CA_DOWN} = {ANOMALY_CODES['C']}": ds.field(vars.CA_DOWN) == ANOMALY_CODES["C"],
+}
+"""Filters (as DuckDB SQL and pyarrow expressions) typical of the notebooks."""
+
+
+def bytes_read() -> int:
+    """
+    Returns the bytes read by this process so far (by read calls, whether or not from the page
+    cache, where the platform counts them).
+    """
+    counters = psutil.Process().io_counters()
+    return getattr(counters, "read_chars", counters.read_bytes)
+
+
+def write_before(in_path: pathlib.Path, out_path: pathlib.Path, row_group_rows: int) -> None:
+    # prepares a partition as before clustering (combined order), rewritten in row groups of
+    # row_group_rows with the writer options of a prepared file, as the clustered file is
+    prepare_parquet.prepare_partition(in_path, out_path, cluster=False)
+
+    file = pq.ParquetFile(out_path)
+    schema = file.schema_arrow
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with pq.ParquetWriter(tmp_path, schema, **prepare_parquet.writer_options(schema)) as writer:
+        # write_table closes a row group at the end of each table, so tables are whole row groups
+        buffered = pa.Table.from_batches([], schema)
+        for batch in file.iter_batches(batch_size=row_group_rows):
+            buffered = pa.concat_tables([buffered, pa.Table.from_batches([batch], schema)])
+            if buffered.num_rows >= row_group_rows:
+                whole = buffered.num_rows // row_group_rows * row_group_rows
+                writer.write_table(buffered.slice(0, whole), row_group_size=row_group_rows)
+                buffered = buffered.slice(whole)
+        if buffered.num_rows:
+            writer.write_table(buffered, row_group_size=row_group_rows)
+    tmp_path.replace(out_path)
+
+
+def duckdb_query(files: list[pathlib.Path], where: str) -> int:
+    # on a fresh connection, so nothing is cached
+    with duckdb.connect() as con:
+        return len(
+            con.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM read_parquet($files) WHERE {where}",
+                {"files": [f.as_posix() for f in files]},
+            ).fetchall()
+        )
+
+
+def pyarrow_query(files: list[pathlib.Path], expr: ds.Expression) -> int:
+    return ds.dataset(files, format="parquet").to_table(columns=COLUMNS, filter=expr).num_rows
+
+
+def measure(query, *args) -> tuple[int, int, float]:
+    # returns the rows, bytes read and seconds of a query
+    start_bytes, start = bytes_read(), time.perf_counter()
+    rows = query(*args)
+    return rows, bytes_read() - start_bytes, time.perf_counter() - start
+
+
+def benchmark(years: list[int]) -> bool:
+    ok = True
+
+    with tempfile.TemporaryDirectory(dir=build_utils.DATA_DIR) as tmp:
+        tmp_dir = pathlib.Path(tmp)
+        layouts = {"before": tmp_dir / "before", "clustered": tmp_dir / "clustered"}
+        files = {name: [build_utils.partition_path(path, year) for year in years] for name, path in layouts.items()}
+
+        for year, before, clustered in zip(years, files["before"], files["clustered"]):
+            in_path = build_utils.partition_path(build_utils.COMBINED_DIR, year)
+            prepare_parquet.prepare_partition(in_path, clustered, cluster=True)
+            write_before(in_path, before, pq.ParquetFile(clustered).metadata.row_group(0).num_rows)
+
+        for name in layouts:
+            size = sum(f.stat().st_size for f in files[name])
+            row_groups = sum(pq.ParquetFile(f).num_row_groups for f in files[name])
+            print(f"{name}: {size / 1024 ** 2:,.1f} MB in {row_groups} row groups")
+
+        print(
+            f"{'query':<36}{'engine':<9}{'before (MB)':>13}{'clustered (MB)':>16}{'ratio':>8}"
+            f"{'before (s)':>12}{'clustered (s)':>15}"
+        )
+
+        for where, expr in QUERIES.items():
+            for engine in ["duckdb", "pyarrow"]:
+                results = {}
+                for name in layouts:
+                    if engine == "duckdb":
+                        results[name] = measure(duckdb_query, files[name], where)
+                    else:
+                        results[name] = measure(pyarrow_query, files[name], expr)
+
+                (before_rows, before_bytes, before_seconds) = results["before"]
+                (clustered_rows, clustered_bytes, clustered_seconds) = results["clustered"]
+                same = before_rows == clustered_rows
+                ok &= same
+
+                print(
+                    f"{where:<36}{engine:<9}{before_bytes / 1024 ** 2:>13.2f}{clustered_bytes / 1024 ** 2:>16.2f}"
+                    f"{before_bytes / max(clustered_bytes, 1):>7.1f}x{before_seconds:>12.3f}{clustered_seconds:>15.3f}"
+                    f"{'' if same else '  ROW COUNT MISMATCH'}"
+                )
+
+    return ok
+
+
+if __name__ == "__main__":
+    benchmark_years = [int(year) for year in sys.argv[1:]] or build_utils.partition_years(build_utils.COMBINED_DIR)
+
+    sys.exit(0 if benchmark(benchmark_years) else 1)
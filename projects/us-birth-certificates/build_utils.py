@@ -0,0 +1,265 @@
+"""Build manifest utilities."""
+
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+
+DATA_DIR = pathlib.Path("data")
+
+DOWNLOAD_MANIFEST = DATA_DIR / "downloads.json"
+"""Downloaded files: file name -> url, size, sha256, ETag, Last-Modified, mtime_ns."""
+
+IMPORT_MANIFEST = DATA_DIR / "import_manifest.json"
+"""Per-year Parquet files: year -> output, source, source hash and imported columns hash."""
+
+COMBINED_DIR = DATA_DIR / "us_births_combined"
+"""Combined dataset, partitioned by year (year=YYYY/part-0.parquet)."""
+
+PREPARED_DIR = DATA_DIR / "us_births"
+"""Prepared dataset, partitioned by year (year=YYYY/part-0.parquet)."""
+
+PARQUET_WRITER_CONFIG = DATA_DIR / "parquet_writer_config.json"
+"""Prepared dataset's per-column Parquet encodings and zstd levels (see tune_parquet.py)."""
+
+DATABASE_DIR = DATA_DIR / "us_births_db"
+"""Versions of the DuckDB database (us_births-YYYYMMDDTHHMMSS.db), built by duckdb_prepare."""
+
+CURRENT_DATABASE = DATABASE_DIR / "current.json"
+"""
+Pointer to the current database version: {"path": file name in DATABASE_DIR, "created": ...,
+"journal": hash of the duckdb_prepare steps it was built with}.
+"""
+
+DATABASE_LINK = DATA_DIR / "us_births.db"
+"""
+Link to the current database version, for notebooks that open this path: a symlink, or a hard link
+where the platform does not allow symlinks. Before the database was versioned, the database itself.
+"""
+
+ANALYSIS_DATABASE = DATA_DIR / "us_births_analysis.db"
+"""
+Writable database for tables made by notebooks (e.g. predictions keyed by id), which published
+versions must not hold; kept when a new version is published (see data_utils.connect).
+"""
+
+KEEP_DATABASE_VERSIONS = 2
+"""Database versions kept (the current one and the one before, which open readers may still use)."""
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def load_manifest(path: pathlib.Path) -> dict[str, dict]:
+    """
+    Loads a JSON manifest, or an empty one if it does not exist.
+    """
+    if not path.exists():
+        return {}
+
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict[str, dict], path: pathlib.Path) -> None:
+    """
+    Saves a JSON manifest, replacing the previous one atomically.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(dict(sorted(manifest.items())), f, indent=2)
+
+    os.replace(tmp, path)
+
+
+def sha256_file(path: pathlib.Path) -> str:
+    """
+    Returns the SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def sha256_json(value) -> str:
+    """
+    Returns the SHA-256 hex digest of a JSON-serializable value (with sorted keys).
+    """
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def is_verified(path: pathlib.Path, entry: dict | None) -> bool:
+    """
+    True if the file exists and matches a manifest entry's size and modification time, so the
+    hash recorded in the entry still applies without reading the file.
+    """
+    if not entry or not path.exists():
+        return False
+
+    st = path.stat()
+
+    return st.st_size == entry.get("size") and st.st_mtime_ns == entry.get("mtime_ns")
+
+
+def file_sha256(path: pathlib.Path, *entries: dict | None) -> str:
+    """
+    Returns the SHA-256 of a file, reusing the hash of the first manifest entry that still
+    verifies (see is_verified), and hashing the file only if none does.
+    """
+    for entry in entries:
+        if is_verified(path, entry) and entry.get("sha256"):
+            return entry["sha256"]
+
+    return sha256_file(path)
+
+
+def file_entry(path: pathlib.Path, sha256: str | None = None) -> dict:
+    """
+    Returns the size and modification time of a file (and its hash, if given), for a manifest entry.
+    """
+    st = path.stat()
+    entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    if sha256 is not None:
+        entry["sha256"] = sha256
+
+    return entry
+
+
+def partition_path(root: pathlib.Path, year: int) -> pathlib.Path:
+    """
+    Returns the path of a year's file in a year-partitioned (Hive-style) dataset.
+    """
+    return root / f"year={year}" / "part-0.parquet"
+
+
+def partition_years(root: pathlib.Path) -> list[int]:
+    """
+    Returns the years present in a year-partitioned dataset, in order.
+    """
+    return sorted(int(p.parent.name.removeprefix("year=")) for p in root.glob("year=*/part-0.parquet"))
+
+
+def remove_stale_partitions(root: pathlib.Path, years: list[int]) -> None:
+    """
+    Removes the partitions of a year-partitioned dataset whose years are not in years.
+    """
+    for year in partition_years(root):
+        if year not in years:
+            print(f"Removing partition {root / f'year={year}'}...")
+            shutil.rmtree(partition_path(root, year).parent)
+
+
+def current_database() -> pathlib.Path:
+    """
+    Returns the current version of the DuckDB database (see CURRENT_DATABASE), or DATABASE_LINK
+    if there is none yet. Connections opened on it keep using it after a new version is published.
+    """
+    pointer = load_manifest(CURRENT_DATABASE)
+
+    return DATABASE_DIR / pointer["path"] if pointer else DATABASE_LINK
+
+
+def new_database_version() -> pathlib.Path:
+    """
+    Returns the path of a new database version in DATABASE_DIR (not yet created or published).
+    """
+    DATABASE_DIR.mkdir(parents=True, exist_ok=True)
+    now = datetime.datetime.now()
+
+    while (path := DATABASE_DIR / f"us_births-{now:%Y%m%dT%H%M%S}.db").exists():
+        now += datetime.timedelta(seconds=1)
+
+    return path
+
+
+def publish_database(path: pathlib.Path, **info) -> None:
+    """
+    Makes a complete database version the current one, by replacing DATABASE_LINK and then the
+    pointer (with info added) atomically: new connections open it, while open ones finish on the
+    previous version. Raises if DATABASE_LINK cannot be replaced (e.g. it is open where the platform
+    prevents replacing open files), leaving the previous version current.
+
+    A database at DATABASE_LINK that is not a version (one built before versions were published) is
+    first kept as the oldest version (see _keep_unversioned_database), not overwritten.
+    """
+    _keep_unversioned_database()
+
+    link_tmp = DATABASE_LINK.with_name(DATABASE_LINK.name + ".tmp")
+    link_tmp.unlink(missing_ok=True)
+
+    try:
+        link_tmp.symlink_to(os.path.relpath(path, DATABASE_LINK.parent))
+    except OSError:
+        # e.g. Windows without the symlink privilege
+        os.link(path, link_tmp)
+
+    try:
+        os.replace(link_tmp, DATABASE_LINK)
+    except OSError as e:
+        link_tmp.unlink(missing_ok=True)
+        raise RuntimeError(f"Could not replace {DATABASE_LINK} ({e}); close connections to it and publish again") from e
+
+    pointer = {"path": path.name, "created": datetime.datetime.now().isoformat(timespec="seconds"), **info}
+    tmp = CURRENT_DATABASE.with_name(CURRENT_DATABASE.name + ".tmp")
+
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(pointer, f, indent=2)
+
+    os.replace(tmp, CURRENT_DATABASE)
+
+
+def _keep_unversioned_database() -> None:
+    # hard links a database file at DATABASE_LINK (not a link to a version) into DATABASE_DIR,
+    # named by its modification time so it sorts before the versions published after it, so that
+    # replacing DATABASE_LINK keeps it and any tables notebooks created in it
+    if DATABASE_LINK.is_symlink() or not DATABASE_LINK.exists():
+        return
+
+    versions = list(DATABASE_DIR.glob("us_births-*.db"))
+    if any(os.path.samefile(DATABASE_LINK, version) for version in versions):
+        return
+
+    modified = datetime.datetime.fromtimestamp(DATABASE_LINK.stat().st_mtime)
+    path = DATABASE_DIR / f"us_births-{modified:%Y%m%dT%H%M%S}.db"
+    if path.exists():
+        raise RuntimeError(f"Could not keep {DATABASE_LINK} as {path}, which exists; move it aside and publish again")
+
+    print(f"Keeping {DATABASE_LINK} as database version {path}...")
+    DATABASE_DIR.mkdir(parents=True, exist_ok=True)
+
+    suffixes = [suffix for suffix in ["", ".wal"] if DATABASE_LINK.with_name(DATABASE_LINK.name + suffix).exists()]
+
+    try:
+        for suffix in suffixes:
+            os.link(DATABASE_LINK.with_name(DATABASE_LINK.name + suffix), path.with_name(path.name + suffix))
+    except OSError as e:
+        for suffix in suffixes:
+            path.with_name(path.name + suffix).unlink(missing_ok=True)
+        raise RuntimeError(f"Could not keep {DATABASE_LINK} as {path} ({e}); move it there and publish again") from e
+
+
+def prune_database_versions(keep: int = KEEP_DATABASE_VERSIONS) -> None:
+    """
+    Removes database versions (and unfinished ones) except the current one and the newest keep
+    versions. Versions still open (where the platform prevents removing them) are left for next time.
+    """
+    current = current_database()
+    versions = sorted(DATABASE_DIR.glob("us_births-*.db"), reverse=True)
+    kept = {current, *versions[:keep]}
+
+    for path in [*versions, *DATABASE_DIR.glob("us_births-*.db.tmp")]:
+        if path in kept:
+            continue
+        print(f"Removing database version {path}...")
+        try:
+            path.unlink()
+            path.with_name(path.name + ".wal").unlink(missing_ok=True)
+        except PermissionError:
+            print(f"{path} is in use; it will be removed next time.")
@@ -0,0 +1,223 @@
+"""Fused validate-and-cast kernel for prepare_parquet.constrain_and_cast_uint_robust.
+
+The reference function makes about a dozen passes over each column (trim, compare, regex match,
+if_else, cast, floor, compare, if_else, cast, range checks and a reduction per stats counter).
+fused_constrain_and_cast_uint parses, checks for integers and range, nulls out invalid values and
+counts them in a single compiled (Numba) pass over the Arrow buffers, giving the same result and
+the same counts.
+
+It covers the common cases only. Other values are passed to the reference function, which (as
+it works value by value) gives the same result for them alone as within the whole array:
+
+- strings are handled if they are at most MAX_WIDTH bytes of printable ASCII and, if numbers, are
+  unsigned decimals (digits, optionally with a leading '+' and a fraction; no '-' or exponent)
+  no larger than the target type's maximum (the reference wraps larger values around);
+- numbers are handled if they are not integers, or are integers within the target type's range.
+
+Any other string (e.g. 'Y', '1 2' or '') is not a number, as for the reference's regex. Only the
+default policies (non_integer="null", range_invalid="null") are handled. tests/test_cast_kernels.py
+checks the kernel against the reference; run benchmark_casts.py to time both.
+"""
+
+from typing import Callable
+import numba
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+MAX_WIDTH = 16
+"""Longest string handled: up to 15 significant digits, so parsing as float64 is exact."""
+
+_COUNTS = ["parse_invalid", "non_integer", "range_invalid"]
+_PARSE_INVALID, _NON_INTEGER, _RANGE_INVALID = range(len(_COUNTS))
+
+
+def fused_constrain_and_cast_uint(
+    arr: pa.Array,
+    dtype: pa.DataType,
+    reference: Callable[..., pa.Array],
+    *,
+    min=None,
+    max=None,
+    non_integer="null",
+    range_invalid="null",
+    weights: np.ndarray | None = None,
+) -> tuple[pa.Array, dict[str, int]] | None:
+    """
+    Returns constrain_and_cast_uint_robust's result and the counts it would add to its stats (in
+    the same order: parse_invalid for strings, non_integer and range_invalid if min or max is
+    given), or None if the kernel does not handle the array. Values the kernel does not handle are
+    passed to reference (constrain_and_cast_uint_robust).
+
+    If weights is given, each value is counted weights[i] times (e.g. for the values of a
+    dictionary, weighted by the number of rows they occur in).
+    """
+    if non_integer != "null" or range_invalid != "null" or not isinstance(arr, pa.Array):
+        return None
+
+    n = len(arr)
+    np_dtype = dtype.to_pandas_dtype()
+    max_value = np.iinfo(np_dtype).max
+    lo = -1 if min is None else int(min)
+    hi = max_value if max is None else int(max)
+    valid = _valid(arr)
+    values = np.zeros(n, dtype=np_dtype)
+    ok = np.zeros(n, dtype=np.bool_)
+    pending = np.zeros(n, dtype=np.bool_)
+    counts = np.zeros(3, dtype=np.int64)
+    weighted = weights is not None
+    weights = np.asarray(weights, dtype=np.int64) if weighted else np.zeros(0, dtype=np.int64)
+
+    if pa.types.is_string(arr.type):
+        buffers = arr.buffers()
+        offsets = np.frombuffer(buffers[1], dtype=np.int32)[arr.offset : arr.offset + n + 1]
+        data = np.frombuffer(buffers[2], dtype=np.uint8) if buffers[2] is not None else np.zeros(0, np.uint8)
+        _parse_strings(data, offsets, valid, max_value, lo, hi, values, ok, pending, counts, weights, weighted)
+        keys = ["parse_invalid", "non_integer"]
+    elif pa.types.is_integer(arr.type) or pa.types.is_floating(arr.type):
+        numbers = pc.cast(arr, pa.float64())
+        numbers = np.frombuffer(numbers.buffers()[1], dtype=np.float64)[numbers.offset : numbers.offset + n]
+        _parse_numbers(numbers, valid, max_value, lo, hi, values, ok, pending, counts, weights, weighted)
+        keys = ["non_integer"]
+    else:
+        return None
+
+    if min is not None or max is not None:
+        keys.append("range_invalid")
+
+    counts = {key: int(counts[_COUNTS.index(key)]) for key in keys}
+
+    if pending.any():
+        indices = np.flatnonzero(pending)
+        kwargs = {"min": min, "max": max, "non_integer": non_integer, "range_invalid": range_invalid}
+        stats = {}
+        rest = reference(arr.take(indices), dtype, **kwargs, stats=stats, stat_key="rest")
+        values[indices] = rest.fill_null(0).to_numpy()
+        ok[indices] = rest.is_valid().to_numpy(zero_copy_only=False)
+
+        if weighted:
+            # the stats are totals, so count them over each value repeated by its weight
+            stats = {}
+            reference(arr.take(np.repeat(indices, weights[indices])), dtype, **kwargs, stats=stats, stat_key="rest")
+
+        for key, count in stats.get("rest", {}).items():
+            counts[key] += count
+
+    null_count = n - int(np.count_nonzero(ok))
+    validity = pa.py_buffer(np.packbits(ok, bitorder="little")) if null_count else None
+    out = pa.Array.from_buffers(dtype, n, [validity, pa.py_buffer(values)], null_count=null_count)
+
+    return out, counts
+
+
+@numba.njit(cache=True, nogil=True, inline="always")
+def _check_range(value, lo, hi, i, values, ok, counts, w):
+    if value < lo or value > hi:
+        counts[_RANGE_INVALID] += w
+    else:
+        values[i] = value
+        ok[i] = True
+
+
+@numba.njit(cache=True, nogil=True)
+def _parse_numbers(numbers, valid, max_value, lo, hi, values, ok, pending, counts, weights, weighted):
+    # NaN is not an integer (as NaN != floor(NaN)); negative, infinite or too large integer values
+    # are wrapped around by the reference cast, so are left to it
+    for i in range(len(numbers)):
+        if not valid[i]:
+            continue
+        w = weights[i] if weighted else 1
+        f = numbers[i]
+        if f != np.floor(f):
+            counts[_NON_INTEGER] += w
+            continue
+        if f < 0 or f > max_value:
+            pending[i] = True
+            continue
+        _check_range(np.int64(f), lo, hi, i, values, ok, counts, w)
+
+
+@numba.njit(cache=True, nogil=True)
+def _parse_strings(data, offsets, valid, max_value, lo, hi, values, ok, pending, counts, weights, weighted):
+    space, plus, minus, dot = ord(" "), ord("+"), ord("-"), ord(".")
+    zero, nine, e_lower, e_upper = ord("0"), ord("9"), ord("e"), ord("E")
+
+    for i in range(len(valid)):
+        w = weights[i] if weighted else 1
+        if not valid[i]:
+            counts[_PARSE_INVALID] += w
+            continue
+
+        start, end = offsets[i], offsets[i + 1]
+
+        # the reference trims all (unicode) whitespace; only handle printable ASCII
+        for j in range(start, end):
+            if data[j] < 0x20 or data[j] >= 0x7F:
+                pending[i] = True
+                break
+        if pending[i]:
+            continue
+
+        while start < end and data[start] == space:
+            start += 1
+        while end > start and data[end - 1] == space:
+            end -= 1
+
+        if end - start > MAX_WIDTH:
+            pending[i] = True
+            continue
+
+        # ^\+?\d+(\.\d+)?$, also noting strings of numeric characters with a '-' or exponent
+        j = start
+        if j < end and data[j] == plus:
+            j += 1
+        value = 0
+        int_digits = 0
+        while j < end and zero <= data[j] <= nine:
+            value = value * 10 + (data[j] - zero)
+            int_digits += 1
+            j += 1
+        frac_digits = 0
+        frac_zero = True
+        if j < end and data[j] == dot:
+            j += 1
+            while j < end and zero <= data[j] <= nine:
+                frac_zero &= data[j] == zero
+                frac_digits += 1
+                j += 1
+            number = frac_digits > 0
+        else:
+            number = True
+        number &= int_digits > 0 and j == end
+
+        if not number:
+            # strings made only of numeric characters, with a '-' or exponent: left to the reference
+            numeric, other = end > start, False
+            for k in range(start, end):
+                c = data[k]
+                if c == minus or c == e_lower or c == e_upper:
+                    other = True
+                elif not (zero <= c <= nine or c == dot or c == plus):
+                    numeric = False
+                    break
+            if numeric and other:
+                pending[i] = True
+                continue
+            counts[_PARSE_INVALID] += w
+            continue
+
+        if not frac_zero:
+            counts[_NON_INTEGER] += w
+            continue
+
+        if value > max_value:
+            pending[i] = True
+            continue
+
+        _check_range(value, lo, hi, i, values, ok, counts, w)
+
+
+def _valid(arr: pa.Array) -> np.ndarray:
+    if arr.null_count == 0:
+        return np.ones(len(arr), dtype=bool)
+    return np.asarray(arr.is_valid())
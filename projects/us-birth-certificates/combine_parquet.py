@@ -1,26 +1,88 @@
-"""Combine Parquet files."""
+"""Combine Parquet files into a year-partitioned dataset."""
 
 import pathlib
 import polars as pl
+import build_utils
+import variables
 
+POLARS_TYPES = {
+    "int64": pl.Int64,
+    "uint8": pl.UInt8,
+    "uint16": pl.UInt16,
+    "string": pl.String,
+    "float16": pl.Float16,
+}
 
-def combine_all() -> None:
-    src_dir = pathlib.Path("data")
-    out_parquet = src_dir / "us_births_combined.parquet"
-    out_parquet.unlink(missing_ok=True)
+TARGET_SCHEMA = pl.Schema({col: POLARS_TYPES[t] for col, t in variables.STORAGE_TYPES.items()})
+"""Schema of the combined dataset, from variables.STORAGE_TYPES."""
 
-    paths = list(src_dir.glob("*.parquet"))
 
-    if not paths:
-        raise FileNotFoundError(f"No input Parquet files found in {src_dir.resolve()}")
+def year_inputs() -> dict[int, pathlib.Path]:
+    """
+    Returns the per-year Parquet files recorded in the import manifest, by year.
+    """
+    manifest = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)
+    inputs = {int(year): pathlib.Path(entry["output"]["path"]) for year, entry in manifest.items()}
 
-    print(f"Combining {len(paths)} Parquet files...")
+    missing = [str(path) for path in inputs.values() if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"Per-year Parquet files in {build_utils.IMPORT_MANIFEST} are missing: {missing}")
 
-    lfs = [pl.scan_parquet(p) for p in paths]
-    combined = pl.concat(lfs, how="diagonal_relaxed")
-    combined.sink_parquet(out_parquet.as_posix())
+    return dict(sorted(inputs.items()))
 
-    print(f"Wrote: {out_parquet}")
+
+def scan_year(path: pathlib.Path, schema: pl.Schema = TARGET_SCHEMA) -> pl.LazyFrame:
+    """
+    Scans a per-year file, cast to the target schema: columns are selected in schema order, cast
+    (out-of-range values to null) and added as nulls if absent, and other columns are dropped.
+    Coded columns still holding letters (files imported before they were coded) are encoded. Raises
+    ValueError if the file has no ids (see variables.record_ids), as they cannot be assigned here.
+    """
+    lf = pl.scan_parquet(path)
+    present = lf.collect_schema()
+
+    if variables.Variables.ID in schema and variables.Variables.ID not in present:
+        raise ValueError(f"{path} has no {variables.Variables.ID} column (imported before ids were); reimport it")
+
+    return lf.select([_column(col, dtype, present.get(col)) for col, dtype in schema.items()])
+
+
+def _column(col: str, dtype: pl.DataType, present: pl.DataType | None) -> pl.Expr:
+    if present is None:
+        return pl.lit(None, dtype).alias(col)
+    if col in variables.CODED_VARS and present == pl.String:
+        codes = variables.CODED_VARS[col]
+        return pl.col(col).str.strip_chars().str.to_uppercase().replace_strict(codes, default=None, return_dtype=dtype)
+    return pl.col(col).cast(dtype, strict=False)
+
+
+def combine_all(years: list[int] | None = None) -> None:
+    """
+    Writes each per-year file to its year=YYYY partition of the combined dataset. If years is
+    given, only those partitions are rewritten; otherwise all are, and partitions of years not in
+    the import manifest are removed.
+    """
+    out_dir = build_utils.COMBINED_DIR
+    inputs = year_inputs()
+
+    if not inputs:
+        raise FileNotFoundError(f"No per-year Parquet files in {build_utils.IMPORT_MANIFEST}")
+
+    if years is None:
+        years = list(inputs)
+        build_utils.remove_stale_partitions(out_dir, years)
+
+    print(f"Combining {len(years)} Parquet files into {out_dir}...")
+
+    for year in years:
+        out_parquet = build_utils.partition_path(out_dir, year)
+        out_parquet.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out_parquet.with_name(out_parquet.name + ".tmp")
+
+        scan_year(inputs[year]).sink_parquet(tmp.as_posix())
+        tmp.replace(out_parquet)
+
+        print(f"Wrote: {out_parquet}")
 
 
 if __name__ == "__main__":
@@ -1,24 +1,54 @@
 import duckdb
+import pathlib
 import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.compute as pc
-from variables import Variables as vars
+import pyarrow.dataset as ds
+import polars as pl
+import build_utils
+import memory_utils
+from variables import ANOMALY_CODES, Variables as vars
+
+
+DATABASE_ALIAS = "us_births_db"
+"""Name the current database version is attached as by connect."""
+
+
+def connect(read_only: bool = True) -> duckdb.DuckDBPyConnection:
+    """
+    Opens the analysis database (build_utils.ANALYSIS_DATABASE), writable unless read_only, with the
+    current database version attached read-only as us_births_db. Tables in either are found by
+    name, and tables created without a database name (such as predictions keyed by id) go to the
+    analysis database, so published versions are never modified and the tables are kept when a new
+    version is published.
+    """
+    path = build_utils.ANALYSIS_DATABASE
+
+    if read_only and not path.exists():
+        duckdb.connect(path.as_posix()).close()
+
+    con = duckdb.connect(path.as_posix(), read_only=read_only, config=memory_utils.duckdb_config())
+    con.execute(f"ATTACH '{build_utils.current_database().as_posix()}' AS {DATABASE_ALIAS} (READ_ONLY)")
+    con.execute(f"SET search_path = '{path.stem},{DATABASE_ALIAS}'")
+
+    return con
 
 
 def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unknown: bool = False) -> pd.DataFrame:
-    con = duckdb.connect("./data/us_births.db", read_only=True)
+    con = duckdb.connect(build_utils.current_database().as_posix(), read_only=True, config=memory_utils.duckdb_config())
 
     df = con.execute(
         f"""
         SELECT
             id,
             -- (training label) indicated if C or P, not indicated if N, U and missing excluded from training
+            -- (codes: variables.ANOMALY_CODES)
             CASE
-                WHEN COALESCE (ca_down, ca_downs) = 'C' THEN 1::UTINYINT
-                WHEN COALESCE (ca_down, ca_downs) = 'P' THEN 1::UTINYINT
-                WHEN COALESCE (ca_down, ca_downs) = 'N' THEN 0::UTINYINT
-                WHEN COALESCE (ca_down, ca_downs) = 'U' AND {include_unknown} THEN 0::UTINYINT
+                WHEN COALESCE (ca_down, ca_downs) = {ANOMALY_CODES['C']} THEN 1::UTINYINT
+                WHEN COALESCE (ca_down, ca_downs) = {ANOMALY_CODES['P']} THEN 1::UTINYINT
+                WHEN COALESCE (ca_down, ca_downs) = {ANOMALY_CODES['N']} THEN 0::UTINYINT
+                WHEN COALESCE (ca_down, ca_downs) = {ANOMALY_CODES['U']} AND {include_unknown} THEN 0::UTINYINT
                 WHEN uca_downs = 1 THEN 1::UTINYINT
                 WHEN uca_downs = 2 THEN 0::UTINYINT
                 WHEN uca_downs = 9 AND {include_unknown} THEN 0::UTINYINT
@@ -42,12 +72,8 @@ def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unk
             -- birth place (1: hospital, 2: not hospital, 3: unknown/not stated)
             bfacil3,
             -- ==================== characteristics of baby ====================
-            -- sex of baby
-            CASE
-                WHEN sex = 'M' THEN 1::UTINYINT
-                WHEN sex = 'F' THEN 0::UTINYINT
-                ELSE NULL
-            END AS sex,
+            -- sex of baby (0: F, 1: M)
+            sex,
             -- birth weight (grams)
             CASE
                 WHEN dbwt >= 227 AND dbwt <= 8165 THEN dbwt
@@ -89,58 +115,50 @@ def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unk
             END
             AS bmi,
             -- ==================== pregnancy risk factors ====================
+            -- (flags are coded 0: N, 1: Y, 8: X, 9: U; see variables.YES_NO_CODES)
             -- pre-pregnancy diabetes
             CASE
-                WHEN rf_pdiab = 'Y' THEN 1::UTINYINT
-                WHEN rf_pdiab = 'N' THEN 0::UTINYINT
+                WHEN rf_pdiab <= 1 THEN rf_pdiab
                 ELSE NULL
             END AS rf_pdiab,
             -- gestational diabetes
             CASE
-                WHEN rf_gdiab = 'Y' THEN 1::UTINYINT
-                WHEN rf_gdiab = 'N' THEN 0::UTINYINT
+                WHEN rf_gdiab <= 1 THEN rf_gdiab
                 ELSE NULL
             END AS rf_gdiab,
             -- pre-pregnancy hypertension
             CASE
-                WHEN rf_phype = 'Y' THEN 1::UTINYINT
-                WHEN rf_phype = 'N' THEN 0::UTINYINT
+                WHEN rf_phype <= 1 THEN rf_phype
                 ELSE NULL
             END AS rf_phype,
             -- gestational hypertension
             CASE
-                WHEN rf_ghype = 'Y' THEN 1::UTINYINT
-                WHEN rf_ghype = 'N' THEN 0::UTINYINT
+                WHEN rf_ghype <= 1 THEN rf_ghype
                 ELSE NULL
             END AS rf_ghype,
             -- hypertension eclampsia
             CASE
-                WHEN rf_ehype = 'Y' THEN 1::UTINYINT
-                WHEN rf_ehype = 'N' THEN 0::UTINYINT
+                WHEN rf_ehype <= 1 THEN rf_ehype
                 ELSE NULL
             END AS rf_ehype,
             -- previous preterm birth
             CASE
-                WHEN rf_ppterm = 'Y' THEN 1::UTINYINT
-                WHEN rf_ppterm = 'N' THEN 0::UTINYINT
+                WHEN rf_ppterm <= 1 THEN rf_ppterm
                 ELSE NULL
             END AS rf_ppterm,
             -- infertility treatment used
             CASE
-                WHEN rf_inftr = 'Y' THEN 1::UTINYINT
-                WHEN rf_inftr = 'N' THEN 0::UTINYINT
+                WHEN rf_inftr <= 1 THEN rf_inftr
                 ELSE NULL
             END AS rf_inftr,
             -- fertility enhancing drugs
             CASE
-                WHEN rf_fedrg = 'Y' THEN 1::UTINYINT
-                WHEN rf_fedrg = 'N' THEN 0::UTINYINT
+                WHEN rf_fedrg <= 1 THEN rf_fedrg
                 ELSE NULL
             END AS rf_fedrg,
             -- asst. reproductive technology
             CASE
-                WHEN rf_artec = 'Y' THEN 1::UTINYINT
-                WHEN rf_artec = 'N' THEN 0::UTINYINT
+                WHEN rf_artec <= 1 THEN rf_artec
                 ELSE NULL
             END AS rf_artec,
             -- no risk factors reported
@@ -151,14 +169,12 @@ def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unk
             -- ==================== labor and delivery ====================
             -- induction of labor
             CASE
-                WHEN ld_indl = 'Y' THEN 1::UTINYINT
-                WHEN ld_indl = 'N' THEN 0::UTINYINT
+                WHEN ld_indl <= 1 THEN ld_indl
                 ELSE NULL
             END AS ld_indl,
             -- augmentation of labor
             CASE
-                WHEN ld_augm = 'Y' THEN 1::UTINYINT
-                WHEN ld_augm = 'N' THEN 0::UTINYINT
+                WHEN ld_augm <= 1 THEN ld_augm
                 ELSE NULL
             END AS ld_augm,
             -- fetal presentation at delivery
@@ -188,38 +204,32 @@ def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unk
             END AS apgar10,
             -- assisted ventilation (immediately)
             CASE
-                WHEN ab_aven1 = 'Y' THEN 1::UTINYINT
-                WHEN ab_aven1 = 'N' THEN 0::UTINYINT
+                WHEN ab_aven1 <= 1 THEN ab_aven1
                 ELSE NULL
             END AS ab_aven1,
             -- assisted ventilation > 6 hrs
             CASE
-                WHEN ab_aven6 = 'Y' THEN 1::UTINYINT
-                WHEN ab_aven6 = 'N' THEN 0::UTINYINT
+                WHEN ab_aven6 <= 1 THEN ab_aven6
                 ELSE NULL
             END AS ab_aven6,
             -- admitted to nicu
             CASE
-                WHEN ab_nicu = 'Y' THEN 1::UTINYINT
-                WHEN ab_nicu = 'N' THEN 0::UTINYINT
+                WHEN ab_nicu <= 1 THEN ab_nicu
                 ELSE NULL
             END AS ab_nicu,
             -- surfactant
             CASE
-                WHEN ab_surf = 'Y' THEN 1::UTINYINT
-                WHEN ab_surf = 'N' THEN 0::UTINYINT
+                WHEN ab_surf <= 1 THEN ab_surf
                 ELSE NULL
             END AS ab_surf,
             -- antibiotics for newborn
             CASE
-                WHEN ab_anti = 'Y' THEN 1::UTINYINT
-                WHEN ab_anti = 'N' THEN 0::UTINYINT
+                WHEN ab_anti <= 1 THEN ab_anti
                 ELSE NULL
             END AS ab_anti,
             -- seizures
             CASE
-                WHEN ab_seiz = 'Y' THEN 1::UTINYINT
-                WHEN ab_seiz = 'N' THEN 0::UTINYINT
+                WHEN ab_seiz <= 1 THEN ab_seiz
                 ELSE NULL
             END AS ab_seiz,
             -- no_abnorm
@@ -229,82 +239,64 @@ def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unk
                 ELSE NULL
             END AS no_abnorm,
             -- ==================== identified disorders ====================
-            -- congenital disorder
+            -- congenital disorder (0: N, 1: C, 2: P)
             CASE
-                WHEN ca_disor = 'C' THEN 1::UTINYINT
-                WHEN ca_disor = 'P' THEN 2::UTINYINT
-                WHEN ca_disor = 'N' THEN 0::UTINYINT
+                WHEN ca_disor <= 2 THEN ca_disor
                 ELSE NULL
             END
             AS ca_disor,
             -- anencephaly
             CASE
-                WHEN ca_anen = 'Y' THEN 1::UTINYINT
-                WHEN ca_anen = 'N' THEN 0::UTINYINT
+                WHEN ca_anen <= 1 THEN ca_anen
                 ELSE NULL
             END AS ca_anen,
             -- meningomyelocele / spina bifida
             CASE
-                WHEN ca_mnsb = 'Y' THEN 1::UTINYINT
-                WHEN ca_mnsb = 'N' THEN 0::UTINYINT
+                WHEN ca_mnsb <= 1 THEN ca_mnsb
                 ELSE NULL
             END AS ca_mnsb,
             -- congenital heart defect
             CASE
-                WHEN ca_cchd = 'Y' THEN 1::UTINYINT
-                WHEN ca_cchd = 'N' THEN 0::UTINYINT
+                WHEN ca_cchd <= 1 THEN ca_cchd
                 ELSE NULL
             END AS ca_cchd,
             -- ca_cdh
             CASE
-                WHEN ca_cdh = 'Y' THEN 1::UTINYINT
-                WHEN ca_cdh = 'N' THEN 0::UTINYINT
+                WHEN ca_cdh <= 1 THEN ca_cdh
                 ELSE NULL
             END AS ca_cdh,
             -- omphalocele
             CASE
-                WHEN ca_omph = 'Y' THEN 1::UTINYINT
-                WHEN ca_omph = 'N' THEN 0::UTINYINT
+                WHEN ca_omph <= 1 THEN ca_omph
                 ELSE NULL
             END AS ca_omph,
             -- gastroschisis
             CASE
-                WHEN ca_gast = 'Y' THEN 1::UTINYINT
-                WHEN ca_gast = 'N' THEN 0::UTINYINT
+                WHEN ca_gast <= 1 THEN ca_gast
                 ELSE NULL
             END AS ca_gast,
             -- limb reduction defect
             CASE
-                WHEN ca_limb = 'Y' THEN 1::UTINYINT
-                WHEN ca_limb = 'N' THEN 0::UTINYINT
+                WHEN ca_limb <= 1 THEN ca_limb
                 ELSE NULL
             END AS ca_limb,
             -- cleft lip w/ or w/o cleft palate
             CASE
-                WHEN ca_cleft = 'Y' THEN 1::UTINYINT
-                WHEN ca_cleft = 'N' THEN 0::UTINYINT
+                WHEN ca_cleft <= 1 THEN ca_cleft
                 ELSE NULL
             END AS ca_cleft,
             -- cleft palate alone
             CASE
-                WHEN ca_clpal = 'Y' THEN 1::UTINYINT
-                WHEN ca_clpal = 'N' THEN 0::UTINYINT
+                WHEN ca_clpal <= 1 THEN ca_clpal
                 ELSE NULL
             END AS ca_clpal,
             -- Hypospadias
             CASE
-                WHEN ca_hypo = 'Y' THEN 1::UTINYINT
-                WHEN ca_hypo = 'N' THEN 0::UTINYINT
+                WHEN ca_hypo <= 1 THEN ca_hypo
                 ELSE NULL
             END AS ca_hypo,
-            -- suspected chromosomal disorder
-            CASE
-                WHEN ca_disor = 'C' THEN 1::UTINYINT
-                WHEN ca_disor = 'P' THEN 2::UTINYINT
-                WHEN ca_disor = 'N' THEN 0::UTINYINT
-                WHEN ca_disor = 'U' THEN 9::UTINYINT
-                ELSE NULL
-            END AS ca_disor,
+            -- suspected chromosomal disorder (0: N, 1: C, 2: P, 9: U)
+            ca_disor AS ca_disor,
             -- no_congen
             CASE
                 WHEN no_congen >= 0 AND no_congen <= 1 THEN no_congen
@@ -348,8 +340,7 @@ def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unk
             END AS pay_rec,
             -- supplemental nutrition program for women, infants, and children
             CASE
-                WHEN wic = 'Y' THEN 1::UTINYINT
-                WHEN wic = 'N' THEN 0::UTINYINT
+                WHEN wic <= 1 THEN wic
                 ELSE NULL
             END AS wic
         FROM
@@ -365,6 +356,86 @@ def load_predictors_data(from_year: int = 1989, to_year: int = 9999, include_unk
     return df
 
 
+def births_dataset(path: pathlib.Path = build_utils.PREPARED_DIR) -> ds.Dataset:
+    """
+    Returns the year-partitioned Parquet dataset as a pyarrow dataset. Filters on year only read
+    the matching partitions.
+    """
+    partitioning = ds.partitioning(pa.schema([("year", pa.uint16())]), flavor="hive")
+    return ds.dataset(path, format="parquet", partitioning=partitioning)
+
+
+def read_births(from_year: int = 1989, to_year: int = 9999, columns: list[str] | None = None) -> pa.Table:
+    """
+    Reads the given years (and columns) of the year-partitioned Parquet dataset.
+    """
+    year = pc.field("year")
+    return births_dataset().to_table(columns=columns, filter=(year >= from_year) & (year <= to_year))
+
+
+def scan_births(path: pathlib.Path = build_utils.PREPARED_DIR) -> pl.LazyFrame:
+    """
+    Returns the year-partitioned Parquet dataset as a polars LazyFrame. Filters on year only read
+    the matching partitions.
+    """
+    return pl.scan_parquet(path, hive_partitioning=True, hive_schema={"year": pl.UInt16})
+
+
+def load_variable_availability(variables: list[str] | None = None) -> pd.DataFrame:
+    """
+    Returns the variable availability index (see variable_index.py): one row per year and variable
+    with the row, null and non-null counts and min/max values, from file metadata only.
+    """
+    with duckdb.connect(build_utils.current_database().as_posix(), read_only=True) as con:
+        return con.execute(
+            """
+            SELECT * FROM variable_availability
+            WHERE $variables IS NULL OR list_contains($variables, variable)
+            ORDER BY variable, year
+            """,
+            {"variables": variables},
+        ).df()
+
+
+def load_quality_profile(variables: list[str] | None = None) -> pd.DataFrame:
+    """
+    Returns the quality profile (see quality_profile.py): one row per year and variable with the
+    row and null counts, counts of invalid values set to null (by reason), min/max values and, for
+    variables with few distinct values, a histogram.
+    """
+    with duckdb.connect(build_utils.current_database().as_posix(), read_only=True) as con:
+        return con.execute(
+            """
+            SELECT * FROM quality_profile
+            WHERE $variables IS NULL OR list_contains($variables, variable)
+            ORDER BY variable, year
+            """,
+            {"variables": variables},
+        ).df()
+
+
+def variable_years(variable: str, min_completeness: float = 0.0) -> list[int]:
+    """
+    Returns the years in which a variable has values, optionally requiring that at least
+    min_completeness (0-1) of the year's records have a value.
+    """
+    df = load_variable_availability([variable])
+    df = df[(df["non_null_count"] > 0) & (df["non_null_count"] >= min_completeness * df["row_count"])]
+    return df["year"].astype(int).tolist()
+
+
+def year_variables(year: int) -> list[str]:
+    """
+    Returns the variables that have values in a year.
+    """
+    with duckdb.connect(build_utils.current_database().as_posix(), read_only=True) as con:
+        rows = con.execute(
+            "SELECT variable FROM variable_availability WHERE year = ? AND non_null_count > 0 ORDER BY variable",
+            [year],
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
 def constrain_pa_series_to_uint8(
     series: pd.Series, min: int = 0, max: int = 255
 ) -> pd.Series:
@@ -3,10 +3,17 @@
 Refer to terms at: https://www.cdc.gov/nchs/data_access/restrictions.htm
 """
 
+import concurrent.futures
+import email.utils
 import os
+import pathlib
+import threading
+import urllib.error
 import urllib.request
 import truststore
 
+from build_utils import CHUNK_SIZE, DATA_DIR, DOWNLOAD_MANIFEST, is_verified, load_manifest, save_manifest, sha256_file
+
 truststore.inject_into_ssl()  # avoids SSL: CERTIFICATE_VERIFY_FAILED on MacOS
 
 
@@ -69,7 +76,7 @@ us_data_files_sas = [
     "https://data.nber.org/nvss/natality/sas/2014/natality2014us.sas7bdat",
     "https://data.nber.org/nvss/natality/sas/2015/natality2015us.sas7bdat",
     "https://data.nber.org/nvss/natality/sas/2016/natality2016us.sas7bdat",
-    "https://data.nber.org/nvss/natality/sas/2015/natality2015us.sas7bdat",
+    "https://data.nber.org/nvss/natality/sas/2017/natality2017us.sas7bdat",
     "https://data.nber.org/nvss/natality/sas/2018/natality2018us.sas7bdat",
     "https://data.nber.org/nvss/natality/sas/2019/natality2019us.sas7bdat",
     "https://data.nber.org/nvss/natality/sas/2020/natality2020us.sas7bdat",
@@ -83,17 +90,168 @@ us_data_files_stata = [
     "https://data.nber.org/nvss/natality/dta/2012/natality2012us.dta"
 ]
 
-if not os.path.exists("data"):
-    os.makedirs("data")
+MANIFEST_NAME = DOWNLOAD_MANIFEST.name
+MAX_WORKERS = 4
+TIMEOUT = 60
+
+
+def check_unique(urls: list[str]) -> None:
+    """
+    Raises if any URL (or the file name it would be saved as) appears more than once.
+    """
+    seen: dict[str, str] = {}
+
+    for url in urls:
+        filename = url.rsplit("/", maxsplit=1)[-1]
+        if filename in seen:
+            raise ValueError(f"Duplicate download '{filename}': {seen[filename]} and {url}")
+        seen[filename] = url
+
+
+def _remote_validator(headers) -> str | None:
+    # If-Range only accepts a strong ETag or a Last-Modified date
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def _range_total(headers) -> int | None:
+    # a 416 response gives the size of the remote file as 'Content-Range: bytes */N'
+    content_range = headers.get("Content-Range") or ""
+    total = content_range.rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def _part_info_path(part: pathlib.Path) -> pathlib.Path:
+    return part.with_name(part.name + ".json")
+
+
+def download_file(url: str, dest_dir: pathlib.Path, entry: dict | None = None) -> dict:
+    """
+    Downloads a file into dest_dir, resuming a partial download if one exists.
+
+    Data is written to '<name>.part' and renamed into place once complete, so an interrupted
+    download never looks finished. The remote file's validator is kept in '<name>.part.json', and a
+    partial download is resumed only with it (as If-Range), so bytes from another version of the
+    file are never appended; otherwise the whole file is downloaded again. Returns the manifest
+    entry for the file.
+    """
+    filename = url.rsplit("/", maxsplit=1)[-1]
+    dest = dest_dir / filename
+    part = dest_dir / (filename + ".part")
+    part_info_path = _part_info_path(part)
+    entry = entry or {}
+
+    if is_verified(dest, entry):
+        return entry
+
+    # a file in place that the manifest does not verify (downloaded before it existed, or changed
+    # since) is downloaded again in full: without a matching hash, none of its bytes can be trusted
+    part_info = load_manifest(part_info_path)
+    offset = part.stat().st_size if part.exists() and part_info.get("validator") else 0
+
+    request = urllib.request.Request(url)
+    if offset > 0:
+        request.add_header("Range", f"bytes={offset}-")
+        request.add_header("If-Range", part_info["validator"])
+
+    try:
+        response = urllib.request.urlopen(request, timeout=TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or offset == 0:
+            raise
+        if _range_total(e.headers) != offset:
+            # range not satisfiable, but the partial file is not the size of the remote file
+            print(f"Restarting {url}")
+            part.unlink()
+            part_info_path.unlink(missing_ok=True)
+            return download_file(url, dest_dir, entry)
+        # range not satisfiable: the partial file is already complete
+        print(f"Verifying {url}")
+        headers = e.headers
+    else:
+        with response:
+            headers = response.headers
+
+            if offset > 0 and response.status == 206:
+                print(f"Resuming {url} at {offset:,} bytes")
+                mode = "ab"
+            else:
+                print(f"Downloading {url}")
+                offset = 0
+                mode = "wb"
+                part_info = {
+                    "url": url,
+                    "etag": headers.get("ETag"),
+                    "last_modified": headers.get("Last-Modified"),
+                    "validator": _remote_validator(headers),
+                }
+                save_manifest(part_info, part_info_path)
+
+            with open(part, mode) as f:
+                while chunk := response.read(CHUNK_SIZE):
+                    f.write(chunk)
+
+        length = headers.get("Content-Length")
+        size = part.stat().st_size
+        if length is not None and size != offset + int(length):
+            raise IOError(f"Incomplete download of {url}: {size:,} of {offset + int(length):,} bytes")
+
+    # hash before the rename so a file in place is always a verified one
+    sha256 = sha256_file(part)
+    os.replace(part, dest)
+    part_info_path.unlink(missing_ok=True)
+
+    last_modified = headers.get("Last-Modified") or part_info.get("last_modified")
+    if last_modified:
+        mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+        os.utime(dest, (mtime, mtime))
+
+    return {
+        "url": url,
+        "size": dest.stat().st_size,
+        "sha256": sha256,
+        "etag": headers.get("ETag") or part_info.get("etag"),
+        "last_modified": last_modified,
+        "validator": _remote_validator(headers) or part_info.get("validator"),
+        "mtime_ns": dest.stat().st_mtime_ns,
+    }
+
+
+def download_all(urls: list[str], dest_dir: pathlib.Path = DATA_DIR, max_workers: int = MAX_WORKERS) -> dict[str, dict]:
+    """
+    Downloads files concurrently, skipping those already verified by the manifest in dest_dir.
+    """
+    check_unique(urls)
+
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = dest_dir / MANIFEST_NAME
+    manifest = load_manifest(manifest_path)
+    lock = threading.Lock()
+    errors: list[tuple[str, BaseException]] = []
+
+    def _download(url: str) -> None:
+        filename = url.rsplit("/", maxsplit=1)[-1]
+        entry = download_file(url, dest_dir, manifest.get(filename))
+        with lock:
+            manifest[filename] = entry
+            save_manifest(manifest, manifest_path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_download, url): url for url in urls}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to download {futures[future]}: {e}")
+                errors.append((futures[future], e))
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} download(s) failed; re-run to resume")
+
+    return manifest
 
-for user_guide in user_guides:
-    filename = "data/" + user_guide.rsplit("/", maxsplit=1)[-1]
-    if not os.path.exists(filename):
-        print(f"Downloading {user_guide}")
-        urllib.request.urlretrieve(user_guide, filename)
 
-for data_file in us_data_files_sas:
-    filename = "data/" + data_file.rsplit("/", maxsplit=1)[-1]
-    if not os.path.exists(filename):
-        print(f"Downloading {data_file}")
-        urllib.request.urlretrieve(data_file, filename)
+if __name__ == "__main__":
+    download_all(user_guides + us_data_files_sas)
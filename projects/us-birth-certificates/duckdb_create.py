@@ -1,31 +1,118 @@
 """
-Create DuckDB database from combined Parquet file.
+Create DuckDB database from the year-partitioned Parquet dataset.
 """
 import pathlib
 import duckdb
+import pandas as pd
+import build_utils
+import memory_utils
+import variables
+from variables import Variables as vars
+
+REFERENCE_CSVS = {
+    "us_births_est_prevalence_age": "us-births-estimated-prevalence-maternal-age-1989-2018.csv",
+    "reduction_rate_year": "us-births-reduction-rates-1989-2024.csv",
+    "ds_case_weights": "us-births-ds-rec-weights.csv",
+    "us_births_est_prevalence_ethnicity": "us-births-estimated-prevalence-ethnicity-2000-2018.csv",
+}
+"""Reference tables (one row per year, or per year and group) read from CSV files."""
+
+
+def reference_tables() -> dict[str, pd.DataFrame]:
+    """
+    Returns the reference tables the derived columns join (see variables.DERIVED_COLUMNS), by name.
+    """
+
+    tables = {
+        "prevalence_year": pd.DataFrame(
+            {
+                str(vars.YEAR): list(range(1989, 2025)),
+                str(vars.P_DS_LB_WT): [
+            0.001038,
+            0.001055,
+            0.001077,
+            0.001083,
+            0.001093,
+            0.001102,
+            0.001121,
+            0.001099,
+            0.001124,
+            0.001136,
+            0.001153,
+            0.001149,
+            0.001179,
+            0.001216,
+            0.001219,
+            0.001218,
+            0.001236,
+            0.001244,
+            0.001261,
+            0.001257,
+            0.001262,
+            0.001244,
+            0.00127,
+            0.001265,
+            0.001283,
+            0.001302,
+            0.001265051,
+            0.001295784,
+            0.0013375,
+            0.001324215,
+            0.001324215,
+            0.001324215,
+            0.001324215,
+            0.001324215,
+            0.001324215,
+            0.001324215,
+                ],
+            }
+        )
+    }
+
+    for name, csv in REFERENCE_CSVS.items():
+        print(f"Reading {csv}")
+        tables[name] = pd.read_csv(f"./{csv}").convert_dtypes()
+
+    return tables
 
 
 def combine_all() -> None:
     src_dir = pathlib.Path("data")
-    source_parquet = src_dir / "us_births.parquet"
+    source_parquet = build_utils.PREPARED_DIR / "year=*" / "*.parquet"
     out_db_temp = src_dir / "us_births_temp.db"
     out_db_temp.unlink(missing_ok=True)
 
-    con = duckdb.connect(out_db_temp.as_posix())
+    con = duckdb.connect(out_db_temp.as_posix(), config=memory_utils.duckdb_config())
 
     print("--------------------------------------------------------------")
     print(f"Importing Parquet file into DuckDB '{out_db_temp}'...")
     print("--------------------------------------------------------------")
 
     try:
-        print(f"Reading Parquet file '{source_parquet}'...")
+        # reference tables first, as the derived columns are computed as the table is built
+
+        for name, df in reference_tables().items():
+            con.register("reference_df", df)
+            con.execute(f"CREATE TABLE {name} AS SELECT * FROM reference_df")
+            con.unregister("reference_df")
+
+        for table in sorted({join.table for column in variables.DERIVED_COLUMNS.values() for join in column.joins}):
+            rows, years = con.execute(f"SELECT count(*), count(DISTINCT {vars.YEAR}) FROM {table}").fetchone()
+            if rows != years:
+                raise ValueError(f"Reference table {table} has {rows} rows for {years} years (one per year expected)")
+
+        print(f"Reading Parquet files '{source_parquet}'...")
+
+        described = con.execute("DESCRIBE SELECT * FROM read_parquet(?)", [source_parquet.as_posix()])
+        present = {row[0] for row in described.fetchall()}
 
+        # the typed table with its derived columns in one pass (see variables.duckdb_select_sql),
+        # rather than altering each column's type and updating each derived column afterwards,
+        # which rewrites the table each time. Partitions are read (and inserted) in path order,
+        # i.e. by year, so DuckDB's per-row-group min/max on year lets year filters skip the other
+        # years' data without sorting here
         con.execute(
-            """
-            CREATE TABLE us_births AS
-            SELECT *
-            FROM read_parquet(?)
-            """,
+            f"CREATE TABLE us_births AS {variables.duckdb_select_sql('read_parquet(?)', present)}",
             [source_parquet.as_posix()],
         )
 
@@ -0,0 +1,274 @@
+"""Reads NCHS fixed-width public-use natality files and saves to Parquet files.
+
+An alternative to import_parquet.import_from_sas that reads the NCHS text files (e.g.
+Nat2018PublicUS.c20190509.r20190717.txt, from
+https://ftp.cdc.gov/pub/Health_Statistics/NCHS/Datasets/DVS/natality/) instead of the NBER SAS
+conversions. The file is memory-mapped and each imported column is sliced out of the record
+buffer and parsed with NumPy, using the column positions in natality-fixed-width-layouts.csv
+(from the NCHS user guides), so no Python objects are created per row.
+
+The record layout changes between years, so each layout covers only the years it has been checked
+for. To add a year, add (or extend) its layout and check it against the SAS conversion with
+'python import_fixed_width.py --benchmark YEAR', which should report no differing values.
+
+Usage: python import_fixed_width.py YEAR [TEXT_FILE]
+       python import_fixed_width.py --benchmark YEAR
+
+Refer to terms at: https://www.cdc.gov/nchs/data_access/restrictions.htm
+"""
+
+import csv
+import pathlib
+import sys
+import tempfile
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import build_utils
+import import_parquet
+import prepare_parquet
+import variables
+
+LAYOUTS_PATH = pathlib.Path(__file__).parent / "natality-fixed-width-layouts.csv"
+
+CHUNK_SIZE = import_parquet.CHUNK_SIZE
+
+_BLANK = ord(" ")
+_DOT = ord(".")
+_ZERO = ord("0")
+_NINE = ord("9")
+
+
+def read_layout(year: int) -> dict[str, tuple[int, int, str]]:
+    """
+    Returns the imported columns' positions for a year: name -> (start, end, type), where start
+    and end are 1-based and inclusive (as in the user guides) and type is 's' (string) or 'n'.
+    """
+    layout = {}
+
+    with open(LAYOUTS_PATH, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if int(row["first_year"]) <= year <= int(row["last_year"]) and row["variable"] in variables.IMPORTED:
+                layout[row["variable"]] = (int(row["start"]), int(row["end"]), row["type"])
+
+    if not layout:
+        raise ValueError(f"No fixed-width layout for {year} in {LAYOUTS_PATH.name}")
+
+    return layout
+
+
+def layout_schema(layout: dict[str, tuple[int, int, str]]) -> pa.Schema:
+    """
+    Returns the Arrow schema of the id and imported columns, matching import_parquet.sas_schema:
+    string columns are strings, and numeric columns and columns not in the layout are float64.
+    """
+    return pa.schema(
+        [pa.field(variables.Variables.ID, pa.int64())]
+        + [
+            pa.field(col, pa.string() if col in layout and layout[col][2] == "s" else pa.float64())
+            for col in variables.IMPORTED_VARS
+        ]
+    )
+
+
+def import_year(source: str, year: int, chunk_size: int = CHUNK_SIZE) -> None:
+    """
+    Imports a year from an NCHS fixed-width text file to data/us_births_{year}.parquet and records
+    it in build_utils.IMPORT_MANIFEST (as import_parquet.import_all does for SAS files), so the
+    year is combined and prepared with the others. The year is skipped if it is up to date.
+
+    A year imported from a text file is imported again from its SAS file, if there is one, by the
+    next import_parquet.import_all (as its source differs).
+    """
+    manifest = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)
+    previous = manifest.get(str(year), {})
+    layout = read_layout(year)
+    source_path = pathlib.Path(source)
+    present = [col for col in variables.IMPORTED_VARS if col in layout]
+    sha256 = build_utils.file_sha256(source_path, previous.get("source"))
+    entry = {
+        "source": {"path": source_path.as_posix(), **build_utils.file_entry(source_path, sha256)},
+        **import_parquet.columns_entry(layout_schema(layout), present),
+    }
+
+    if import_parquet.is_up_to_date(entry, previous):
+        print(f"{year} is up to date.")
+        return
+
+    out_path = pathlib.Path(f"data/us_births_{year}.parquet")
+    invalid = import_from_fixed_width(source, year, chunk_size, out_path)
+
+    entry["output"] = {"path": out_path.as_posix(), **build_utils.file_entry(out_path)}
+    # values set to null on import, for the quality profile (see prepare_parquet)
+    entry["invalid"] = invalid
+    manifest = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)
+    manifest[str(year)] = entry
+    build_utils.save_manifest(manifest, build_utils.IMPORT_MANIFEST)
+
+
+def import_from_fixed_width(
+    source: str, year: int, chunk_size: int = CHUNK_SIZE, out_path: pathlib.Path | None = None
+):
+    """
+    Imports data from an NCHS fixed-width text file and saves it as a Parquet file with the same
+    schema as import_parquet.import_from_sas, one row group per chunk_size records.
+    """
+    print(f"Importing data for year {year} from {source}...")
+
+    layout = read_layout(year)
+    schema = layout_schema(layout)
+    out_path = out_path or pathlib.Path(f"data/us_births_{year}.parquet")
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+
+    buffer = np.memmap(source, dtype=np.uint8, mode="r")
+    record_length = _record_length(buffer)
+    rows = -(-len(buffer) // record_length)
+
+    print(f"Saving {rows:,} records to {out_path}...")
+
+    stats = {}
+
+    with pq.ParquetWriter(tmp_path, prepare_parquet.output_schema(schema), compression="zstd") as writer:
+        for start in range(0, rows, chunk_size):
+            records = _records(buffer, record_length, start, min(rows, start + chunk_size))
+            arrays = []
+
+            for field in schema:
+                if field.name == variables.Variables.ID:
+                    arrays.append(pa.array(variables.record_ids(year, start, len(records))))
+                    continue
+                if field.name not in layout:
+                    arrays.append(pa.nulls(len(records), type=field.type))
+                    continue
+
+                first, last, col_type = layout[field.name]
+                chars = records[:, first - 1 : last]
+                arrays.append(parse_strings(chars) if col_type == "s" else parse_numbers(chars))
+
+            writer.write_table(import_parquet.downcast(pa.Table.from_arrays(arrays, schema=schema), stats))
+
+    del buffer
+
+    import_parquet.print_stats(year, stats)
+
+    tmp_path.replace(out_path)
+
+    return stats
+
+
+def _record_length(buffer: np.ndarray) -> int:
+    # records are fixed length, each ending with a newline (which we include in the length)
+    newlines = np.flatnonzero(buffer[:65536] == ord("\n"))
+
+    if len(newlines) == 0:
+        raise ValueError("No record terminator found in the first 64 KB")
+
+    return int(newlines[0]) + 1
+
+
+def _records(buffer: np.ndarray, record_length: int, start: int, end: int) -> np.ndarray:
+    # records [start, end) as a (rows, record_length) view, padding a final unterminated record
+    data = buffer[start * record_length : end * record_length]
+
+    if len(data) % record_length:
+        data = np.concatenate([data, np.full(record_length - len(data) % record_length, _BLANK, dtype=np.uint8)])
+
+    return data.reshape(-1, record_length)
+
+
+def parse_numbers(chars: np.ndarray) -> pa.Array:
+    """
+    Parses a (rows, width) block of ASCII digits (right-justified, optionally with a decimal
+    point) as float64. Blank or otherwise unparseable fields are null.
+    """
+    is_digit = (chars >= _ZERO) & (chars <= _NINE)
+    is_dot = chars == _DOT
+    valid = is_digit.any(axis=1) & (is_digit | is_dot | (chars == _BLANK)).all(axis=1) & (is_dot.sum(axis=1) <= 1)
+
+    # place value of each digit: the number of digits to its right
+    digits_right = np.cumsum(is_digit[:, ::-1], axis=1)[:, ::-1] - is_digit
+    values = (np.where(is_digit, chars - _ZERO, 0).astype(np.int64) * 10 ** digits_right).sum(axis=1)
+
+    decimals = np.where(is_dot.any(axis=1), digits_right[np.arange(len(chars)), is_dot.argmax(axis=1)], 0)
+    values = values / 10.0**decimals
+
+    return pa.array(values, type=pa.float64(), mask=~valid)
+
+
+def parse_strings(chars: np.ndarray) -> pa.Array:
+    """
+    Converts a (rows, width) block of ASCII characters to strings, without trailing blanks.
+    Blank fields are null (as blank strings are when importing from SAS).
+    """
+    rows, width = chars.shape
+
+    if (chars >= 0x80).any():
+        raise ValueError("Non-ASCII characters in a string column")
+
+    data = np.ascontiguousarray(chars).reshape(-1)
+    offsets = np.arange(0, rows * width + 1, width, dtype=np.int32)
+    validity = np.packbits(~(chars == _BLANK).all(axis=1), bitorder="little")
+
+    arr = pa.StringArray.from_buffers(rows, pa.py_buffer(offsets), pa.py_buffer(data), pa.py_buffer(validity))
+
+    return pc.utf8_rtrim(arr, characters=" ")
+
+
+def benchmark(year: int, sas_source: str, text_source: str) -> None:
+    """
+    Imports a year with both backends, printing the throughput of each and the number of values
+    that differ per column (which also checks the layout table against the SAS conversion).
+    """
+    with tempfile.TemporaryDirectory(dir="data") as tmp:
+        outputs = {}
+
+        for name, source, import_fn in (
+            ("sas", sas_source, import_parquet.import_from_sas),
+            ("fixed_width", text_source, import_from_fixed_width),
+        ):
+            out_path = pathlib.Path(tmp) / f"us_births_{year}_{name}.parquet"
+            start = time.perf_counter()
+            import_fn(source, year, out_path=out_path)
+            elapsed = time.perf_counter() - start
+            rows = pq.ParquetFile(out_path).metadata.num_rows
+            size = pathlib.Path(source).stat().st_size
+            print(
+                f"{name}: {rows:,} rows in {elapsed:.1f}s "
+                f"({rows / elapsed:,.0f} rows/s, {size / elapsed / 1024 ** 2:,.0f} MB/s of source)"
+            )
+            outputs[name] = out_path
+
+        sas = pq.ParquetFile(outputs["sas"])
+        fixed_width = pq.ParquetFile(outputs["fixed_width"])
+
+        if sas.metadata.num_rows != fixed_width.metadata.num_rows:
+            print(f"Row counts differ: {sas.metadata.num_rows:,} (sas) vs {fixed_width.metadata.num_rows:,}")
+            return
+
+        for col in read_layout(year):
+            a = sas.read(columns=[col]).column(0)
+            b = fixed_width.read(columns=[col]).column(0)
+            if a.type != b.type:
+                print(f"{col}: type {a.type} (sas) vs {b.type}")
+                continue
+            same = pc.fill_null(pc.equal(a, b), False)
+            both_null = pc.and_(pc.is_null(a), pc.is_null(b))
+            differ = len(a) - pc.sum(pc.or_(same, both_null)).as_py()
+            if differ:
+                print(f"{col}: {differ:,} values differ")
+
+
+def _text_file(year: int) -> str:
+    # the NCHS file for a year in data, e.g. Nat2018PublicUS.c20190509.r20190717.txt
+    return str(next(pathlib.Path("data").glob(f"Nat{year}PublicUS*.txt")))
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--benchmark":
+        benchmark_year = int(sys.argv[2])
+        benchmark(benchmark_year, f"data/natality{benchmark_year}us.sas7bdat", _text_file(benchmark_year))
+    else:
+        year_arg = int(sys.argv[1])
+        import_year(sys.argv[2] if len(sys.argv) > 2 else _text_file(year_arg), year_arg)
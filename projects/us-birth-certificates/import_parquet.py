@@ -1,44 +1,478 @@
 """Reads data files and saves to Parquet files."""
-import gc
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
 import pathlib
-import pandas as pd
+import time
+import psutil
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import pyreadstat
+import build_utils
+import memory_utils
+import prepare_parquet
 import variables
 
+# most rows read from the SAS file (and written as one Parquet row group) at a time; import_all
+# reads fewer when the memory budget of each worker is smaller (see import_chunk_size)
+CHUNK_SIZE = 500_000
 
-def import_all():
+ENCODING = "latin-1"
+
+# approximate resident bytes per decoded value (pandas chunk, Arrow copy and writer buffers)
+NUMERIC_VALUE_BYTES = 8 * 3
+STRING_VALUE_BYTES = 64 * 3
+
+# approximate bytes per source row that stay resident across chunks until the file is closed
+# (Parquet writer buffers and footer metadata, string dictionaries and the allocator's high-water
+# mark), so a larger year needs more memory than a smaller one at the same chunk size; compare
+# peak_rss with estimated_bytes in data/import_summary.csv to tune them
+NUMERIC_RETAINED_BYTES = 1
+STRING_RETAINED_BYTES = 16
+
+# approximate resident bytes of an idle worker process (interpreter, pandas, pyarrow)
+WORKER_BASE_BYTES = 300 * 1024 ** 2
+
+# start method of the processes decoding parts of a year (see import_from_sas): not fork, as the
+# parent may already run prepare_parquet's column thread pool (see downcast), and forking a
+# process with running threads can deadlock
+PART_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def import_all(
+    max_workers: int | None = None,
+    memory_budget: int | str | None = None,
+    decode_workers: int | None = None,
+):
     """
     Reads data files and saves to Parquet files.
+
+    Years are imported concurrently in a process pool. Each year's peak memory is estimated from
+    its SAS header and a year is only started when the estimates of the running years plus its
+    own fit in memory_budget (see memory_utils.memory_budget), and the RAM available now fits its
+    estimate. Chunks are sized so that max_workers years fit the budget at once. Largest years are
+    started first and smaller years fill the remaining budget.
+
+    max_workers (default: the CPU count) is also the number of cores shared by the running years.
+    A year is decoded by several processes (see import_from_sas) when cores are free: by
+    decode_workers if given, else the cores not used by running years less one for each other
+    pending year, so a large year left on its own uses the whole machine; fewer if its estimate
+    (see estimate_import_memory) would not fit the budget left. Timings, decoding processes and
+    peak RSS (of the process importing each year, not its decoding processes) per year are written
+    to data/import_summary.csv.
+
+    A year is only re-imported if its inputs changed since the last import, as recorded in
+    build_utils.IMPORT_MANIFEST: the source file's hash, or the names and types of the imported
+    columns present in the source (so adding a variable re-imports only the years that have it).
     """
+    manifest = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)
+    downloads = build_utils.load_manifest(build_utils.DOWNLOAD_MANIFEST)
     sources: dict[int, str] = {}
+    metas = {}
+    entries: dict[int, dict] = {}
     files = list(pathlib.Path("data").glob("*.sas7bdat"))
 
     for file in files:
         year_str = "".join(filter(str.isdigit, file.stem))
         if year_str.isdigit():
-            if not pathlib.Path(f"data/us_births_{int(year_str)}.parquet").exists():
-                year = int(year_str)
-                sources[year] = str(file)
+            year = int(year_str)
+            meta = read_metadata(str(file))
+            previous = manifest.get(str(year), {})
+            entry = import_entry(file, meta, downloads.get(file.name), previous.get("source"))
+
+            if is_up_to_date(entry, previous):
+                continue
+
+            sources[year] = str(file)
+            metas[year] = meta
+            entries[year] = entry
+
+    if not sources:
+        print("All years are up to date.")
+        return
+
+    memory_budget = memory_utils.memory_budget(memory_budget)
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_sizes = {year: import_chunk_size(meta, memory_budget // max_workers) for year, meta in metas.items()}
+    estimates = {year: estimate_import_memory(meta, chunk_sizes[year]) for year, meta in metas.items()}
+    pending = sorted(sources, key=lambda year: (estimates[year], year), reverse=True)
+    running: dict[concurrent.futures.Future, int] = {}
+    workers: dict[int, int] = {}
+    reserved = 0
+    busy = 0
+    summary = []
+    errors = []
+
+    print(f"Importing {len(pending)} years with a memory budget of {memory_budget / 1024 ** 3:.1f} GB...")
+
+    # each year computes with its share of the threads (see prepare_parquet's column pool)
+    threads = max(memory_utils.threads() // max_workers, 1)
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, max_tasks_per_child=1, initializer=_set_threads, initargs=(threads,)
+    ) as executor:
+        while pending or running:
+            for year in list(pending):
+                if busy >= max_workers:
+                    break
+                # a year larger than the whole budget still runs, but on its own
+                fits = reserved + estimates[year] <= memory_budget
+                if (fits and psutil.virtual_memory().available >= estimates[year]) or not running:
+                    cores = decode_workers or max(1, max_workers - busy - (len(pending) - 1))
+                    workers[year] = decode_processes(metas[year], chunk_sizes[year], cores, memory_budget - reserved)
+                    estimates[year] = estimate_import_memory(metas[year], chunk_sizes[year], workers[year])
+                    future = executor.submit(_import_year, sources[year], year, chunk_sizes[year], workers[year])
+                    running[future] = year
+                    reserved += estimates[year]
+                    busy += workers[year]
+                    pending.remove(year)
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                year = running.pop(future)
+                reserved -= estimates[year]
+                busy -= workers[year]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Failed to import {year}: {e}")
+                    errors.append(year)
+                    continue
+                result["estimated_bytes"] = estimates[year]
+                result["chunk_size"] = chunk_sizes[year]
+                result["workers"] = workers[year]
+                invalid = result.pop("invalid")
+                summary.append(result)
+
+                out_path = pathlib.Path(f"data/us_births_{year}.parquet")
+                entries[year]["output"] = {"path": out_path.as_posix(), **build_utils.file_entry(out_path)}
+                # values set to null on import, for the quality profile (see prepare_parquet)
+                entries[year]["invalid"] = invalid
+                manifest[str(year)] = entries[year]
+                build_utils.save_manifest(manifest, build_utils.IMPORT_MANIFEST)
+
+                print(
+                    f"Imported {year} in {result['seconds']:.0f}s, peak RSS {result['peak_rss'] / 1024 ** 3:.2f} GB "
+                    f"(estimated {estimates[year] / 1024 ** 3:.2f} GB)"
+                )
+
+    if summary:
+        summary.sort(key=lambda row: row["year"])
+        pa_csv.write_csv(pa.Table.from_pylist(summary), "data/import_summary.csv")
+
+    if errors:
+        raise RuntimeError(f"Failed to import years: {sorted(errors)}")
+
+
+def read_metadata(source: str):
+    """
+    Reads the header of a SAS file (row count, column names and types) without reading any data.
+    """
+    _, meta = pyreadstat.read_sas7bdat(source, metadataonly=True, encoding=ENCODING)
+    return meta
+
 
-    sources = dict(sorted(sources.items(), key=lambda item: item[0], reverse=True))
+def import_entry(source: pathlib.Path, meta, *source_entries: dict | None) -> dict:
+    """
+    Returns the import manifest entry describing the inputs of a year's import: the source file
+    (with its hash, reused from source_entries when they still match the file) and a hash of the
+    imported columns present in the source, with their source and storage types and ranges.
+    """
+    schema = sas_schema(meta)
+    present = [col for col in variables.IMPORTED_VARS if col in meta.readstat_variable_types]
+    sha256 = build_utils.file_sha256(source, *source_entries)
+
+    return {
+        "source": {"path": source.as_posix(), **build_utils.file_entry(source, sha256)},
+        **columns_entry(schema, present),
+    }
+
+
+def columns_entry(schema: pa.Schema, present: list[str]) -> dict:
+    """
+    Returns the hash (and count) of the imported columns present in a source, with their source
+    and storage types and ranges, for an import manifest entry.
+    """
+    columns = [
+        [
+            col,
+            str(schema.field(col).type),
+            str(prepare_parquet.output_type(col, schema.field(col).type)),
+            variables.UINT8_SPECS.get(col) or variables.UINT16_SPECS.get(col),
+        ]
+        for col in present
+    ]
+    # ids are added on import, so files imported before they were (or with other ids) are reimported
+    columns.append([variables.Variables.ID, "int64", "int64", variables.ID_YEAR_FACTOR])
 
-    for year, source in sources.items():
-        import_from_sas(source, year)
-        gc.collect()
+    return {"columns_sha256": build_utils.sha256_json(columns), "columns": len(columns)}
 
 
-def import_from_sas(source: str, year: int):
+def is_up_to_date(entry: dict, previous: dict) -> bool:
+    """
+    True if a year's output exists unchanged and was built from the same inputs as entry.
+    """
+    output = previous.get("output")
+
+    return (
+        output is not None
+        and build_utils.is_verified(pathlib.Path(output["path"]), output)
+        and previous.get("source", {}).get("sha256") == entry["source"]["sha256"]
+        and previous.get("columns_sha256") == entry["columns_sha256"]
+    )
+
+
+def estimate_import_memory(meta, chunk_size: int = CHUNK_SIZE, workers: int = 1) -> int:
+    """
+    Estimates the peak memory (bytes) of importing a SAS file, from its header: the rows held at
+    once (one chunk, or the whole file if smaller, per decoding process) times the bytes of the
+    imported columns present, plus what stays resident across chunks for every row of the file,
+    plus each process (the importing one and, with more than one worker, its decoding processes).
+    """
+    rows = min(meta.number_rows or chunk_size, chunk_size)
+    processes = workers + 1 if workers > 1 else 1
+
+    return processes * WORKER_BASE_BYTES + _retained_bytes(meta) + workers * rows * _row_bytes(meta)
+
+
+def decode_processes(meta, chunk_size: int, cores: int, memory_budget: int) -> int:
+    """
+    Returns the number of processes (at most cores, and at least one) decoding a SAS file whose
+    import fits memory_budget bytes (see estimate_import_memory); no more than its row ranges.
+    """
+    workers = len(row_ranges(meta.number_rows, chunk_size, cores))
+    while workers > 1 and estimate_import_memory(meta, chunk_size, workers) > memory_budget:
+        workers -= 1
+
+    return workers
+
+
+def import_chunk_size(meta, memory_budget: int) -> int:
+    """
+    Returns the chunk size (rows, at most CHUNK_SIZE) for importing a SAS file within memory_budget
+    bytes, from its header (see estimate_import_memory).
+    """
+    budget = memory_budget - WORKER_BASE_BYTES - _retained_bytes(meta)
+    plan = memory_utils.plan_batches(_row_bytes(meta), budget, 1, max_rows=CHUNK_SIZE)
+    return plan.batch_rows
+
+
+def _row_bytes(meta, numeric_bytes: int = NUMERIC_VALUE_BYTES, string_bytes: int = STRING_VALUE_BYTES) -> int:
+    # approximate resident bytes per row of the imported columns present in a SAS file
+    types = meta.readstat_variable_types
+    present = [col for col in variables.IMPORTED_VARS if col in types]
+    return sum(string_bytes if types[col] == "string" else numeric_bytes for col in present)
+
+
+def _retained_bytes(meta) -> int:
+    # approximate bytes resident across chunks for the whole SAS file (see NUMERIC_RETAINED_BYTES)
+    return (meta.number_rows or 0) * _row_bytes(meta, NUMERIC_RETAINED_BYTES, STRING_RETAINED_BYTES)
+
+
+def _set_threads(threads: int) -> None:
+    os.environ[memory_utils.THREADS_ENV] = str(threads)
+
+
+def _import_year(source: str, year: int, chunk_size: int, workers: int = 1) -> dict:
+    # runs in a fresh worker process (max_tasks_per_child=1), so peak RSS is this year's alone
+    start = time.perf_counter()
+    stats = import_from_sas(source, year, chunk_size, workers)
+    return {"year": year, "seconds": time.perf_counter() - start, "peak_rss": memory_utils.peak_rss(), "invalid": stats}
+
+
+def import_from_sas(
+    source: str,
+    year: int,
+    chunk_size: int = CHUNK_SIZE,
+    workers: int | None = 1,
+    out_path: pathlib.Path | None = None,
+):
     """
     Imports data from a SAS file and saves it as a Parquet file.
+
+    The file is read chunk_size rows at a time and each chunk is written as a row group, so memory
+    use depends on the chunk size rather than the size of the year. Each chunk is cast to the
+    storage types in variables (see downcast), so the file is compact from the start.
+
+    With more than one worker, the rows are split into contiguous ranges (on chunk boundaries)
+    that are decoded in separate processes, each writing a part file. The parts are then stitched
+    together in row order, row group by row group, giving the same file as a serial import.
     """
     print(f"Importing data for year {year} from {source}...")
 
-    df = pd.read_sas(source, format="sas7bdat", encoding="latin-1")
-    df = df.reindex(columns=variables.IMPORTED_VARS)
+    out_path = out_path or pathlib.Path(f"data/us_births_{year}.parquet")
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+
+    meta = read_metadata(source)
+    schema = sas_schema(meta)
+    columns = [col for col in variables.IMPORTED_VARS if col in meta.readstat_variable_types]
+    ranges = row_ranges(meta.number_rows, chunk_size, workers or os.cpu_count() or 1)
+
+    if len(ranges) > 1:
+        print(f"Decoding {meta.number_rows:,} rows in {len(ranges)} parts...")
+
+        part_paths = [out_path.with_name(f"{out_path.stem}.part{i:03}.parquet") for i in range(len(ranges))]
+
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=len(ranges), mp_context=PART_CONTEXT) as executor:
+                futures = [
+                    executor.submit(_import_range, source, year, schema, columns, offset, limit, chunk_size, part_path)
+                    for (offset, limit), part_path in zip(ranges, part_paths)
+                ]
+                stats = merge_stats(*(future.result() for future in futures))
+
+            print(f"Saving to {out_path}...")
 
-    print(f"Saving to data/us_births_{year}.parquet...")
+            with pq.ParquetWriter(tmp_path, prepare_parquet.output_schema(schema), compression="zstd") as writer:
+                for part_path in part_paths:
+                    part = pq.ParquetFile(part_path)
+                    for i in range(part.num_row_groups):
+                        writer.write_table(part.read_row_group(i))
+        finally:
+            for part_path in part_paths:
+                part_path.unlink(missing_ok=True)
+    else:
+        print(f"Saving to {out_path}...")
+
+        stats = _import_range(source, year, schema, columns, 0, meta.number_rows, chunk_size, tmp_path)
+
+    print_stats(year, stats)
+
+    tmp_path.replace(out_path)
+
+    return stats
+
+
+def downcast(table: pa.Table, stats: dict) -> pa.Table:
+    """
+    Casts imported columns to their storage types (see variables.UINT8_SPECS etc.), as
+    prepare_parquet does, counting invalid values per column in stats.
+    """
+    batches = [prepare_parquet.process_batch(batch, stats) for batch in table.to_batches()]
+
+    return pa.Table.from_batches(batches, schema=prepare_parquet.output_schema(table.schema))
+
+
+def merge_stats(*stats: dict) -> dict:
+    """
+    Sums invalid value counts (column -> reason -> count) from several imports.
+    """
+    merged: dict[str, dict[str, int]] = {}
 
-    df.to_parquet(f"data/us_births_{year}.parquet", compression="zstd")
+    for s in stats:
+        for col, counts in s.items():
+            for reason, count in counts.items():
+                merged.setdefault(col, {})[reason] = merged.get(col, {}).get(reason, 0) + count
+
+    return merged
+
+
+def print_stats(year: int, stats: dict) -> None:
+    """
+    Prints the columns of a year that had invalid values set to null.
+    """
+    for col, counts in sorted(stats.items()):
+        invalid = {reason: count for reason, count in counts.items() if count}
+        if invalid:
+            print(f"{year} {col}: {invalid}")
+
+
+def _import_range(
+    source: str,
+    year: int,
+    schema: pa.Schema,
+    columns: list[str],
+    offset: int,
+    limit: int | None,
+    chunk_size: int,
+    out_path: pathlib.Path,
+) -> dict:
+    # decodes rows [offset, offset + limit) into out_path, one row group per chunk, with their
+    # ids (see variables.record_ids); returns stats
+    end = None if limit is None else offset + limit
+    stats = {}
+
+    with pq.ParquetWriter(out_path, prepare_parquet.output_schema(schema), compression="zstd") as writer:
+        while end is None or offset < end:
+            n = chunk_size if end is None else min(chunk_size, end - offset)
+            df, _ = pyreadstat.read_sas7bdat(
+                source, row_offset=offset, row_limit=n, usecols=columns, encoding=ENCODING
+            )
+            if len(df) == 0:
+                break
+
+            for name in columns:
+                if pa.types.is_string(schema.field(name).type):
+                    # blank strings are missing (as pd.read_sas treats them)
+                    df[name] = df[name].mask(df[name].str.strip() == "")
+
+            df.insert(0, variables.Variables.ID, variables.record_ids(year, offset, len(df)))
+            df = df.reindex(columns=schema.names)
+            writer.write_table(downcast(pa.Table.from_pandas(df, schema=schema, preserve_index=False), stats))
+
+            offset += len(df)
+            if len(df) < n:
+                break
+
+    return stats
+
+
+def row_ranges(rows: int | None, chunk_size: int, workers: int) -> list[tuple[int, int | None]]:
+    """
+    Splits rows into at most workers contiguous (offset, limit) ranges, each a whole number of
+    chunks (except the last), so row groups are the same however many ranges there are.
+    """
+    if rows is None or workers <= 1:
+        return [(0, rows)]
+
+    chunks = -(-rows // chunk_size)
+    parts = min(workers, chunks)
+    ranges = []
+    start = 0
+
+    for i in range(parts):
+        n = chunks // parts + (1 if i < chunks % parts else 0)
+        end = min(rows, start + n * chunk_size)
+        ranges.append((start, end - start))
+        start = end
+
+    return ranges
+
+
+def sas_schema(meta) -> pa.Schema:
+    """
+    Returns the Arrow schema of the id and imported columns, from the SAS file header.
+
+    Character columns are strings; numeric columns, and imported columns the file does not
+    have, are float64 (as pd.read_sas followed by reindex would give). The id column (see
+    variables.record_ids) comes first.
+    """
+    types = meta.readstat_variable_types
+
+    return pa.schema(
+        [pa.field(variables.Variables.ID, pa.int64())]
+        + [
+            pa.field(col, pa.string() if types.get(col) == "string" else pa.float64())
+            for col in variables.IMPORTED_VARS
+        ]
+    )
 
 
 if __name__ == "__main__":
-    import_all()
+    parser = argparse.ArgumentParser(description="Imports the SAS files in data/ to Parquet files.")
+    parser.add_argument("--max-workers", type=int, default=None, help="cores shared by the years (default: all)")
+    parser.add_argument(
+        "--memory-budget", default=None, help="memory for all processes, e.g. 16G (default: a share of available RAM)"
+    )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=None,
+        help="processes decoding each year (default: the cores left free by the other years; 1 to decode serially)",
+    )
+    args = parser.parse_args()
+
+    import_all(args.max_workers, args.memory_budget, args.decode_workers)
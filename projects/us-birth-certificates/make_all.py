@@ -1,43 +1,45 @@
 """Merge annual data files into one."""
 
-import pandas as pd
+import pathlib
+import pyarrow.parquet as pq
 
+import build_utils
+import memory_utils
 import variables
 
-PARQUET_ENGINE = "fastparquet"
+BATCH_COPIES = 3
+"""Batches held at once: read, cast and buffered by the writer."""
 
 
-def merge_years():
-    "Merge annual data files into one."
+def merge_years(out_path: pathlib.Path = build_utils.DATA_DIR / "us_births_all.parquet"):
+    """
+    Merge annual data files into one.
 
-    sources = [
-        "data/us_births_2014.parquet",
-        "data/us_births_2015.parquet",
-        "data/us_births_2016.parquet",
-        "data/us_births_2017.parquet",
-        "data/us_births_2018.parquet",
-        "data/us_births_2019.parquet",
-        "data/us_births_2020.parquet",
-        "data/us_births_2021.parquet",
-        "data/us_births_2022.parquet",
-        "data/us_births_2023.parquet",
-        "data/us_births_2024.parquet",
-    ]
+    The years are those in the import manifest. Each file is streamed one record batch at a time,
+    with column types set as variables.set_all_column_types does (via set_all_column_types_arrow),
+    so peak memory is about one batch whatever the number of years. Batch and row group sizes are
+    planned from the memory budget (see memory_utils).
+    """
 
-    dataframes = []
+    manifest = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)
+    sources = [pathlib.Path(entry["output"]["path"]) for _, entry in sorted(manifest.items())]
 
-    for source in sources:
-        print(f"Reading {source}...")
+    if not sources:
+        raise FileNotFoundError(f"No per-year Parquet files in {build_utils.IMPORT_MANIFEST}")
 
-        df = pd.read_parquet(source)
+    schema = variables.arrow_schema()
+    plan = memory_utils.plan_batches(memory_utils.row_bytes(schema), memory_utils.memory_budget(), BATCH_COPIES)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
 
-        df = columns.set_all_column_types(df)
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        for source in sources:
+            print(f"Reading {source}...")
 
-        dataframes.append(df)
+            for batch in pq.ParquetFile(source).iter_batches(batch_size=plan.batch_rows):
+                batch = variables.set_all_column_types_arrow(batch, schema)
+                writer.write_batch(batch, row_group_size=plan.row_group_rows)
 
-    data_all = pd.concat(dataframes)
-
-    data_all.to_parquet("data/us_births_all.parquet", engine=PARQUET_ENGINE)
+    tmp_path.replace(out_path)
 
 
 if __name__ == "__main__":
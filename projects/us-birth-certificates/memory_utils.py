@@ -0,0 +1,166 @@
+"""Memory budget planning shared by the pipeline stages.
+
+The budget (bytes) is MEMORY_BUDGET_ENV if set (e.g. "16G"; pipeline.py sets it for the
+processes it starts, to their share of its own budget), otherwise MEMORY_FRACTION of the RAM
+available (from psutil). Stages size their batches and row groups from it (see plan_batches), so
+the same code runs on a laptop and a large server, and slow their read-ahead when the process's
+RSS nears it (see MemoryGuard).
+
+Likewise, the threads a process computes with are THREADS_ENV if set (pipeline.py sets it to the
+process's share of the cores), otherwise the CPU count (see threads).
+"""
+
+import os
+import sys
+import time
+import typing
+import psutil
+import pyarrow as pa
+
+MEMORY_BUDGET_ENV = "US_BIRTHS_MEMORY_BUDGET"
+"""Environment variable giving the memory budget of a process, in bytes (or with a K, M or G suffix)."""
+
+THREADS_ENV = "US_BIRTHS_THREADS"
+"""Environment variable giving the number of threads a process computes with."""
+
+MEMORY_FRACTION = 0.8
+"""Share of available RAM used by default."""
+
+STRING_VALUE_BYTES = 16
+"""Approximate Arrow bytes per string value (offset plus a few characters; most are short codes)."""
+
+MIN_BATCH_ROWS = 65_536
+MAX_BATCH_ROWS = 2_097_152
+"""Bounds on planned batch sizes: smaller batches are slow, larger ones no faster."""
+
+MAX_ROW_GROUP_ROWS = 1_048_576
+"""Largest planned Parquet row group, so that readers can stream the files in modest memory."""
+
+HIGH_WATER = 0.9
+"""Share of the budget at which MemoryGuard applies backpressure."""
+
+POLL_SECONDS = 0.05
+
+_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def memory_budget(budget: int | str | None = None, workers: int = 1) -> int:
+    """
+    Returns the memory budget (bytes) of each of workers processes: budget if given (as bytes or
+    e.g. "16G"), else MEMORY_BUDGET_ENV if set, else MEMORY_FRACTION of the RAM available.
+    """
+    if budget is None:
+        budget = os.environ.get(MEMORY_BUDGET_ENV)
+    if budget is None:
+        budget = int(psutil.virtual_memory().available * MEMORY_FRACTION)
+
+    return parse_bytes(budget) // max(workers, 1)
+
+
+def threads() -> int:
+    """
+    Returns the number of threads a process computes with: THREADS_ENV if set, else the CPU count.
+    """
+    return max(int(os.environ.get(THREADS_ENV) or os.cpu_count() or 1), 1)
+
+
+def parse_bytes(value: int | str) -> int:
+    """
+    Parses a size in bytes, optionally with a K, M, G or T suffix (powers of 1024).
+    """
+    if isinstance(value, int):
+        return value
+
+    value = value.strip().upper().removesuffix("B")
+    if value and value[-1] in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1]])
+
+    return int(value)
+
+
+def value_bytes(dtype: pa.DataType) -> int:
+    """
+    Returns the approximate Arrow bytes per value of a type (including its validity bit).
+    """
+    if pa.types.is_dictionary(dtype):
+        dtype = dtype.index_type
+    if pa.types.is_string(dtype) or pa.types.is_large_string(dtype) or pa.types.is_binary(dtype):
+        return STRING_VALUE_BYTES
+    try:
+        return max(dtype.bit_width // 8, 1) + 1
+    except ValueError:
+        return STRING_VALUE_BYTES  # nested or other variable-width types
+
+
+def row_bytes(schema: pa.Schema) -> int:
+    """
+    Returns the approximate Arrow bytes per row of a schema.
+    """
+    return sum(value_bytes(field.type) for field in schema)
+
+
+class BatchPlan(typing.NamedTuple):
+    batch_rows: int
+    row_group_rows: int
+
+
+def plan_batches(
+    row_bytes: int,
+    budget: int,
+    copies: int,
+    min_rows: int = MIN_BATCH_ROWS,
+    max_rows: int = MAX_BATCH_ROWS,
+) -> BatchPlan:
+    """
+    Plans batch and row group sizes for a stage holding up to copies batches of row_bytes per row
+    at once (e.g. read ahead, being processed and queued for writing) within budget bytes.
+    Batches are a multiple of min_rows between min_rows and max_rows; row groups are no larger
+    than batches or MAX_ROW_GROUP_ROWS.
+    """
+    rows = budget // max(copies * row_bytes, 1)
+    rows = max(min_rows, min(max_rows, rows // min_rows * min_rows))
+
+    return BatchPlan(rows, min(rows, MAX_ROW_GROUP_ROWS))
+
+
+def duckdb_config(budget: int | None = None) -> dict[str, str]:
+    """
+    Returns DuckDB connection settings limiting its memory to the budget (see memory_budget).
+    """
+    return {"memory_limit": f"{memory_budget(budget) // 1024**2}MB"}
+
+
+class MemoryGuard:
+    """
+    Applies backpressure when the process's RSS nears the budget: wait() blocks while RSS is above
+    HIGH_WATER of the budget and ready() is false (e.g. until queued batches are consumed), so
+    producers stop working ahead of consumers without ever waiting on memory that cannot be freed.
+    """
+
+    def __init__(self, budget: int | None = None):
+        self.limit = int(memory_budget(budget) * HIGH_WATER)
+        self.waits = 0
+        self._process = psutil.Process()
+
+    def over(self) -> bool:
+        return self._process.memory_info().rss > self.limit
+
+    def wait(self, ready: typing.Callable[[], bool]) -> None:
+        if ready() or not self.over():
+            return
+        self.waits += 1
+        while not ready() and self.over():
+            time.sleep(POLL_SECONDS)
+
+
+def peak_rss() -> int:
+    """
+    Returns the peak resident set size of this process, in bytes.
+    """
+    if sys.platform == "win32":
+        return psutil.Process().memory_info().peak_wset
+
+    import resource
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
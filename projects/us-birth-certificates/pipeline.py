@@ -0,0 +1,323 @@
+"""Runs the data pipeline, skipping stages (and years) whose inputs are unchanged.
+
+The stages are, in order: download -> import -> combine -> prepare -> duckdb_create ->
+duckdb_prepare. Each stage declares its input and output files. A stage is skipped if its outputs
+exist and the fingerprint of its inputs (the paths, sizes and modification times of its input
+files, including its code) matches the one recorded in data/pipeline_state.json after it last ran.
+
+The combine and prepare stages work per year: only the years whose inputs changed are rebuilt,
+in parallel. The import stage also works per year, but does its own change detection and
+scheduling (see import_parquet.import_all). Each stage (or year) runs in a fresh process, and the
+wall time and peak memory (RSS of all processes) of each stage is reported.
+
+The memory budget (--memory-budget, e.g. 16G; by default a share of available RAM) is shared by
+the processes a stage runs at once, each planning its batch sizes from its share (see
+memory_utils). The cores are shared likewise, each process computing with its share of threads.
+
+Usage: python pipeline.py [--force] [--max-workers N] [--memory-budget SIZE] [stage ...]
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import os
+import pathlib
+import runpy
+import sys
+import threading
+import time
+from typing import Callable, NamedTuple
+import psutil
+import build_utils
+import memory_utils
+import quality_profile
+
+PIPELINE_STATE = build_utils.DATA_DIR / "pipeline_state.json"
+
+SAMPLE_INTERVAL = 0.1
+
+HERE = pathlib.Path(__file__).parent
+
+
+def _code(*modules: str) -> list[pathlib.Path]:
+    return [HERE / f"{module}.py" for module in ("build_utils", "variables", *modules)]
+
+
+def _files(root: pathlib.Path, pattern: str) -> list[pathlib.Path]:
+    return sorted(root.glob(pattern))
+
+
+def _import_years() -> list[int]:
+    return sorted(int(year) for year in build_utils.load_manifest(build_utils.IMPORT_MANIFEST))
+
+
+class Stage(NamedTuple):
+    name: str
+    script: str | None = None
+    """For whole stages: the script run (as __main__)."""
+    inputs: Callable[[], list[pathlib.Path]] | None = None
+    outputs: Callable[[], list[pathlib.Path]] | None = None
+    years: Callable[[], list[int]] | None = None
+    """For per-year stages: the years to build."""
+    year_task: tuple[str, str] | None = None
+    """For per-year stages: (module, function) called with years=[year]."""
+    year_inputs: Callable[[int], list[pathlib.Path]] | None = None
+    year_outputs: Callable[[int], list[pathlib.Path]] | None = None
+    out_dir: pathlib.Path | None = None
+    """For per-year stages: the partitioned dataset written (stale years are removed)."""
+
+
+STAGES = [
+    Stage(
+        "download",
+        script="download_data.py",
+        inputs=lambda: _code("download_data"),
+        outputs=lambda: [build_utils.DOWNLOAD_MANIFEST]
+        + [build_utils.DATA_DIR / name for name in build_utils.load_manifest(build_utils.DOWNLOAD_MANIFEST)],
+    ),
+    Stage(
+        "import",
+        script="import_parquet.py",
+        inputs=lambda: _files(build_utils.DATA_DIR, "*.sas7bdat") + _code("import_parquet", "prepare_parquet"),
+        outputs=lambda: [build_utils.IMPORT_MANIFEST]
+        + [build_utils.DATA_DIR / f"us_births_{year}.parquet" for year in _import_years()],
+    ),
+    Stage(
+        "combine",
+        years=_import_years,
+        year_task=("combine_parquet", "combine_all"),
+        year_inputs=lambda year: [build_utils.DATA_DIR / f"us_births_{year}.parquet"] + _code("combine_parquet"),
+        year_outputs=lambda year: [build_utils.partition_path(build_utils.COMBINED_DIR, year)],
+        out_dir=build_utils.COMBINED_DIR,
+    ),
+    Stage(
+        "prepare",
+        years=lambda: build_utils.partition_years(build_utils.COMBINED_DIR),
+        year_task=("prepare_parquet", "prepare_all"),
+        year_inputs=lambda year: [
+            build_utils.partition_path(build_utils.COMBINED_DIR, year),
+            build_utils.PARQUET_WRITER_CONFIG,
+        ]
+        + _code("prepare_parquet", "quality_profile", "cast_kernels", "memory_utils"),
+        year_outputs=lambda year: [
+            build_utils.partition_path(build_utils.PREPARED_DIR, year),
+            build_utils.partition_path(quality_profile.QUALITY_DIR, year),
+        ],
+        out_dir=build_utils.PREPARED_DIR,
+    ),
+    Stage(
+        "duckdb_create",
+        script="duckdb_create.py",
+        inputs=lambda: (
+            _files(build_utils.PREPARED_DIR, "year=*/part-0.parquet")
+            + _files(HERE, "*.csv")
+            + _code("duckdb_create")
+        ),
+        outputs=lambda: [build_utils.DATA_DIR / "us_births_temp.db"],
+    ),
+    Stage(
+        "duckdb_prepare",
+        script="duckdb_prepare.py",
+        inputs=lambda: (
+            [build_utils.DATA_DIR / "us_births_temp.db"]
+            + _files(quality_profile.QUALITY_DIR, "year=*/part-0.parquet")
+            + _code("duckdb_prepare", "variable_index", "quality_profile", "chance")
+        ),
+        outputs=lambda: [build_utils.CURRENT_DATABASE, build_utils.current_database()],
+    ),
+]
+
+
+def fingerprint(paths: list[pathlib.Path]) -> str:
+    """
+    Returns a fingerprint of files' paths, sizes and modification times (missing files included).
+    """
+    return build_utils.sha256_json(
+        [[p.as_posix(), *(build_utils.file_entry(p).values() if p.exists() else [None])] for p in paths]
+    )
+
+
+def run_pipeline(
+    stages: list[str] | None = None,
+    force: bool = False,
+    max_workers: int | None = None,
+    memory_budget: int | str | None = None,
+) -> list[dict]:
+    """
+    Runs the pipeline's stages (or only the named stages), in order, returning a report per stage.
+    """
+    state = build_utils.load_manifest(PIPELINE_STATE)
+    budget = memory_utils.memory_budget(memory_budget)
+
+    print(f"Memory budget: {budget / 1024 ** 3:.1f} GB")
+    report = []
+
+    try:
+        for stage in STAGES:
+            if stages and stage.name not in stages:
+                continue
+
+            print("==============================================================")
+            print(f"Stage: {stage.name}")
+            print("==============================================================")
+
+            with PeakMemory() as memory:
+                start = time.perf_counter()
+                if stage.year_task:
+                    status = _run_per_year(stage, state, force, max_workers, budget)
+                else:
+                    status = _run_whole(stage, state, force, budget)
+                seconds = time.perf_counter() - start
+
+            report.append({"stage": stage.name, "status": status, "seconds": seconds, "peak_rss": memory.peak})
+    finally:
+        build_utils.save_manifest(state, PIPELINE_STATE)
+        print_report(report)
+
+    return report
+
+
+def _run_whole(stage: Stage, state: dict, force: bool, budget: int) -> str:
+    previous = state.get(stage.name, {})
+
+    if not force and _is_up_to_date(stage.inputs(), stage.outputs(), previous.get("inputs")):
+        print(f"Skipping {stage.name}: inputs unchanged.")
+        return "skipped"
+
+    with _executor(1, budget) as executor:
+        executor.submit(_run_script, str(HERE / stage.script)).result()
+
+    # fingerprint the inputs after running, as a stage may update its inputs (duckdb_prepare does)
+    state[stage.name] = {"inputs": fingerprint(stage.inputs())}
+
+    return "ran"
+
+
+def _run_per_year(stage: Stage, state: dict, force: bool, max_workers: int | None, budget: int) -> str:
+    previous = state.get(stage.name, {}).get("years", {})
+    years = stage.years()
+    build_utils.remove_stale_partitions(stage.out_dir, years)
+
+    todo = [
+        year
+        for year in years
+        if force
+        or not _is_up_to_date(stage.year_inputs(year), stage.year_outputs(year), previous.get(str(year)))
+    ]
+    fingerprints = {str(year): previous[str(year)] for year in years if year not in todo}
+    failures = {}
+
+    if todo:
+        print(f"Building {stage.name} for {len(todo)} of {len(years)} years: {todo}")
+
+        module, function = stage.year_task
+        workers = min(max_workers or os.cpu_count() or 1, len(todo))
+
+        with _executor(workers, budget) as executor:
+            futures = {executor.submit(_run_task, module, function, year): year for year in todo}
+            for future in concurrent.futures.as_completed(futures):
+                year = futures[future]
+                try:
+                    future.result()
+                    fingerprints[str(year)] = fingerprint(stage.year_inputs(year))
+                except Exception as e:
+                    print(f"Error building {stage.name} for {year}: {e}")
+                    failures[year] = e
+    else:
+        print(f"Skipping {stage.name}: inputs unchanged for all {len(years)} years.")
+
+    state[stage.name] = {"years": dict(sorted(fingerprints.items()))}
+
+    if failures:
+        raise RuntimeError(f"{stage.name} failed for years: {sorted(failures)}")
+
+    return f"ran {len(todo)}/{len(years)} years" if todo else "skipped"
+
+
+def _is_up_to_date(inputs: list[pathlib.Path], outputs: list[pathlib.Path], previous: str | None) -> bool:
+    return previous == fingerprint(inputs) and all(p.exists() for p in outputs)
+
+
+def _executor(workers: int, budget: int) -> concurrent.futures.ProcessPoolExecutor:
+    # a fresh process per task, each with its share of the memory budget and of the cores
+    threads = max((os.cpu_count() or 1) // workers, 1)
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        max_tasks_per_child=1,
+        initializer=_set_budget,
+        initargs=(budget // workers, threads),
+    )
+
+
+def _set_budget(budget: int, threads: int) -> None:
+    os.environ[memory_utils.MEMORY_BUDGET_ENV] = str(budget)
+    os.environ[memory_utils.THREADS_ENV] = str(threads)
+
+
+def _run_script(path: str) -> None:
+    # with no arguments, so the script does not parse the pipeline's own
+    sys.argv = [path]
+    runpy.run_path(path, run_name="__main__")
+
+
+def _run_task(module: str, function: str, year: int) -> None:
+    getattr(importlib.import_module(module), function)(years=[year])
+
+
+class PeakMemory:
+    """
+    Samples the total RSS of this process and its child processes in a background thread, keeping
+    the peak (in bytes).
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        process = psutil.Process()
+        while True:
+            rss = 0
+            for p in [process, *process.children(recursive=True)]:
+                try:
+                    rss += p.memory_info().rss
+                except psutil.Error:
+                    pass  # process exited
+            self.peak = max(self.peak, rss)
+            if self._stop.wait(self.interval):
+                break
+
+
+def print_report(report: list[dict]) -> None:
+    print("--------------------------------------------------------------")
+    print(f"{'stage':<16}{'status':<24}{'seconds':>10}{'peak RSS (MB)':>16}")
+    for row in report:
+        print(f"{row['stage']:<16}{row['status']:<24}{row['seconds']:>10.1f}{row['peak_rss'] / 1024 ** 2:>16,.0f}")
+    print("--------------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the data pipeline, skipping unchanged work.")
+    parser.add_argument("stages", nargs="*", help=f"stages to run (default: all): {', '.join(s.name for s in STAGES)}")
+    parser.add_argument("--force", action="store_true", help="run stages even if their inputs are unchanged")
+    parser.add_argument("--max-workers", type=int, default=None, help="processes for per-year stages")
+    parser.add_argument(
+        "--memory-budget", default=None, help="memory for all processes, e.g. 16G (default: a share of available RAM)"
+    )
+    args = parser.parse_args()
+
+    unknown = set(args.stages) - {stage.name for stage in STAGES}
+    if unknown:
+        parser.error(f"unknown stages: {sorted(unknown)}")
+
+    run_pipeline(args.stages, force=args.force, max_workers=args.max_workers, memory_budget=args.memory_budget)
@@ -1,9 +1,19 @@
+import concurrent.futures
+import pathlib
+import queue
+import threading
+from typing import Callable, Iterable, Iterator
+import numpy as np
 import pyarrow as pa
 import pyarrow.compute as pc
 import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 
-from variables import Variables as vars
+import build_utils
+import cast_kernels
+import memory_utils
+import quality_profile
+from variables import CODED_VARS, FLOAT16_VARS, STRING_VARS, UINT8_SPECS, UINT16_SPECS, Variables as vars
 
 
 def _any_true(mask: pa.Array) -> bool:
@@ -105,7 +115,154 @@ def constrain_and_cast_uint_robust(
     return out
 
 
+def constrain_and_cast_uint(
+    arr: pa.Array,
+    dtype: pa.DataType,
+    *,
+    min=None,
+    max=None,
+    non_integer="null",
+    range_invalid="null",
+    stats: dict | None = None,
+    stat_key: str | None = None,
+) -> pa.Array:
+    """
+    Same as constrain_and_cast_uint_robust (the reference), using the fused kernel in
+    cast_kernels where it applies. Dictionary arrays are cast via their dictionary (see
+    _constrain_and_cast_dictionary).
+    """
+    if pa.types.is_dictionary(arr.type):
+        return _constrain_and_cast_dictionary(
+            arr,
+            dtype,
+            min=min,
+            max=max,
+            non_integer=non_integer,
+            range_invalid=range_invalid,
+            stats=stats,
+            stat_key=stat_key,
+        )
+
+    fused = cast_kernels.fused_constrain_and_cast_uint(
+        arr,
+        dtype,
+        constrain_and_cast_uint_robust,
+        min=min,
+        max=max,
+        non_integer=non_integer,
+        range_invalid=range_invalid,
+    )
+
+    if fused is None:
+        return constrain_and_cast_uint_robust(
+            arr,
+            dtype,
+            min=min,
+            max=max,
+            non_integer=non_integer,
+            range_invalid=range_invalid,
+            stats=stats,
+            stat_key=stat_key,
+        )
+
+    out, counts = fused
+    _add_counts(stats, stat_key, counts)
+
+    return out
+
+
+def _constrain_and_cast_dictionary(
+    arr: pa.DictionaryArray,
+    dtype: pa.DataType,
+    *,
+    min=None,
+    max=None,
+    non_integer="null",
+    range_invalid="null",
+    stats: dict | None = None,
+    stat_key: str | None = None,
+) -> pa.Array:
+    # parses each distinct value once, then maps the results back to the rows with take; the
+    # counts are weighted by the number of rows each value occurs in (from the indices), and
+    # null rows are parse_invalid for strings, as for the reference
+    indices = arr.indices
+    weights = np.bincount(np.asarray(pc.drop_null(indices)), minlength=len(arr.dictionary))
+
+    fused = cast_kernels.fused_constrain_and_cast_uint(
+        arr.dictionary,
+        dtype,
+        constrain_and_cast_uint_robust,
+        min=min,
+        max=max,
+        non_integer=non_integer,
+        range_invalid=range_invalid,
+        weights=weights,
+    )
+
+    if fused is None:
+        return constrain_and_cast_uint_robust(
+            arr.dictionary_decode(),
+            dtype,
+            min=min,
+            max=max,
+            non_integer=non_integer,
+            range_invalid=range_invalid,
+            stats=stats,
+            stat_key=stat_key,
+        )
+
+    values, counts = fused
+
+    if "parse_invalid" in counts:
+        counts["parse_invalid"] += indices.null_count
+
+    _add_counts(stats, stat_key, counts)
+
+    return values.take(indices)
+
+
+def _add_counts(stats: dict | None, stat_key: str | None, counts: dict[str, int]) -> None:
+    if stats is not None and stat_key is not None:
+        stats.setdefault(stat_key, {})
+        for reason, count in counts.items():
+            stats[stat_key][reason] = stats[stat_key].get(reason, 0) + count
+
+
+def encode_codes(
+    arr: pa.Array,
+    codes: dict[str, int],
+    *,
+    stats: dict | None = None,
+    stat_key: str | None = None,
+) -> pa.Array:
+    """
+    Encodes single-character values (e.g. 'Y' or 'N') as uint8 codes using a code table (see
+    variables.CODED_VARS). Values are trimmed and upper-cased; blank values are null, and values
+    not in the table are null and counted as code_invalid. Dictionary arrays are encoded via
+    their dictionary.
+    """
+    if pa.types.is_dictionary(arr.type):
+        out, invalid = _encode_values(arr.dictionary, codes)
+        weights = np.bincount(np.asarray(pc.drop_null(arr.indices)), minlength=len(arr.dictionary))
+        _add_counts(stats, stat_key, {"code_invalid": int(weights[invalid].sum())})
+        return out.take(arr.indices)
+
+    out, invalid = _encode_values(arr, codes)
+    _add_counts(stats, stat_key, {"code_invalid": int(np.count_nonzero(invalid))})
+    return out
+
+
+def _encode_values(arr: pa.Array, codes: dict[str, int]) -> tuple[pa.Array, np.ndarray]:
+    s = pc.utf8_upper(pc.utf8_trim_whitespace(pc.cast(arr, pa.string())))
+    out = pa.array(list(codes.values()), type=U8).take(pc.index_in(s, value_set=pa.array(list(codes))))
+    invalid = pc.and_(pc.is_null(out), pc.fill_null(pc.not_equal(s, ""), False))
+    return out, np.asarray(invalid)
+
+
 def cast_to(arr: pa.Array, dtype: pa.DataType) -> pa.Array:
+    if pa.types.is_dictionary(arr.type):
+        # cast each distinct value once
+        return pc.cast(arr.dictionary, dtype, safe=False).take(arr.indices)
     return pc.cast(arr, dtype, safe=False)
 
 
@@ -114,259 +271,427 @@ INVALID_POLICY = "null"
 U8 = pa.uint8()
 U16 = pa.uint16()
 
-uint16_specs = {
-    vars.DATAYEAR: (1989, None),
-    vars.BIRYR: (1989, None),
-    vars.DOB_YY: (1989, None),
-    vars.DOB_TT: (0, 9999),
 
-    vars.DBWT: (0, 9999),
-
-    vars.DWGT_R: (100, 999),
-    vars.PWGT_R: (75, 999),
-}
-
-uint8_specs = {
-    vars.DOB_MM: (1, 12),
-    vars.DOB_WK: (1, 7),
+def output_type(name: str, dtype: pa.DataType) -> pa.DataType:
+    """
+    Returns the storage type of a column (see variables.UINT8_SPECS etc.), or dtype if unspecified.
+    """
+    if name == vars.ID:
+        return pa.int64()
+    if name in UINT8_SPECS or name in CODED_VARS:
+        return U8
+    if name in UINT16_SPECS:
+        return U16
+    if name in STRING_VARS:
+        return pa.string()
+    if name in FLOAT16_VARS:
+        return pa.float16()
+    return dtype
+
+
+def output_schema(schema: pa.Schema) -> pa.Schema:
+    """
+    Returns the schema process_batch produces for batches of the given schema.
+    """
+    return pa.schema([pa.field(field.name, output_type(field.name, field.type)) for field in schema])
 
-    vars.BFACIL3: (1, 3),
 
-    vars.MAGER: (12, 50),
-    vars.DMAGE: (None, None),
-    vars.DMAGERPT: (None, None),
-    vars.MAGER14: (1, 14),
-    vars.MAGER9: (1, 14),
-    vars.MAGE36: (1, 41),
-    vars.MAGER12: (1, 14),
-    vars.MAGER8: (1, 9),
+def process_batch(
+    batch: pa.RecordBatch,
+    stats: dict | None = None,
+    profile: dict[str, quality_profile.ColumnProfile] | None = None,
+) -> pa.RecordBatch:
+    """
+    Constrains and casts a batch's columns to their storage types (see output_type), counting
+    invalid values in stats and, if given, adding the cast columns to their profile (see
+    quality_profile). Columns are processed concurrently in a thread pool (pyarrow compute
+    releases the GIL), each counting into its own stats, which are then merged in column order.
+    """
+    if profile is not None:
+        for field in output_schema(batch.schema):
+            profile.setdefault(field.name, quality_profile.ColumnProfile(field.type))
 
-    vars.MBSTATE_REC: (1, 3),
-    vars.RESTATUS: (1, 4),
+    results = list(_column_pool().map(_process_column, batch.schema, batch.columns, [profile] * batch.num_columns))
 
-    vars.MBRACE: (1, 24),
-    vars.MRACE: (None, None),
-    vars.MRACEREC: (None, None),
-    vars.MRACE31: (1, 31),
-    vars.MRACE6: (1, 6),
-    vars.MRACE15: (1, 15),
-    vars.MRACEIMP: (1, 2),
-
-    vars.ORMOTH: (None, None),
-    vars.ORRACEM: (None, None),
-
-    vars.UMHISP: (None, None),
-    vars.MHISPX: (0, 9),
-    vars.MHISP_R: (0, 9),
-    vars.MRACEHISP: (1, 8),
-
-    vars.MAR: (None, None),
-
-    vars.DMEDUC: (None, None),
-    vars.MEDUC: (1, 9),
-    vars.UMEDUC: (None, None),
-    vars.MEDUC6: (None, None),
-    vars.MEDUC_REC: (None, None),
-    vars.MPLBIR: (None, None),
-
-    vars.DFAGERPT: (None, None),
-    vars.FAGE11: (None, None),
-    vars.FAGERPT: (None, None),
-    vars.UFAGECOMB: (None, None),
-    vars.FAGECOMB: (0, 99),
-    vars.FAGEREC11: (0, 11),
-
-    vars.ORFATH: (None, None),
-    vars.ORRACEF: (None, None),
-
-    vars.FRACE: (None, None),
-    vars.FRACEIMP: (None, None),
-    vars.FRACEREC: (None, None),
-
-    vars.UFHISP: (None, None),
-    vars.FRACEHISP: (1, 9),
-    vars.FRACE31: (1, 99),
-    vars.FRACE6: (1, 9),
-    vars.FRACE15: (1, 99),
-
-    vars.FHISPX: (0, 9),
-    vars.FHISP_R: (0, 9),
-
-    vars.FEDUC: (1, 9),
-
-    vars.PRIORLIVE: (0, 99),
-    vars.PRIORDEAD: (0, 99),
-    vars.PRIORTERM: (0, 99),
-
-    vars.LBO_REC: (1, 9),
-    vars.TBO_REC: (1, 9),
-
-    vars.ILLB_R11: (0, 99),
-    vars.ILOP_R11: (0, 99),
-    vars.ILP_R11: (0, 99),
-
-    vars.PRECARE: (0, 10),
-
-    vars.PAY: (1, 9),
-    vars.PAY_REC: (1, 9),
-
-    vars.APGAR5: (0, 99),
-    vars.APGAR5R: (1, 5),
-    vars.APGAR10: (0, 99),
-    vars.APGAR10R: (1, 5),
-
-    vars.DPLURAL: (1, 4),
-    vars.IMP_PLURAL: (1, 1),
-    vars.SETORDER_R: (1, 9),
-
-    vars.GESTREC10: (1, 99),
-
-    vars.NO_ABNORM: (0, 9),
-
-    vars.DOWNS: (0, 255),
-    vars.UCA_DOWNS: (1, 9),
-    vars.NO_CONGEN: (0, 1),
-
-    vars.PREVIS: (0, 99),
-    vars.PREVIS_REC: (1, 12),
-
-    vars.M_HT_IN: (30, 99),
-
-    vars.BMI_R: (1, 9),
-    vars.WTGAIN: (0, 99),
-
-    vars.ME_PRES: (1, 9),
-    vars.RDMETH_REC: (1, 9),
-    vars.DMETH_REC: (1, 9),
-    vars.NO_RISKS: (1, 9),
-    vars.ATTEND: (1, 9),
-}
-
-string_cols = [
-    vars.MAR_P,
-    vars.DMAR,
-    vars.SEX,
-    vars.AB_AVEN1,
-    vars.AB_AVEN6,
-    vars.AB_NICU,
-    vars.AB_SURF,
-    vars.AB_ANTI,
-    vars.AB_SEIZ,
-    vars.CA_ANEN,
-    vars.CA_MNSB,
-    vars.CA_CCHD,
-    vars.CA_CDH,
-    vars.CA_OMPH,
-    vars.CA_GAST,
-    vars.CA_LIMB,
-    vars.CA_CLEFT,
-    vars.CA_CLPAL,
-    vars.CA_DOWN,
-    vars.CA_DOWNS,
-    vars.CA_DISOR,
-    vars.CA_HYPO,
-    vars.BFED,
-    vars.WIC,
-    vars.RF_PDIAB,
-    vars.RF_GDIAB,
-    vars.RF_PHYPE,
-    vars.RF_GHYPE,
-    vars.RF_EHYPE,
-    vars.RF_PPTERM,
-    vars.RF_INFTR,
-    vars.RF_FEDRG,
-    vars.RF_ARTEC,
-    vars.RF_CESAR,
-    vars.RF_CESARN,
-    vars.LD_INDL,
-    vars.LD_AUGM,
-    vars.LD_ANES,
-]
-
-float16_cols = [
-    vars.BMI,
-]
-
-stats = {}
-
-
-def process_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
     arrays = []
     fields = []
 
-    for name, arr in zip(batch.schema.names, batch.columns):
-        if name in uint8_specs:
-            print(f"Processing uint8 column: {name}")
-            mn, mx = uint8_specs[name]
-            arr = constrain_and_cast_uint_robust(
-                arr,
-                U8,
-                min=mn,
-                max=mx,
-                non_integer="null",
-                range_invalid="null",
-                stats=stats,
-                stat_key=name, )
-            arrays.append(arr)
-            fields.append(pa.field(name, U8))
-        elif name in uint16_specs:
-            print(f"Processing uint16 column: {name}")
-            mn, mx = uint16_specs[name]
-            arr = constrain_and_cast_uint_robust(
-                arr,
-                U16,
-                min=mn,
-                max=mx,
-                non_integer="null",
-                range_invalid="null",
-                stats=stats,
-                stat_key=name, )
-            arrays.append(arr)
-            fields.append(pa.field(name, U16))
-        elif name in string_cols:
-            print(f"Processing string column: {name}")
-            arr = cast_to(arr, pa.string())
-            arrays.append(arr)
-            fields.append(pa.field(name, pa.string()))
-        elif name in float16_cols:
-            print(f"Processing float16 column: {name}")
-            arr = cast_to(arr, pa.float16())
-            arrays.append(arr)
-            fields.append(pa.field(name, pa.float16()))
-        else:
-            print(f"Warning: Unspecified column '{name}', passing through as-is.")
-            arrays.append(arr)
-            fields.append(batch.schema.field(name))
+    for arr, field, column_stats, warning in results:
+        if warning and warning not in _warned:
+            _warned.add(warning)
+            print(warning)
+        _merge_stats(stats, column_stats)
+        arrays.append(arr)
+        fields.append(field)
 
     return pa.RecordBatch.from_arrays(arrays, schema=pa.schema(fields))
 
 
-in_path = "./data/us_births_combined.parquet"
-out_path = "./data/us_births.parquet"
+_warned = set()
+
+
+def _merge_stats(stats: dict | None, column_stats: dict) -> None:
+    for key, counts in column_stats.items():
+        _add_counts(stats, key, counts)
+
 
-dataset = ds.dataset(in_path, format="parquet")
+def _process_column(
+    field: pa.Field, arr: pa.Array, profile: dict | None
+) -> tuple[pa.Array, pa.Field, dict, str | None]:
+    arr, field, column_stats, warning = _cast_column(field, arr)
+
+    if profile is not None:
+        # each column is profiled by one thread
+        profile[field.name].update(arr)
+
+    return arr, field, column_stats, warning
+
+
+def _cast_column(field: pa.Field, arr: pa.Array) -> tuple[pa.Array, pa.Field, dict, str | None]:
+    name = field.name
+    dtype = output_type(name, arr.type)
+    column_stats = {}
+
+    if arr.type == dtype and (name in UINT8_SPECS or name in UINT16_SPECS or name in CODED_VARS):
+        # already constrained and cast (on import)
+        return arr, pa.field(name, dtype), column_stats, None
+    elif name in UINT8_SPECS or name in UINT16_SPECS:
+        mn, mx = UINT8_SPECS[name] if name in UINT8_SPECS else UINT16_SPECS[name]
+        arr = constrain_and_cast_uint(
+            arr,
+            dtype,
+            min=mn,
+            max=mx,
+            non_integer="null",
+            range_invalid="null",
+            stats=column_stats,
+            stat_key=name, )
+        return arr, pa.field(name, dtype), column_stats, None
+    elif name in CODED_VARS:
+        arr = encode_codes(arr, CODED_VARS[name], stats=column_stats, stat_key=name)
+        return arr, pa.field(name, dtype), column_stats, None
+    elif name in STRING_VARS or name in FLOAT16_VARS or name == vars.ID:
+        return cast_to(arr, dtype), pa.field(name, dtype), column_stats, None
+    else:
+        return arr, field, column_stats, f"Warning: Unspecified column '{name}', passing through as-is."
 
-# adjust batch_size as needed based on available memory
-scanner = dataset.scanner(batch_size=2_097_152, use_threads=True)
 
-writer = None
-try:
-    for batch in scanner.to_batches():
-        out_batch = process_batch(batch)
-        table = pa.Table.from_batches([out_batch])
+_pool = None
 
-        if writer is None:
-            writer = pq.ParquetWriter(
-                out_path,
-                table.schema,
-                compression="zstd",
-                use_dictionary=True,
-                write_statistics=True,
-            )
 
-        writer.write_table(table, row_group_size=500_000)
-finally:
-    if writer is not None:
-        writer.close()
+def _column_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        # this process's share of the cores, as the pipeline prepares several years at once
+        _pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=memory_utils.threads(), thread_name_prefix="process_batch"
+        )
+    return _pool
+
+
+CLUSTER_ROWS = True
+"""Whether prepare_all sorts rows by CLUSTER_COLUMNS within each partition by default."""
+
+CLUSTER_COLUMNS = [vars.MAGER, vars.MRACEHISP]
+"""
+Columns rows are sorted by within each year partition (the year itself is the partition), so that
+the row group and page statistics of the sorted columns let readers skip most of a file for
+filters on maternal age and race/ethnicity.
+"""
+
+CLUSTER_ROW_GROUP_ROWS = 131_072
+"""Largest row group of a clustered file: smaller row groups let readers skip more finely."""
+
+CLUSTER_COPIES = 3
+"""Copies of the rows sorted in one pass held at once: read, sorted and buffered by the writer."""
+
+UNSORTED_WRITER_OPTIONS = {"compression": "zstd", "compression_level": 1}
+"""Options of the intermediate file written before clustering (read once, then deleted)."""
+
+
+def prepare_all(
+    in_dir: pathlib.Path = build_utils.COMBINED_DIR,
+    out_dir: pathlib.Path = build_utils.PREPARED_DIR,
+    years: list[int] | None = None,
+    cluster: bool = CLUSTER_ROWS,
+):
+    """
+    Prepares each year partition of the combined dataset into the same partition of the prepared
+    dataset. If years is given, only those partitions are rewritten; otherwise all are, and
+    partitions of years not in the combined dataset are removed. If cluster is true, rows are
+    sorted by CLUSTER_COLUMNS within each partition (see cluster_partition).
+    """
+    if years is None:
+        years = build_utils.partition_years(in_dir)
+        build_utils.remove_stale_partitions(out_dir, years)
+
+    build_utils.remove_stale_partitions(quality_profile.QUALITY_DIR, build_utils.partition_years(in_dir))
+    manifest = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)
+
+    for year in years:
+        stats, profile = prepare_partition(
+            build_utils.partition_path(in_dir, year), build_utils.partition_path(out_dir, year), cluster
+        )
+
+        # values set to null on import, and in prepare
+        import_stats = manifest.get(str(year), {}).get("invalid", {})
+        profile_path = build_utils.partition_path(quality_profile.QUALITY_DIR, year)
+        quality_profile.print_invalid(quality_profile.write_profile(profile_path, year, profile, import_stats, stats))
+
+    print("Done.")
+
+
+def prepare_partition(
+    in_path: pathlib.Path, out_path: pathlib.Path, cluster: bool = CLUSTER_ROWS
+) -> tuple[dict, dict]:
+    """
+    Prepares one file, pipelining I/O with processing: batches are read ahead in one thread and
+    written (and compressed) in another, through bounded queues, while the current batch is
+    processed, so reading, processing and writing overlap. Batches are written in read order, or
+    if cluster is true, to an intermediate file that is then sorted (see cluster_partition).
+
+    Batch and row group sizes are planned from the memory budget (see memory_utils), and reading
+    ahead and writing behind wait for the queues to drain when RSS nears the budget.
+
+    Returns the invalid value counts (column -> reason -> count) and the column profiles (see
+    quality_profile) of the prepared file.
+    """
+    print(f"Preparing {in_path}...")
+
+    dataset = ds.dataset(in_path, format="parquet")
+
+    # read string columns to be parsed as dictionaries (as Parquet stores them), so that each
+    # distinct value is parsed once
+    dictionary_columns = [
+        field.name
+        for field in dataset.schema
+        if pa.types.is_string(field.type) and output_type(field.name, field.type) != field.type
+    ]
+    if dictionary_columns:
+        read_options = ds.ParquetReadOptions(dictionary_columns=dictionary_columns)
+        dataset = ds.dataset(in_path, format=ds.ParquetFileFormat(read_options=read_options))
+
+    schema = output_schema(dataset.schema)
+    budget = memory_utils.memory_budget()
+    row_bytes = memory_utils.row_bytes(dataset.schema) + memory_utils.row_bytes(schema)
+    plan = memory_utils.plan_batches(row_bytes, budget, BATCH_COPIES)
+    guard = memory_utils.MemoryGuard(budget)
+
+    print(f"Batches of {plan.batch_rows:,} rows, row groups of {plan.row_group_rows:,} rows...")
+
+    scanner = dataset.scanner(batch_size=plan.batch_rows, use_threads=True)
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    unsorted_path = out_path.with_name(out_path.name + ".unsorted")
+    stats = {}
+    profile = {}
+
+    with pq.ParquetWriter(
+        unsorted_path if cluster else tmp_path,
+        schema,
+        **(UNSORTED_WRITER_OPTIONS if cluster else writer_options(schema)),
+    ) as writer:
+        write_table = lambda table: writer.write_table(table, row_group_size=plan.row_group_rows)
+        with WriteBehind(write_table, guard=guard) as write:
+            for batch in read_ahead(scanner.to_batches(), guard=guard):
+                write(pa.Table.from_batches([process_batch(batch, stats, profile)]))
+
+    if cluster:
+        try:
+            cluster_partition(unsorted_path, tmp_path)
+        finally:
+            unsorted_path.unlink(missing_ok=True)
+
+    tmp_path.replace(out_path)
+
+    return stats, profile
+
+
+def writer_options(schema: pa.Schema, sorted_by: list[str] | None = None) -> dict:
+    """
+    Returns the ParquetWriter options of a prepared file: zstd with each column's encoding and
+    level from build_utils.PARQUET_WRITER_CONFIG (see tune_parquet.py; columns not in it are
+    dictionary encoded at the default level), statistics and page indexes, and (if sorted_by is
+    given) the columns the rows are sorted by recorded in the file metadata.
+
+    There are no Bloom filters: the flag columns (e.g. Down syndrome C/N/P/U) have a handful of
+    values that each occur in nearly every row group, even the rarest, so a filter could not skip
+    any. Readers filter on the flags by the min/max statistics of row groups and pages (the page
+    index) alone, which skip only pages in which no value in the range occurs.
+    """
+    columns = build_utils.load_manifest(build_utils.PARQUET_WRITER_CONFIG).get("columns", {})
+    columns = {col: columns.get(col, {}) for col in schema.names}
+    dictionary = [col for col, c in columns.items() if c.get("use_dictionary", True)]
+
+    options = {
+        "compression": "zstd",
+        "use_dictionary": dictionary if len(dictionary) < len(columns) else True,
+        "write_statistics": True,
+        "write_page_index": True,
+    }
+
+    encodings = {col: c["encoding"] for col, c in columns.items() if col not in dictionary and c.get("encoding")}
+    if encodings:
+        options["column_encoding"] = encodings
+
+    levels = {col: c["compression_level"] for col, c in columns.items() if c.get("compression_level") is not None}
+    if levels:
+        options["compression_level"] = levels
+
+    if sorted_by:
+        options["sorting_columns"] = [
+            pq.SortingColumn(schema.get_field_index(col), descending=False, nulls_first=False) for col in sorted_by
+        ]
+
+    return options
+
+
+def cluster_partition(in_path: pathlib.Path, out_path: pathlib.Path, columns: list[str] = CLUSTER_COLUMNS) -> None:
+    """
+    Writes a file with its rows sorted by columns (ascending, nulls last). The first column must
+    be an unsigned integer column. The rows are sorted in as few passes as the memory budget
+    allows (see memory_utils): each pass reads the rows within a range of the first column's
+    values (with a filter, so only that range is held in memory), sorts them and writes them.
+    """
+    file = pq.ParquetFile(in_path)
+    schema = file.schema_arrow
+    first = columns[0]
+    rows = file.metadata.num_rows
+
+    budget = memory_utils.memory_budget()
+    max_rows = max(rows, memory_utils.MIN_BATCH_ROWS)
+    plan = memory_utils.plan_batches(memory_utils.row_bytes(schema), budget, CLUSTER_COPIES, max_rows=max_rows)
+    counts = _value_counts(file.read(columns=[first]).column(0))
+    ranges = _value_ranges(counts, plan.batch_rows)
+    row_group_rows = min(plan.row_group_rows, CLUSTER_ROW_GROUP_ROWS)
+    dataset = ds.dataset(in_path, format="parquet")
+    sort_keys = [(col, "ascending", "at_end") for col in columns]
+
+    print(f"Sorting {rows:,} rows by {', '.join(columns)} in {len(ranges)} pass(es)...")
+
+    with pq.ParquetWriter(out_path, schema, **writer_options(schema, columns)) as writer:
+        for i, (lo, hi) in enumerate(ranges):
+            expr = (ds.field(first) >= lo) & (ds.field(first) < hi)
+            if i == len(ranges) - 1:
+                expr = expr | ds.field(first).is_null()
+            table = dataset.to_table(filter=expr).sort_by(sort_keys)
+            writer.write_table(table, row_group_size=row_group_rows)
+
+
+def _value_counts(arr: pa.ChunkedArray) -> np.ndarray:
+    # counts of each value of an unsigned integer column (index = value)
+    values = np.asarray(pc.drop_null(arr).combine_chunks())
+    return np.bincount(values, minlength=1)
+
+
+def _value_ranges(counts: np.ndarray, rows: int) -> list[tuple[int, int]]:
+    # splits the values into consecutive [lo, hi) ranges of at most rows rows (a value with more
+    # rows gets a range of its own), covering every value
+    ranges = []
+    lo, total = 0, 0
+
+    for value, count in enumerate(counts):
+        if total and total + count > rows:
+            ranges.append((lo, value))
+            lo, total = value, 0
+        total += count
+
+    ranges.append((lo, len(counts)))
+
+    return ranges
+
+
+QUEUE_DEPTH = 2
+"""Batches buffered between reading, processing and writing (bounds memory to a few batches)."""
+
+BATCH_COPIES = 2 * QUEUE_DEPTH + 2
+"""Batches held at once: queued for processing and writing, being processed and being written."""
+
+_DONE = object()
+
+
+def read_ahead(batches: Iterable, depth: int = QUEUE_DEPTH, guard: memory_utils.MemoryGuard | None = None) -> Iterator:
+    """
+    Iterates batches produced in a background thread, up to depth batches ahead (or, if guard
+    finds RSS near the memory budget, only once the queued batches are consumed).
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # gives up if the consumer stopped (e.g. on an error), so the thread can always be joined
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if guard is not None:
+                    guard.wait(lambda: q.empty() or stop.is_set())
+                if not put(batch):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while (item := q.get()) is not _DONE:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class WriteBehind:
+    """
+    Calls write for each item in a background thread, in order, with up to depth items queued.
+    An error in write is raised on the next call (or on exit). If guard finds RSS near the memory
+    budget, calls wait until the queued items are written.
+    """
 
-print("Done.")
+    def __init__(self, write: Callable, depth: int = QUEUE_DEPTH, guard: memory_utils.MemoryGuard | None = None):
+        self._write = write
+        self._guard = guard
+        self._queue = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __call__(self, item):
+        if self._error is not None:
+            raise self._error
+        if self._guard is not None:
+            self._guard.wait(self._queue.empty)
+        self._queue.put(item)
+
+    def __exit__(self, *exc):
+        self._queue.put(_DONE)
+        self._thread.join()
+        if self._error is not None and exc[0] is None:
+            raise self._error
+
+    def _consume(self):
+        while (item := self._queue.get()) is not _DONE:
+            if self._error is None:
+                try:
+                    self._write(item)
+                except BaseException as e:
+                    self._error = e
+
+
+if __name__ == "__main__":
+    prepare_all()
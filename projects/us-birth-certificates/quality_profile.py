@@ -0,0 +1,176 @@
+"""Per-year data quality profile, collected while preparing the Parquet dataset.
+
+For each year and column: row, null and non-null counts, counts of values set to null because
+they were invalid (by reason: parse_invalid, non_integer, range_invalid and code_invalid, on
+import and in prepare), min and max values and, for columns with few distinct values, a histogram
+of the values. The profile is collected from each batch as it is prepared (integer columns are
+counted with np.bincount), so no separate profiling queries over the data are needed.
+
+Each year's profile is written to QUALITY_DIR/year=YYYY/part-0.parquet by
+prepare_parquet.prepare_partition and loaded into the quality_profile table in us_births.db by
+duckdb_prepare; see data_utils.load_quality_profile.
+"""
+
+import pathlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import build_utils
+
+TABLE = "quality_profile"
+
+QUALITY_DIR = build_utils.DATA_DIR / "quality_profile"
+"""Quality profiles, partitioned by year (year=YYYY/part-0.parquet)."""
+
+REASONS = ["parse_invalid", "non_integer", "range_invalid", "code_invalid"]
+"""Reasons values are set to null (see prepare_parquet.constrain_and_cast_uint and encode_codes)."""
+
+HISTOGRAM_MAX_DISTINCT = 64
+"""Columns with more distinct values (in a year) than this have no histogram."""
+
+SCHEMA = pa.schema(
+    [
+        pa.field("year", pa.uint16()),
+        pa.field("variable", pa.string()),
+        pa.field("type", pa.string()),
+        pa.field("row_count", pa.int64()),
+        pa.field("null_count", pa.int64()),
+        pa.field("non_null_count", pa.int64()),
+        *(pa.field(reason, pa.int64()) for reason in REASONS),
+        pa.field("min_value", pa.string()),
+        pa.field("max_value", pa.string()),
+        pa.field("distinct_count", pa.int64()),
+        pa.field("histogram", pa.list_(pa.struct([("value", pa.string()), ("count", pa.int64())]))),
+    ]
+)
+"""
+Schema of the profile. distinct_count and histogram are null for columns that are not counted
+exactly (floats, and strings with more than HISTOGRAM_MAX_DISTINCT distinct values).
+"""
+
+
+class ColumnProfile:
+    """
+    Accumulates the profile of one column over batches. Unsigned integer columns are counted
+    exactly (np.bincount over the type's whole range); string columns are counted with
+    value_counts until they have more than HISTOGRAM_MAX_DISTINCT distinct values; other columns
+    only have min and max.
+    """
+
+    def __init__(self, dtype: pa.DataType):
+        self.dtype = dtype
+        self.rows = 0
+        self.nulls = 0
+        self.bins = None
+        self.values = {} if pa.types.is_string(dtype) else None
+        self.min = None
+        self.max = None
+
+        if pa.types.is_uint8(dtype) or pa.types.is_uint16(dtype):
+            self.bins = np.zeros(np.iinfo(dtype.to_pandas_dtype()).max + 1, dtype=np.int64)
+
+    def update(self, arr: pa.Array) -> None:
+        self.rows += len(arr)
+        self.nulls += arr.null_count
+
+        if self.bins is not None:
+            values = np.asarray(pc.drop_null(arr))
+            self.bins += np.bincount(values, minlength=len(self.bins))
+            return
+
+        if self.values is not None:
+            for item in pc.value_counts(arr).to_pylist():
+                if item["values"] is not None:
+                    self.values[item["values"]] = self.values.get(item["values"], 0) + item["counts"]
+            if len(self.values) > HISTOGRAM_MAX_DISTINCT:
+                self.values = None
+
+        if pa.types.is_float16(arr.type):
+            arr = pc.cast(arr, pa.float32())  # min_max has no float16 kernel
+
+        min_max = pc.min_max(arr).as_py()
+        if min_max["min"] is not None:
+            self.min = min_max["min"] if self.min is None else min(self.min, min_max["min"])
+            self.max = min_max["max"] if self.max is None else max(self.max, min_max["max"])
+
+    def row(self, year: int, variable: str, invalid: dict[str, int]) -> dict:
+        """Returns the profile as a row of SCHEMA."""
+
+        histogram = None
+        distinct = None
+        lo, hi = self.min, self.max
+
+        if self.bins is not None:
+            present = np.flatnonzero(self.bins)
+            distinct = len(present)
+            if distinct:
+                lo, hi = int(present[0]), int(present[-1])
+            if distinct <= HISTOGRAM_MAX_DISTINCT:
+                histogram = [{"value": str(value), "count": int(self.bins[value])} for value in present]
+        elif self.values is not None:
+            distinct = len(self.values)
+            histogram = [{"value": value, "count": count} for value, count in sorted(self.values.items())]
+
+        return {
+            "year": year,
+            "variable": variable,
+            "type": str(self.dtype),
+            "row_count": self.rows,
+            "null_count": self.nulls,
+            "non_null_count": self.rows - self.nulls,
+            **{reason: invalid.get(reason, 0) for reason in REASONS},
+            "min_value": None if lo is None else str(lo),
+            "max_value": None if hi is None else str(hi),
+            "distinct_count": distinct,
+            "histogram": histogram,
+        }
+
+
+def write_profile(
+    path: pathlib.Path,
+    year: int,
+    profile: dict[str, ColumnProfile],
+    *invalid: dict[str, dict[str, int]],
+) -> pa.Table:
+    """
+    Writes a year's profile (in column order) with the invalid value counts (column -> reason ->
+    count) of one or more steps summed, and returns it.
+    """
+    totals: dict[str, dict[str, int]] = {}
+    for counts in invalid:
+        for col, reasons in counts.items():
+            for reason, count in reasons.items():
+                totals.setdefault(col, {})[reason] = totals.get(col, {}).get(reason, 0) + count
+
+    table = pa.Table.from_pylist(
+        [column.row(year, col, totals.get(col, {})) for col, column in profile.items()], schema=SCHEMA
+    )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    pq.write_table(table, tmp)
+    tmp.replace(path)
+
+    return table
+
+
+def load_profiles(path: pathlib.Path = QUALITY_DIR) -> pa.Table:
+    """
+    Returns the profiles of all years, in year and column order.
+    """
+    if not any(path.glob("year=*/part-0.parquet")):
+        return SCHEMA.empty_table()
+
+    return ds.dataset(path, format="parquet", schema=SCHEMA).to_table()
+
+
+def print_invalid(profile: pa.Table) -> None:
+    """
+    Prints the columns of a profile that had invalid values set to null.
+    """
+    for row in profile.to_pylist():
+        invalid = {reason: row[reason] for reason in REASONS if row[reason]}
+        if invalid:
+            print(f"{row['year']} {row['variable']}: {invalid}")
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# the project's modules import each other by name, as when run from the project folder
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
@@ -0,0 +1,149 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+import cast_kernels
+import prepare_parquet
+from benchmark_casts import EDGE_CASES, SPECS
+
+NUMBERS = [0.0, 1.0, 2.5, -1.0, -0.0, 300.0, 70000.0, 1e300, float("nan"), float("inf"), float("-inf"), None]
+
+SPEC_IDS = [f"{dtype}-{mn}-{mx}" for dtype, mn, mx in SPECS]
+
+
+def reference(arr: pa.Array, dtype: pa.DataType, mn, mx) -> tuple[pa.Array, dict]:
+    stats = {}
+    if pa.types.is_dictionary(arr.type):
+        arr = arr.dictionary_decode()
+    out = prepare_parquet.constrain_and_cast_uint_robust(arr, dtype, min=mn, max=mx, stats=stats, stat_key="col")
+    return out, stats
+
+
+def assert_same(arr: pa.Array, dtype: pa.DataType, mn, mx):
+    expected, expected_stats = reference(arr, dtype, mn, mx)
+    stats = {}
+    out = prepare_parquet.constrain_and_cast_uint(arr, dtype, min=mn, max=mx, stats=stats, stat_key="col")
+
+    assert out.type == expected.type
+    assert out.to_pylist() == expected.to_pylist()
+    assert stats == expected_stats
+    assert list(stats["col"]) == list(expected_stats["col"])
+
+
+def assert_kernel_same(arr: pa.Array, dtype: pa.DataType, mn, mx):
+    # the kernel itself, rather than through constrain_and_cast_uint (which may not use it)
+    expected, expected_stats = reference(arr, dtype, mn, mx)
+    result = cast_kernels.fused_constrain_and_cast_uint(
+        arr, dtype, prepare_parquet.constrain_and_cast_uint_robust, min=mn, max=mx
+    )
+
+    assert result is not None
+    out, counts = result
+    assert out.to_pylist() == expected.to_pylist()
+    assert counts == expected_stats["col"]
+    assert list(counts) == list(expected_stats["col"])
+
+
+@pytest.mark.parametrize("dtype, mn, mx", SPECS, ids=SPEC_IDS)
+@pytest.mark.parametrize("value", EDGE_CASES)
+def test_string_edge_cases(value, dtype, mn, mx):
+    assert_kernel_same(pa.array([value, "1"], type=pa.string()), dtype, mn, mx)
+
+
+@pytest.mark.parametrize("dtype, mn, mx", SPECS, ids=SPEC_IDS)
+@pytest.mark.parametrize("value", NUMBERS)
+def test_number_edge_cases(value, dtype, mn, mx):
+    assert_kernel_same(pa.array([value, 1.0], type=pa.float64()), dtype, mn, mx)
+
+
+@pytest.mark.parametrize("dtype, mn, mx", SPECS, ids=SPEC_IDS)
+@pytest.mark.parametrize(
+    "values",
+    [
+        ["+5", "+0", "+255", "+256", "+1.0", "+1.5", "+-1"],
+        ["-1", "-0", "-1.0", "-255", "-x"],
+        ["1e2", "1E2", "1e-2", "1e+2", "2.5e1", "1E400", "e", "E5", "1e"],
+        [" 7", "7 ", "  8  ", "\t3", "3\n", "\x1c4", " 5", "5 ", " ", ""],
+        ["café", "١", "５", "½", "ⅷ", "1​"],
+        ["255", "256", "65535", "65536", "4294967296", "1" * 16, "1" * 17, "0" * 20 + "1", "1" + "0" * 30],
+    ],
+    ids=["signs", "negative", "exponents", "whitespace", "non-ascii", "out-of-range"],
+)
+def test_string_cases(values, dtype, mn, mx):
+    assert_same(pa.array(values, type=pa.string()), dtype, mn, mx)
+
+
+@pytest.mark.parametrize("dtype, mn, mx", SPECS, ids=SPEC_IDS)
+@pytest.mark.parametrize(
+    "arr",
+    [
+        pa.array([1, 2, None, 14, 200], type=pa.uint8()),
+        pa.array([0, 1, 255, 256, 65535, 65536, None], type=pa.int64()),
+        pa.array([-1, -128, 127, None], type=pa.int8()),
+        pa.array([1.0, 1.5, 1e20, -1e20, None], type=pa.float32()),
+    ],
+    ids=["uint8", "int64", "int8", "float32"],
+)
+def test_numeric_types(arr, dtype, mn, mx):
+    assert_same(arr, dtype, mn, mx)
+
+
+@pytest.mark.parametrize("dtype, mn, mx", SPECS, ids=SPEC_IDS)
+@pytest.mark.parametrize(
+    "arr",
+    [
+        pa.array([], type=pa.string()),
+        pa.nulls(5, type=pa.string()),
+        pa.nulls(5, type=pa.float64()),
+        pc.dictionary_encode(pa.nulls(5, type=pa.string())),
+        pa.array([None, "1", None, "X", None], type=pa.string()),
+    ],
+    ids=["empty", "all null", "all null float64", "all null dictionary", "some null"],
+)
+def test_nulls(arr, dtype, mn, mx):
+    assert_same(arr, dtype, mn, mx)
+
+
+@pytest.mark.parametrize("dtype, mn, mx", SPECS, ids=SPEC_IDS)
+def test_mixtures(dtype, mn, mx):
+    # random mixtures of the edge cases, as plain, sliced and dictionary arrays
+    rng = np.random.default_rng(0)
+
+    for _ in range(50):
+        values = list(rng.choice(np.array(EDGE_CASES, dtype=object), 50))
+        arr = pa.array(values, type=pa.string())
+        assert_same(arr, dtype, mn, mx)
+        assert_same(arr.slice(7, 30), dtype, mn, mx)
+        assert_same(pc.dictionary_encode(arr), dtype, mn, mx)
+        assert_same(pc.dictionary_encode(arr).slice(7, 30), dtype, mn, mx)
+
+
+@pytest.mark.parametrize("dtype, mn, mx", SPECS, ids=SPEC_IDS)
+def test_sliced_numbers(dtype, mn, mx):
+    arr = pa.array([5.0, None, 2.5, 1.0, 300.0, float("nan"), 9.0, 70000.0], type=pa.float64())
+    assert_same(arr.slice(1, 6), dtype, mn, mx)
+    assert_kernel_same(arr.slice(3), dtype, mn, mx)
+
+
+def test_weights():
+    # a dictionary's values, each counted as many times as it occurs
+    arr = pa.array(["1", "X", "1.5", "300", "-1", None], type=pa.string())
+    weights = np.array([3, 2, 4, 1, 5, 6])
+
+    out, counts = cast_kernels.fused_constrain_and_cast_uint(
+        arr, pa.uint8(), prepare_parquet.constrain_and_cast_uint_robust, min=1, max=14, weights=weights
+    )
+    _, expected_stats = reference(pa.array(np.repeat(arr.to_pylist(), weights).tolist()), pa.uint8(), 1, 14)
+
+    assert out.to_pylist() == [1, None, None, None, None, None]
+    assert counts == expected_stats["col"]
+
+
+def test_unhandled():
+    reference_cast = prepare_parquet.constrain_and_cast_uint_robust
+    arr = pa.array(["1"], type=pa.string())
+
+    assert cast_kernels.fused_constrain_and_cast_uint(arr, pa.uint8(), reference_cast, non_integer="truncate") is None
+    assert cast_kernels.fused_constrain_and_cast_uint(arr, pa.uint8(), reference_cast, range_invalid="error") is None
+    assert cast_kernels.fused_constrain_and_cast_uint(pa.array([True]), pa.uint8(), reference_cast) is None
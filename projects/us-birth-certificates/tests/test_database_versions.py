@@ -0,0 +1,100 @@
+import os
+import pathlib
+
+import duckdb
+import pytest
+
+import build_utils
+import data_utils
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_utils, "DATABASE_DIR", tmp_path / "us_births_db")
+    monkeypatch.setattr(build_utils, "CURRENT_DATABASE", tmp_path / "us_births_db" / "current.json")
+    monkeypatch.setattr(build_utils, "DATABASE_LINK", tmp_path / "us_births.db")
+    monkeypatch.setattr(build_utils, "ANALYSIS_DATABASE", tmp_path / "us_births_analysis.db")
+    return tmp_path
+
+
+def new_version(ids: list[int]) -> pathlib.Path:
+    path = build_utils.new_database_version()
+    with duckdb.connect(path.as_posix()) as con:
+        con.execute("CREATE TABLE us_births AS SELECT unnest(?::BIGINT[]) AS id", [ids])
+    return path
+
+
+def test_publish_database_hard_link_fallback(data_dir, monkeypatch):
+    def no_symlinks(self, target):
+        raise OSError("symlinks not allowed")
+
+    monkeypatch.setattr(pathlib.Path, "symlink_to", no_symlinks)
+    path = new_version([1, 2])
+    build_utils.publish_database(path)
+
+    assert build_utils.current_database() == path
+    assert os.path.samefile(build_utils.DATABASE_LINK, path)
+    assert not build_utils.DATABASE_LINK.is_symlink()
+
+
+def test_publish_database_raises_if_link_not_replaced(data_dir, monkeypatch):
+    first = new_version([1])
+    build_utils.publish_database(first)
+    second = new_version([1, 2])
+
+    def locked(src, dst):
+        raise PermissionError("in use")
+
+    monkeypatch.setattr(os, "replace", locked)
+    with pytest.raises(RuntimeError, match="Could not replace"):
+        build_utils.publish_database(second)
+
+    assert build_utils.current_database() == first
+    assert os.path.samefile(build_utils.DATABASE_LINK, first)
+    assert not build_utils.DATABASE_LINK.with_name("us_births.db.tmp").exists()
+
+
+def test_connect_keeps_notebook_tables_out_of_versions(data_dir):
+    first = new_version([1, 2, 3])
+    build_utils.publish_database(first)
+
+    with data_utils.connect(read_only=False) as con:
+        con.execute("CREATE TABLE ds_lb_pred_01 AS SELECT 2::BIGINT AS id, 0.5 AS p_ds_lb_pred")
+        con.execute(
+            "CREATE VIEW us_births_pred_01 AS SELECT b.*, p.p_ds_lb_pred AS p_ds_lb_pred_01 "
+            "FROM us_births b LEFT JOIN ds_lb_pred_01 p ON b.id = p.id"
+        )
+        with pytest.raises(duckdb.Error):
+            con.execute(f"CREATE TABLE {data_utils.DATABASE_ALIAS}.t (x INTEGER)")
+
+    with duckdb.connect(first.as_posix(), read_only=True) as con:
+        assert con.execute("SELECT table_name FROM duckdb_tables()").fetchall() == [("us_births",)]
+
+    # the predictions join onto the version current when connecting
+    build_utils.publish_database(new_version([1, 2, 3, 4]))
+    with data_utils.connect() as con:
+        rows = con.execute("SELECT id, p_ds_lb_pred_01 FROM us_births_pred_01 ORDER BY id").fetchall()
+
+    assert rows == [(1, None), (2, 0.5), (3, None), (4, None)]
+
+
+def test_publish_database_keeps_unversioned_database(data_dir):
+    # a database built before versions were published, with a table a notebook created in it
+    with duckdb.connect(build_utils.DATABASE_LINK.as_posix()) as con:
+        con.execute("CREATE TABLE us_births AS SELECT 1::BIGINT AS id")
+        con.execute("CREATE TABLE ds_lb_pred_01 AS SELECT 1::BIGINT AS id, 0.5 AS p_ds_lb_pred")
+    os.utime(build_utils.DATABASE_LINK, (0, 0))
+
+    path = new_version([1, 2])
+    build_utils.publish_database(path)
+    build_utils.prune_database_versions()
+
+    versions = sorted(build_utils.DATABASE_DIR.glob("us_births-*.db"))
+    assert versions[-1] == path
+    assert len(versions) == 2
+    with duckdb.connect(versions[0].as_posix(), read_only=True) as con:
+        assert con.execute("SELECT p_ds_lb_pred FROM ds_lb_pred_01").fetchall() == [(0.5,)]
+
+    # publishing again replaces the link without keeping it twice
+    build_utils.publish_database(new_version([1, 2, 3]))
+    assert len(list(build_utils.DATABASE_DIR.glob("us_births-*.db"))) == 3
@@ -0,0 +1,178 @@
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+import download_data
+
+FILENAME = "natality2024us.sas7bdat"
+
+
+class FileServer:
+    """
+    A local stand-in for the download servers: serves one file with an ETag, and honours Range and
+    If-Range (as a 206, a 416 when the range starts at the end, or a 200 when If-Range does not match).
+    """
+
+    def __init__(self, content: bytes, etag: str = '"v1"'):
+        self.content = content
+        self.etag = etag
+        self.requests: list[dict] = []
+
+    def handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                content = server.content
+                start = 0
+                byte_range = self.headers.get("Range")
+                if_range = self.headers.get("If-Range")
+
+                if byte_range and (if_range is None or if_range == server.etag):
+                    start = int(byte_range.removeprefix("bytes=").rstrip("-"))
+                    if start >= len(content):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(content)}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+                else:
+                    self.send_response(200)
+
+                self.send_header("ETag", server.etag)
+                self.send_header("Last-Modified", "Tue, 01 Jul 2025 00:00:00 GMT")
+                self.send_header("Content-Length", str(len(content) - start))
+                self.end_headers()
+                self.wfile.write(content[start:])
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def _serve(content: bytes, etag: str = '"v1"') -> tuple[FileServer, str]:
+        file_server = FileServer(content, etag)
+        httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), file_server.handler())
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return file_server, f"http://127.0.0.1:{httpd.server_address[1]}/{FILENAME}"
+
+    yield _serve
+
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def write_partial(tmp_path, content: bytes, validator: str | None):
+    part = tmp_path / (FILENAME + ".part")
+    part.write_bytes(content)
+    if validator is not None:
+        download_data.save_manifest({"validator": validator, "etag": validator}, tmp_path / (FILENAME + ".part.json"))
+
+
+def assert_downloaded(tmp_path, entry: dict, content: bytes):
+    assert (tmp_path / FILENAME).read_bytes() == content
+    assert entry["size"] == len(content)
+    assert entry["sha256"] == hashlib.sha256(content).hexdigest()
+    assert not (tmp_path / (FILENAME + ".part")).exists()
+    assert not (tmp_path / (FILENAME + ".part.json")).exists()
+
+
+def test_download(tmp_path, serve):
+    content = bytes(range(256)) * 1000
+    server, url = serve(content)
+
+    entry = download_data.download_file(url, tmp_path)
+
+    assert_downloaded(tmp_path, entry, content)
+    assert entry["validator"] == '"v1"'
+    assert "Range" not in server.requests[0]
+
+    # verified by its manifest entry: not requested again
+    assert download_data.download_file(url, tmp_path, entry) == entry
+    assert len(server.requests) == 1
+
+
+def test_resume(tmp_path, serve):
+    content = bytes(range(256)) * 1000
+    server, url = serve(content)
+    write_partial(tmp_path, content[:100_000], '"v1"')
+
+    entry = download_data.download_file(url, tmp_path)
+
+    assert_downloaded(tmp_path, entry, content)
+    assert server.requests[0]["Range"] == "bytes=100000-"
+    assert server.requests[0]["If-Range"] == '"v1"'
+
+
+def test_resume_changed_etag(tmp_path, serve):
+    old_content = bytes(range(256)) * 1000
+    content = bytes(reversed(range(256))) * 1100
+    server, url = serve(content, etag='"v2"')
+    write_partial(tmp_path, old_content[:100_000], '"v1"')
+
+    entry = download_data.download_file(url, tmp_path)
+
+    # If-Range does not match: the server sends the whole file, which replaces the partial one
+    assert_downloaded(tmp_path, entry, content)
+    assert entry["validator"] == '"v2"'
+    assert server.requests[0]["If-Range"] == '"v1"'
+
+
+def test_partial_without_validator(tmp_path, serve):
+    content = bytes(range(256)) * 1000
+    server, url = serve(content)
+    write_partial(tmp_path, b"x" * 100_000, None)
+
+    entry = download_data.download_file(url, tmp_path)
+
+    assert_downloaded(tmp_path, entry, content)
+    assert "Range" not in server.requests[0]
+
+
+def test_range_not_satisfiable_complete(tmp_path, serve):
+    content = bytes(range(256)) * 1000
+    server, url = serve(content)
+    write_partial(tmp_path, content, '"v1"')
+
+    entry = download_data.download_file(url, tmp_path)
+
+    assert_downloaded(tmp_path, entry, content)
+    assert len(server.requests) == 1
+
+
+def test_range_not_satisfiable_wrong_size(tmp_path, serve):
+    content = bytes(range(256)) * 1000
+    server, url = serve(content)
+    write_partial(tmp_path, content + b"extra", '"v1"')
+
+    entry = download_data.download_file(url, tmp_path)
+
+    # the partial file is longer than the remote file: truncated and downloaded again
+    assert_downloaded(tmp_path, entry, content)
+    assert "Range" in server.requests[0]
+    assert "Range" not in server.requests[1]
+
+
+def test_unverified_file_in_place(tmp_path, serve):
+    content = bytes(range(256)) * 1000
+    server, url = serve(content)
+    entry = download_data.download_file(url, tmp_path)
+
+    # corrupted in place: its size and mtime no longer match the manifest entry
+    (tmp_path / FILENAME).write_bytes(b"x" * len(content))
+    entry = download_data.download_file(url, tmp_path, {**entry, "mtime_ns": 0})
+
+    assert_downloaded(tmp_path, entry, content)
+    assert "Range" not in server.requests[1]
@@ -0,0 +1,58 @@
+import pyarrow.parquet as pq
+
+import build_utils
+import combine_parquet
+import import_fixed_width
+from variables import Variables
+
+YEAR = 2018
+
+
+def write_records(path, values: list[dict[str, str]]):
+    # fixed-width records with the given fields (by layout name) and blanks elsewhere
+    layout = import_fixed_width.read_layout(YEAR)
+    length = max(end for _, end, _ in layout.values())
+    lines = []
+
+    for record in values:
+        line = bytearray(b" " * length)
+        for col, text in record.items():
+            start, end, _ = layout[col]
+            line[start - 1 : end] = text.rjust(end - start + 1).encode("ascii")
+        lines.append(bytes(line) + b"\n")
+
+    path.write_bytes(b"".join(lines))
+
+
+def test_import_year(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    source = tmp_path / "data" / f"Nat{YEAR}PublicUS.txt"
+    write_records(
+        source,
+        [
+            {"dob_yy": "2018", "mager": "35", "sex": "F", "ca_down": "C", "dbwt": "3200"},
+            {"dob_yy": "2018", "mager": "99", "sex": "M", "ca_down": "N", "dbwt": "9999"},
+            {"dob_yy": "2018", "mager": "2x", "sex": "M", "ca_down": "U", "dbwt": "2800"},
+        ],
+    )
+
+    import_fixed_width.import_year(str(source), YEAR)
+
+    entry = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)[str(YEAR)]
+    assert entry["source"]["path"] == source.as_posix()
+    assert entry["source"]["sha256"] == build_utils.sha256_file(source)
+    assert entry["output"]["path"] == f"data/us_births_{YEAR}.parquet"
+    assert entry["invalid"]["mager"]["range_invalid"] == 1
+
+    # the year reaches the dataset through the manifest
+    assert combine_parquet.year_inputs() == {YEAR: build_utils.DATA_DIR / f"us_births_{YEAR}.parquet"}
+    table = pq.read_table(entry["output"]["path"], columns=[Variables.ID, "mager", "dbwt"])
+    assert table.column(Variables.ID).to_pylist() == [YEAR * 10**8 + 1, YEAR * 10**8 + 2, YEAR * 10**8 + 3]
+    assert table.column("mager").to_pylist() == [35, None, None]
+    assert table.column("dbwt").to_pylist() == [3200, 9999, 2800]
+
+    # unchanged: not imported again
+    mtime_ns = entry["output"]["mtime_ns"]
+    import_fixed_width.import_year(str(source), YEAR)
+    assert build_utils.load_manifest(build_utils.IMPORT_MANIFEST)[str(YEAR)]["output"]["mtime_ns"] == mtime_ns
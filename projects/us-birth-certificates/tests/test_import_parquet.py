@@ -0,0 +1,110 @@
+import hashlib
+import importlib.util
+import types
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import import_parquet
+import variables
+
+# stands in for pyreadstat in this process and, through sys.path, in the spawned decoding processes:
+# a "SAS file" is a pickled DataFrame
+FAKE_PYREADSTAT = '''
+import types
+import pandas as pd
+
+
+def read_sas7bdat(path, metadataonly=False, row_offset=0, row_limit=0, usecols=None, encoding=None):
+    df = pd.read_pickle(path)
+    types_ = {col: "double" if pd.api.types.is_numeric_dtype(df[col]) else "string" for col in df.columns}
+    meta = types.SimpleNamespace(number_rows=len(df), readstat_variable_types=types_)
+    if metadataonly:
+        return df.iloc[:0], meta
+    end = row_offset + row_limit if row_limit else len(df)
+    return df.iloc[row_offset:end][usecols or list(df.columns)].reset_index(drop=True), meta
+'''
+
+
+def sas_meta(number_rows: int, strings: int = 2):
+    # a SAS header with every imported variable, the first strings of them character columns
+    cols = list(variables.IMPORTED_VARS)
+    return types.SimpleNamespace(
+        number_rows=number_rows,
+        readstat_variable_types={col: "string" if i < strings else "double" for i, col in enumerate(cols)},
+    )
+
+
+def test_estimate_import_memory_grows_with_rows():
+    chunk_size = import_parquet.CHUNK_SIZE
+    small = import_parquet.estimate_import_memory(sas_meta(2 * chunk_size), chunk_size)
+    large = import_parquet.estimate_import_memory(sas_meta(8 * chunk_size), chunk_size)
+
+    assert large - small == 6 * chunk_size * import_parquet._row_bytes(
+        sas_meta(0), import_parquet.NUMERIC_RETAINED_BYTES, import_parquet.STRING_RETAINED_BYTES
+    )
+
+
+def test_estimate_import_memory_string_columns_cost_more():
+    strings = import_parquet.estimate_import_memory(sas_meta(4_000_000, strings=10))
+    numeric = import_parquet.estimate_import_memory(sas_meta(4_000_000, strings=0))
+
+    assert strings > numeric
+
+
+def test_import_chunk_size_leaves_room_for_retained_bytes():
+    budget = 2 * 1024 ** 3
+    small = import_parquet.import_chunk_size(sas_meta(1_000_000), budget)
+    large = import_parquet.import_chunk_size(sas_meta(4_000_000), budget)
+
+    assert large < small
+    assert import_parquet.estimate_import_memory(sas_meta(4_000_000), large) <= budget
+
+
+def test_decode_processes():
+    meta = sas_meta(10 * import_parquet.CHUNK_SIZE)
+    one = import_parquet.estimate_import_memory(meta)
+
+    assert import_parquet.decode_processes(meta, import_parquet.CHUNK_SIZE, 64, 10 ** 15) == 10
+    assert import_parquet.decode_processes(meta, import_parquet.CHUNK_SIZE, 4, 10 ** 15) == 4
+    assert import_parquet.decode_processes(meta, import_parquet.CHUNK_SIZE, 4, one) == 1
+    # each decoding process holds a chunk, on top of the importing process
+    three = import_parquet.estimate_import_memory(meta, import_parquet.CHUNK_SIZE, 3)
+    assert three > 3 * (one - import_parquet._retained_bytes(meta))
+
+
+def test_parallel_import_matches_serial(tmp_path, monkeypatch):
+    fake = tmp_path / "fake" / "pyreadstat.py"
+    fake.parent.mkdir()
+    fake.write_text(FAKE_PYREADSTAT)
+    monkeypatch.syspath_prepend(str(fake.parent))
+    spec = importlib.util.spec_from_file_location("pyreadstat", fake)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(import_parquet, "pyreadstat", module)
+
+    # 23 rows in chunks of 5: the last chunk is partial and the parts have different chunk counts
+    rows = 23
+    source = tmp_path / "natl2018.sas7bdat"
+    pd.DataFrame(
+        {
+            variables.Variables.DOB_YY: [2018.0] * rows,
+            variables.Variables.DOB_MM: [float(i % 12 + 1) if i % 7 else 99.0 for i in range(rows)],
+            variables.Variables.MAGER: [float(15 + i) for i in range(rows)],
+            variables.Variables.RF_CESARN: ["Y" if i % 3 else " " for i in range(rows)],
+        }
+    ).to_pickle(source)
+
+    # serial first, so the parallel import starts its processes from a process already running threads
+    serial = tmp_path / "serial.parquet"
+    parallel = tmp_path / "parallel.parquet"
+    serial_stats = import_parquet.import_from_sas(str(source), 2018, chunk_size=5, workers=1, out_path=serial)
+    parallel_stats = import_parquet.import_from_sas(str(source), 2018, chunk_size=5, workers=3, out_path=parallel)
+
+    assert hashlib.sha256(parallel.read_bytes()).hexdigest() == hashlib.sha256(serial.read_bytes()).hexdigest()
+    assert parallel_stats == serial_stats
+    assert serial_stats[variables.Variables.DOB_MM]
+    assert pq.ParquetFile(parallel).num_row_groups == 5
+    ids = pq.read_table(parallel).column(variables.Variables.ID).to_pylist()
+    assert ids == variables.record_ids(2018, 0, rows).tolist()
+    assert not list(tmp_path.glob("*.part*"))
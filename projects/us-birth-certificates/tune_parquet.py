@@ -0,0 +1,210 @@
+"""Tunes the Parquet encoding and compression of each column of the prepared dataset.
+
+A sample of row groups is read from each year of the prepared dataset (in file order, so that
+clustered columns keep their runs). Each column is written on its own with each candidate
+encoding (dictionary, i.e. RLE/bit-packed dictionary indices; plain; delta and byte stream split
+where the type allows) and zstd level, and the file sizes are compared. The candidates smaller than
+the current setting (dictionary, default level) are then timed in full scans with pyarrow and
+DuckDB, and the smallest candidate that scans no more than SLOWDOWN_TOLERANCE slower than the
+current setting is chosen.
+
+The choices are written to build_utils.PARQUET_WRITER_CONFIG, which
+prepare_parquet.writer_options applies when the prepared dataset is next built (the pipeline's
+prepare stage reruns when the config changes).
+
+Usage: python tune_parquet.py [sample_rows]
+"""
+
+import datetime
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import build_utils
+import prepare_parquet
+
+SAMPLE_ROWS = 1_000_000
+"""Rows sampled (across all years) by default."""
+
+COMPRESSION_LEVELS = [1, 3, 6, 9]
+"""zstd levels tried (higher levels compress little better and slow writing down a lot)."""
+
+SLOWDOWN_TOLERANCE = 0.1
+"""Slowest full scan (relative to the current setting) accepted for a smaller file."""
+
+REPEATS = 3
+"""Scans timed per candidate (the fastest is kept)."""
+
+
+CURRENT = {"use_dictionary": True, "encoding": None, "compression_level": None}
+"""
+The setting used before tuning (and for columns not in the config). A column's setting is
+use_dictionary, encoding (when not a dictionary) and compression_level (None for the default).
+"""
+
+
+def setting(use_dictionary: bool, encoding: str | None, compression_level: int | None) -> dict:
+    return {"use_dictionary": use_dictionary, "encoding": encoding, "compression_level": compression_level}
+
+
+def label(candidate: dict) -> str:
+    encoding = "dictionary" if candidate["use_dictionary"] else candidate["encoding"].lower()
+    level = "default" if candidate["compression_level"] is None else candidate["compression_level"]
+    return f"{encoding}/zstd:{level}"
+
+
+def candidates(dtype: pa.DataType) -> list[dict]:
+    """
+    Returns the settings tried for a column type.
+    """
+    encodings = ["PLAIN"]
+    if pa.types.is_integer(dtype):
+        encodings += ["BYTE_STREAM_SPLIT"]
+        if dtype.bit_width >= 32:
+            encodings += ["DELTA_BINARY_PACKED"]  # only for 32 and 64 bit integers
+    elif pa.types.is_floating(dtype):
+        encodings += ["BYTE_STREAM_SPLIT"]
+    elif pa.types.is_string(dtype):
+        encodings += ["DELTA_LENGTH_BYTE_ARRAY", "DELTA_BYTE_ARRAY"]
+
+    return [CURRENT] + [
+        setting(encoding is None, encoding, level)
+        for encoding in [None, *encodings]
+        for level in COMPRESSION_LEVELS
+    ]
+
+
+def sample(in_dir: pathlib.Path = build_utils.PREPARED_DIR, rows: int = SAMPLE_ROWS) -> pa.Table:
+    """
+    Reads about rows rows from the prepared dataset: row groups spread evenly through each year's
+    file, the same number of rows from each year.
+    """
+    years = build_utils.partition_years(in_dir)
+    if not years:
+        raise FileNotFoundError(f"No prepared partitions in {in_dir}")
+
+    quota = rows // len(years)
+    tables = []
+
+    for year in years:
+        file = pq.ParquetFile(build_utils.partition_path(in_dir, year))
+        if file.num_row_groups == 0:
+            continue
+        count = min(file.num_row_groups, -(-quota // file.metadata.row_group(0).num_rows))
+        picked = np.unique(np.linspace(0, file.num_row_groups - 1, count).round().astype(int))
+        tables.append(file.read_row_groups([int(i) for i in picked]).slice(0, quota))
+
+    return pa.concat_tables(tables, promote_options="permissive")
+
+
+def write_column(table: pa.Table, path: pathlib.Path, candidate: dict) -> int:
+    # writes a single-column table with a setting, returning the file size
+    col = table.column_names[0]
+    pq.write_table(
+        table,
+        path,
+        compression="zstd",
+        compression_level=candidate["compression_level"],
+        use_dictionary=candidate["use_dictionary"],
+        column_encoding=None if candidate["use_dictionary"] else {col: candidate["encoding"]},
+        row_group_size=prepare_parquet.CLUSTER_ROW_GROUP_ROWS,
+    )
+    return path.stat().st_size
+
+
+def scan_seconds(path: pathlib.Path, col: str, con: duckdb.DuckDBPyConnection) -> float:
+    # fastest of REPEATS full scans with pyarrow and with DuckDB (both decode every value)
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        pq.read_table(path)
+        con.execute(f'SELECT sum(hash("{col}")) FROM read_parquet(?)', [path.as_posix()]).fetchall()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def tune_column(table: pa.Table, tmp_dir: pathlib.Path, con: duckdb.DuckDBPyConnection) -> dict:
+    """
+    Returns the chosen setting of a single-column table, with the sizes and scan times measured.
+    """
+    col = table.column_names[0]
+    settings = candidates(table.schema.field(0).type)
+    # a file per candidate, as DuckDB may cache a file's metadata by its path
+    paths = [tmp_dir / f"{col}.{i}.parquet" for i in range(len(settings))]
+    # by size, then in candidate order (so the current setting wins ties)
+    sizes = sorted(
+        ((write_column(table, paths[i], candidate), i, candidate) for i, candidate in enumerate(settings)),
+        key=lambda item: item[:2],
+    )
+
+    current_bytes = next(size for size, i, _ in sizes if i == 0)
+    current_seconds = scan_seconds(paths[0], col, con)  # CURRENT is the first candidate
+
+    chosen, chosen_bytes, chosen_seconds = CURRENT, current_bytes, current_seconds
+    for size, i, candidate in sizes:
+        if size >= current_bytes:
+            break
+        seconds = scan_seconds(paths[i], col, con)
+        if seconds <= current_seconds * (1 + SLOWDOWN_TOLERANCE):
+            chosen, chosen_bytes, chosen_seconds = candidate, size, seconds
+            break
+
+    for path in paths:
+        path.unlink()
+
+    return {
+        **chosen,
+        "bytes": chosen_bytes,
+        "scan_seconds": round(chosen_seconds, 6),
+        "current_bytes": current_bytes,
+        "current_scan_seconds": round(current_seconds, 6),
+    }
+
+
+def tune(rows: int = SAMPLE_ROWS, out_path: pathlib.Path = build_utils.PARQUET_WRITER_CONFIG) -> dict:
+    """
+    Tunes each column of a sample of the prepared dataset, writes the config to out_path and
+    returns it.
+    """
+    table = sample(rows=rows)
+    columns = {}
+
+    print(f"Tuning {table.num_columns} columns on {table.num_rows:,} sampled rows...")
+    print(f"{'column':<24}{'setting':<32}{'bytes':>12}{'current':>12}{'scan (s)':>10}{'current':>10}")
+
+    with tempfile.TemporaryDirectory() as tmp, duckdb.connect() as con:
+        for col in table.column_names:
+            result = tune_column(table.select([col]), pathlib.Path(tmp), con)
+            columns[col] = result
+            print(
+                f"{col:<24}{label(result):<32}{result['bytes']:>12,}{result['current_bytes']:>12,}"
+                f"{result['scan_seconds']:>10.4f}{result['current_scan_seconds']:>10.4f}"
+            )
+
+    total = sum(c["bytes"] for c in columns.values())
+    current = sum(c["current_bytes"] for c in columns.values())
+    print(f"Total: {total:,} bytes (current {current:,}, {1 - total / current:.1%} smaller)")
+
+    config = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "sample_rows": table.num_rows,
+        "columns": columns,
+    }
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    tmp_path.write_text(json.dumps(config, indent=2), encoding="utf-8")
+    tmp_path.replace(out_path)
+
+    print(f"Wrote: {out_path}")
+
+    return config
+
+
+if __name__ == "__main__":
+    tune(int(sys.argv[1]) if len(sys.argv) > 1 else SAMPLE_ROWS)
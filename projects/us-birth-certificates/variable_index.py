@@ -0,0 +1,112 @@
+"""Builds an index of which variables are available in which years, from file metadata only.
+
+The index is built from the SAS file headers (which variables each year's source has) and the
+per-year Parquet footers (row counts, null counts and min/max per column), so no data is read.
+It is stored as the variable_availability table in the us_births database; see
+data_utils.load_variable_availability.
+"""
+
+import pathlib
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+import build_utils
+import import_parquet
+import variables
+
+TABLE = "variable_availability"
+
+SCHEMA = pa.schema(
+    [
+        pa.field("year", pa.uint16()),
+        pa.field("variable", pa.string()),
+        pa.field("in_source", pa.bool_()),
+        pa.field("source_type", pa.string()),
+        pa.field("row_count", pa.int64()),
+        pa.field("null_count", pa.int64()),
+        pa.field("non_null_count", pa.int64()),
+        pa.field("min_value", pa.string()),
+        pa.field("max_value", pa.string()),
+    ]
+)
+
+
+def build_variable_index() -> pa.Table:
+    """
+    Returns one row per imported year and variable, from the import manifest's sources and outputs.
+    """
+    manifest = build_utils.load_manifest(build_utils.IMPORT_MANIFEST)
+    rows = []
+
+    for year, entry in sorted(manifest.items()):
+        output = pathlib.Path(entry["output"]["path"])
+        source = pathlib.Path(entry["source"]["path"])
+
+        if not output.exists():
+            continue
+
+        source_types = import_parquet.read_metadata(str(source)).readstat_variable_types if source.exists() else {}
+        rows.extend(file_index(int(year), output, source_types))
+
+    return pa.Table.from_pylist(rows, schema=SCHEMA)
+
+
+def file_index(year: int, path: pathlib.Path, source_types: dict[str, str]) -> list[dict]:
+    """
+    Returns the index rows of one per-year Parquet file, from its footer statistics.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    columns = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+    rows = []
+
+    for variable in variables.IMPORTED_VARS:
+        row_count = metadata.num_rows
+        null_count = row_count
+        min_value = max_value = None
+
+        if variable in columns:
+            null_count = 0
+            for rg in range(metadata.num_row_groups):
+                stats = metadata.row_group(rg).column(columns[variable]).statistics
+                if stats is None or not stats.has_null_count:
+                    null_count = None
+                    break
+                null_count += stats.null_count
+                if stats.has_min_max:
+                    min_value = stats.min if min_value is None else min(min_value, stats.min)
+                    max_value = stats.max if max_value is None else max(max_value, stats.max)
+
+        rows.append(
+            {
+                "year": year,
+                "variable": variable,
+                "in_source": variable in source_types,
+                "source_type": source_types.get(variable),
+                "row_count": row_count,
+                "null_count": null_count,
+                "non_null_count": None if null_count is None else row_count - null_count,
+                "min_value": None if min_value is None else str(min_value),
+                "max_value": None if max_value is None else str(max_value),
+            }
+        )
+
+    return rows
+
+
+def create_variable_index(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    (Re)creates the variable_availability table in a database.
+    """
+    print(f"Creating table {TABLE}...")
+
+    index = build_variable_index()
+
+    con.execute(f"CREATE OR REPLACE TABLE {TABLE} AS SELECT * FROM index ORDER BY year, variable")
+
+
+if __name__ == "__main__":
+    # through duckdb_prepare, whose variable_availability step reruns if the index changed, and
+    # which publishes a new database version (published versions are never modified)
+    import duckdb_prepare
+
+    duckdb_prepare.combine_all()
@@ -1,8 +1,12 @@
 """Column utilities."""
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from enum import StrEnum
+from typing import NamedTuple
 
 
 class Variables(StrEnum):
@@ -244,6 +248,9 @@ class Variables(StrEnum):
 
     # added/computed columns
 
+    ID = "id"
+    """Record id, assigned on import (see record_ids): stable across rebuilds."""
+
     YEAR = "year"
 
     MAGE_C = "mage_c"
@@ -307,16 +314,14 @@ class Variables(StrEnum):
 
 
 COMPUTED: dict[
-    str, pd.UInt16Dtype | pd.Float64Dtype | pd.CategoricalDtype | pd.CategoricalDtype
+    str, pd.UInt8Dtype | pd.UInt16Dtype | pd.Float64Dtype | pd.CategoricalDtype | pd.CategoricalDtype
 ] = {
     str(Variables.YEAR): pd.UInt16Dtype(),
     str(Variables.MAGE_C): pd.UInt16Dtype(),
     str(Variables.DS): pd.CategoricalDtype(),
     str(Variables.P_DS_LB_NT): pd.Float64Dtype(),
     str(Variables.P_DS_LB_WT): pd.Float64Dtype(),
-    str(Variables.CA_DOWN_C): pd.CategoricalDtype(
-        categories=["C", "P", "N", "U"], ordered=False
-    ),
+    str(Variables.CA_DOWN_C): pd.UInt8Dtype(),
     str(Variables.DOWN_IND): pd.CategoricalDtype(),
     str(Variables.DS_C): pd.CategoricalDtype(),
     str(Variables.DS_P): pd.CategoricalDtype(),
@@ -447,12 +452,8 @@ IMPORTED: dict[
     str(Variables.CA_CLPAL): pd.CategoricalDtype(),
     str(Variables.DOWNS): pd.CategoricalDtype(),
     str(Variables.UCA_DOWNS): pd.CategoricalDtype(),
-    str(Variables.CA_DOWN): pd.CategoricalDtype(
-        categories=["C", "P", "N", "U"], ordered=False
-    ),
-    str(Variables.CA_DOWNS): pd.CategoricalDtype(
-        categories=["C", "P", "N", "U"], ordered=False
-    ),
+    str(Variables.CA_DOWN): pd.CategoricalDtype(),
+    str(Variables.CA_DOWNS): pd.CategoricalDtype(),
     str(Variables.CA_DISOR): pd.CategoricalDtype(),
     str(Variables.CA_HYPO): pd.CategoricalDtype(),
     str(Variables.NO_CONGEN): pd.CategoricalDtype(),
@@ -489,6 +490,509 @@ IMPORTED: dict[
 COMPUTED_VARS = list(COMPUTED.keys())
 IMPORTED_VARS = list(IMPORTED.keys())
 
+# Storage types of the imported columns (applied on import and by prepare_parquet): unsigned
+# integers constrained to an inclusive (min, max) range (None: no bound), with values that are not
+# integers or are out of range set to null; strings; and float16. Other columns keep their types.
+
+UINT16_SPECS: dict[str, tuple[int | None, int | None]] = {
+    Variables.DATAYEAR: (1989, None),
+    Variables.BIRYR: (1989, None),
+    Variables.DOB_YY: (1989, None),
+    Variables.DOB_TT: (0, 9999),
+
+    Variables.DBWT: (0, 9999),
+
+    Variables.DWGT_R: (100, 999),
+    Variables.PWGT_R: (75, 999),
+}
+
+UINT8_SPECS: dict[str, tuple[int | None, int | None]] = {
+    Variables.DOB_MM: (1, 12),
+    Variables.DOB_WK: (1, 7),
+
+    Variables.BFACIL3: (1, 3),
+
+    Variables.MAGER: (12, 50),
+    Variables.DMAGE: (None, None),
+    Variables.DMAGERPT: (None, None),
+    Variables.MAGER14: (1, 14),
+    Variables.MAGER9: (1, 14),
+    Variables.MAGE36: (1, 41),
+    Variables.MAGER12: (1, 14),
+
+    Variables.MBSTATE_REC: (1, 3),
+    Variables.RESTATUS: (1, 4),
+
+    Variables.MBRACE: (1, 24),
+    Variables.MRACE: (None, None),
+    Variables.MRACEREC: (None, None),
+    Variables.MRACE31: (1, 31),
+    Variables.MRACE6: (1, 6),
+    Variables.MRACE15: (1, 15),
+    Variables.MRACEIMP: (1, 2),
+
+    Variables.ORMOTH: (None, None),
+    Variables.ORRACEM: (None, None),
+
+    Variables.UMHISP: (None, None),
+    Variables.MHISPX: (0, 9),
+    Variables.MHISP_R: (0, 9),
+    Variables.MRACEHISP: (1, 8),
+
+    Variables.MAR: (None, None),
+
+    Variables.DMEDUC: (None, None),
+    Variables.MEDUC: (1, 9),
+    Variables.UMEDUC: (None, None),
+    Variables.MEDUC6: (None, None),
+    Variables.MEDUC_REC: (None, None),
+    Variables.MPLBIR: (None, None),
+
+    Variables.DFAGE: (None, None),
+    Variables.DFAGERPT: (None, None),
+    Variables.FAGE11: (None, None),
+    Variables.FAGERPT: (None, None),
+    Variables.UFAGECOMB: (None, None),
+    Variables.FAGECOMB: (0, 99),
+    Variables.FAGEREC11: (0, 11),
+
+    Variables.ORFATH: (None, None),
+    Variables.ORRACEF: (None, None),
+
+    Variables.FBRACE: (None, None),
+    Variables.FRACE: (None, None),
+    Variables.FRACEIMP: (None, None),
+    Variables.FRACEREC: (None, None),
+
+    Variables.UFHISP: (None, None),
+    Variables.FRACEHISP: (1, 9),
+    Variables.FRACE31: (1, 99),
+    Variables.FRACE6: (1, 9),
+    Variables.FRACE15: (1, 99),
+
+    Variables.FHISPX: (0, 9),
+    Variables.FHISP_R: (0, 9),
+
+    Variables.FEDUC: (1, 9),
+
+    Variables.PRIORLIVE: (0, 99),
+    Variables.PRIORDEAD: (0, 99),
+    Variables.PRIORTERM: (0, 99),
+
+    Variables.LBO_REC: (1, 9),
+    Variables.TBO_REC: (1, 9),
+
+    Variables.ILLB_R11: (0, 99),
+    Variables.ILOP_R11: (0, 99),
+    Variables.ILP_R11: (0, 99),
+
+    Variables.PRECARE: (0, 10),
+
+    Variables.PAY: (1, 9),
+    Variables.PAY_REC: (1, 9),
+
+    Variables.APGAR5: (0, 99),
+    Variables.APGAR5R: (1, 5),
+    Variables.APGAR10: (0, 99),
+    Variables.APGAR10R: (1, 5),
+
+    Variables.DPLURAL: (1, 4),
+    Variables.IMP_PLURAL: (1, 1),
+    Variables.SETORDER_R: (1, 9),
+
+    Variables.GESTREC10: (1, 99),
+
+    Variables.NO_ABNORM: (0, 9),
+
+    Variables.DOWNS: (0, 255),
+    Variables.UCA_DOWNS: (1, 9),
+    Variables.NO_CONGEN: (0, 1),
+
+    Variables.PREVIS: (0, 99),
+    Variables.PREVIS_REC: (1, 12),
+
+    Variables.M_HT_IN: (30, 99),
+
+    Variables.BMI_R: (1, 9),
+    Variables.WTGAIN: (0, 99),
+
+    Variables.ME_PRES: (1, 9),
+    Variables.RDMETH_REC: (1, 9),
+    Variables.DMETH_REC: (1, 9),
+    Variables.NO_RISKS: (1, 9),
+    Variables.ATTEND: (1, 9),
+}
+
+YES_NO_CODES: dict[str, int] = {"N": 0, "Y": 1, "X": 8, "U": 9}
+"""Codes of Y/N flags: N (no), Y (yes), X (not applicable) and U (unknown or not stated)."""
+
+ANOMALY_CODES: dict[str, int] = {"N": 0, "C": 1, "P": 2, "U": 9}
+"""Codes of Down syndrome and chromosomal disorder: N (no), C (confirmed), P (pending), U (unknown)."""
+
+SEX_CODES: dict[str, int] = {"F": 0, "M": 1}
+"""Codes of sex of infant: F (female) and M (male)."""
+
+DMAR_CODES: dict[str, int] = {"1": 1, "2": 2, "9": 9}
+"""Codes of marital status: 1 (married), 2 (unmarried) and 9 (unknown); blank is null."""
+
+# Single-character columns stored as uint8 codes (applied on import and by prepare_parquet):
+# values are trimmed and upper-cased and looked up in the column's code table; blank values and
+# values not in the table are null. The duckdb view us_births_labelled shows the letters.
+
+CODED_VARS: dict[str, dict[str, int]] = {
+    Variables.MAR_P: YES_NO_CODES,
+    Variables.DMAR: DMAR_CODES,
+    Variables.SEX: SEX_CODES,
+    Variables.AB_AVEN1: YES_NO_CODES,
+    Variables.AB_AVEN6: YES_NO_CODES,
+    Variables.AB_NICU: YES_NO_CODES,
+    Variables.AB_SURF: YES_NO_CODES,
+    Variables.AB_ANTI: YES_NO_CODES,
+    Variables.AB_SEIZ: YES_NO_CODES,
+    Variables.CA_ANEN: YES_NO_CODES,
+    Variables.CA_MNSB: YES_NO_CODES,
+    Variables.CA_CCHD: YES_NO_CODES,
+    Variables.CA_CDH: YES_NO_CODES,
+    Variables.CA_OMPH: YES_NO_CODES,
+    Variables.CA_GAST: YES_NO_CODES,
+    Variables.CA_LIMB: YES_NO_CODES,
+    Variables.CA_CLEFT: YES_NO_CODES,
+    Variables.CA_CLPAL: YES_NO_CODES,
+    Variables.CA_DOWN: ANOMALY_CODES,
+    Variables.CA_DOWNS: ANOMALY_CODES,
+    Variables.CA_DOWN_C: ANOMALY_CODES,  # computed (duckdb_prepare)
+    Variables.CA_DISOR: ANOMALY_CODES,
+    Variables.CA_HYPO: YES_NO_CODES,
+    Variables.BFED: YES_NO_CODES,
+    Variables.WIC: YES_NO_CODES,
+    Variables.RF_PDIAB: YES_NO_CODES,
+    Variables.RF_GDIAB: YES_NO_CODES,
+    Variables.RF_PHYPE: YES_NO_CODES,
+    Variables.RF_GHYPE: YES_NO_CODES,
+    Variables.RF_EHYPE: YES_NO_CODES,
+    Variables.RF_PPTERM: YES_NO_CODES,
+    Variables.RF_INFTR: YES_NO_CODES,
+    Variables.RF_FEDRG: YES_NO_CODES,
+    Variables.RF_ARTEC: YES_NO_CODES,
+    Variables.RF_CESAR: YES_NO_CODES,
+    Variables.LD_INDL: YES_NO_CODES,
+    Variables.LD_AUGM: YES_NO_CODES,
+    Variables.LD_ANES: YES_NO_CODES,
+}
+
+STRING_VARS: list[str] = [
+    Variables.RF_CESARN,
+]
+
+FLOAT16_VARS: list[str] = [
+    Variables.BMI,
+]
+
+
+ID_YEAR_FACTOR = 10**8
+"""Record ids are year * ID_YEAR_FACTOR + the record's row number (from 1) in the year's source file."""
+
+
+def record_ids(year: int, start: int, rows: int) -> np.ndarray:
+    """Returns the ids of rows records of a year's source file, from row offset start (see ID_YEAR_FACTOR)."""
+
+    if start + rows >= ID_YEAR_FACTOR:
+        raise ValueError(f"Too many records in {year} for ids ({start + rows:,}; at most {ID_YEAR_FACTOR - 1:,})")
+
+    return np.arange(start + 1, start + rows + 1, dtype=np.int64) + year * ID_YEAR_FACTOR
+
+
+def storage_type(col: str) -> str | None:
+    """
+    Returns the storage type of an imported column ('uint8', 'uint16', 'string' or 'float16'), or
+    of the id column ('int64').
+    """
+
+    if col == Variables.ID:
+        return "int64"
+    if col in UINT8_SPECS or col in CODED_VARS:
+        return "uint8"
+    if col in UINT16_SPECS:
+        return "uint16"
+    if col in STRING_VARS:
+        return "string"
+    if col in FLOAT16_VARS:
+        return "float16"
+    return None
+
+
+STORAGE_TYPES: dict[str, str] = {col: storage_type(col) for col in [Variables.ID, *IMPORTED_VARS]}
+"""Storage types of the id and all imported columns, in column order: the schema of the per-year files."""
+
+DUCKDB_STORAGE_TYPES: dict[str, str] = {
+    "int64": "BIGINT",
+    "uint8": "UTINYINT",
+    "uint16": "USMALLINT",
+    "float16": "FLOAT",
+    "string": "VARCHAR",
+}
+"""DuckDB types of the storage types (DuckDB has no 16 bit float)."""
+
+DUCKDB_COMPUTED: dict[str, str] = {
+    Variables.YEAR: "USMALLINT",
+    Variables.MAGE_C: "UTINYINT",
+    Variables.MRACE_C: "UTINYINT",
+    Variables.MHISP_C: "UTINYINT",
+    Variables.MRACEHISP_C: "UTINYINT",
+    Variables.DOWN_IND: "UTINYINT",
+    Variables.CA_DOWN_C: "UTINYINT",
+    Variables.P_DS_LB_WT: "DOUBLE",
+    Variables.P_DS_LB_NT: "DOUBLE",
+    Variables.P_DS_LB_WT_MAGE: "DOUBLE",
+    Variables.P_DS_LB_NT_MAGE: "DOUBLE",
+    Variables.P_DS_LB_WT_ETHN: "DOUBLE",
+    Variables.P_DS_LB_NT_ETHN: "DOUBLE",
+    Variables.P_DS_LB_WT_MAGE_REDUC: "DOUBLE",
+    "ds_case_weight": "DOUBLE",
+}
+"""
+Columns of the us_births table computed from the imported ones, with their DuckDB types, in table
+order (see DERIVED_COLUMNS).
+"""
+
+DUCKDB_TYPES: dict[str, str] = {
+    **{col: DUCKDB_STORAGE_TYPES[dtype] for col, dtype in STORAGE_TYPES.items()},
+    **DUCKDB_COMPUTED,
+}
+"""DuckDB types of all columns of the us_births table, in table order."""
+
+
+class Join(NamedTuple):
+    """A reference table joined by year, as alias (rows of years not in the table get nulls)."""
+
+    table: str
+    alias: str
+
+
+class DerivedColumn(NamedTuple):
+    """
+    A column computed as the us_births table is built: a SQL expression of the columns in depends
+    (imported or derived, as b.col) and of the reference tables in joins (as alias.col).
+    """
+
+    sql: str
+    depends: tuple[str, ...] = ()
+    joins: tuple[Join, ...] = ()
+
+
+_confirmed, _pending, _no, _unknown = (ANOMALY_CODES[label] for label in "CPNU")
+
+DERIVED_COLUMNS: dict[str, DerivedColumn] = {
+    Variables.YEAR: DerivedColumn(
+        f"COALESCE(b.{Variables.DOB_YY}, b.{Variables.DATAYEAR})",
+        (Variables.DOB_YY, Variables.DATAYEAR),
+    ),
+    # combines CA_DOWN, CA_DOWNS, UCA_DOWNS and DOWNS (codes: ANOMALY_CODES)
+    Variables.CA_DOWN_C: DerivedColumn(
+        f"""CASE
+            WHEN COALESCE(b.{Variables.CA_DOWN}, b.{Variables.CA_DOWNS}) IS NOT NULL
+                THEN COALESCE(b.{Variables.CA_DOWN}, b.{Variables.CA_DOWNS})
+            WHEN b.{Variables.UCA_DOWNS} = 1 THEN {_confirmed}
+            WHEN b.{Variables.UCA_DOWNS} = 2 THEN {_no}
+            WHEN b.{Variables.UCA_DOWNS} = 9 THEN {_unknown}
+            WHEN b.{Variables.DOWNS} = 1 THEN {_confirmed}
+            WHEN b.{Variables.DOWNS} = 2 THEN {_no}
+            WHEN b.{Variables.DOWNS} = 9 THEN {_unknown} -- 8 (not on certificate) treated as unknown
+        END""",
+        (Variables.CA_DOWN, Variables.CA_DOWNS, Variables.UCA_DOWNS, Variables.DOWNS),
+    ),
+    Variables.DOWN_IND: DerivedColumn(
+        f"""CASE
+            WHEN b.{Variables.CA_DOWN_C} IN ({_confirmed}, {_pending}) THEN 1
+            WHEN b.{Variables.CA_DOWN_C} = {_no} THEN 0
+            WHEN b.{Variables.DOWNS} = 1 THEN 1
+            WHEN b.{Variables.DOWNS} = 2 THEN 0
+            WHEN b.{Variables.UCA_DOWNS} = 1 THEN 1
+            WHEN b.{Variables.UCA_DOWNS} = 2 THEN 0
+        END""",
+        (Variables.CA_DOWN_C, Variables.DOWNS, Variables.UCA_DOWNS),
+    ),
+    Variables.MAGE_C: DerivedColumn(
+        f"COALESCE(b.{Variables.MAGER}, b.{Variables.DMAGE}, b.{Variables.MAGE36} + 13)",
+        (Variables.MAGER, Variables.DMAGE, Variables.MAGE36),
+    ),
+    Variables.P_DS_LB_NT: DerivedColumn(
+        f"1 / (1 + exp(7.33 - 4.211 / (1 + exp(-0.2815 * (b.{Variables.MAGE_C} - 37.23)))))",
+        (Variables.MAGE_C,),
+    ),
+    Variables.P_DS_LB_WT: DerivedColumn(
+        f"e.{Variables.P_DS_LB_WT}",
+        (Variables.YEAR,),
+        (Join("prevalence_year", "e"),),
+    ),
+    Variables.MRACE_C: DerivedColumn(
+        f"""CASE
+            WHEN b.{Variables.MRACE15} IS NOT NULL AND (b.{Variables.YEAR} < 2014 OR b.{Variables.YEAR} > 2019) THEN
+                CASE
+                    WHEN b.{Variables.MRACE15} IN (1, 2, 3) THEN b.{Variables.MRACE15}
+                    WHEN b.{Variables.MRACE15} BETWEEN 4 AND 14 THEN 4
+                END
+            WHEN b.{Variables.MRACEREC} IS NOT NULL AND (b.{Variables.YEAR} < 2014 OR b.{Variables.YEAR} > 2019) THEN
+                CASE
+                    WHEN b.{Variables.MRACEREC} IN (1, 2, 3, 4) THEN b.{Variables.MRACEREC}
+                END
+            WHEN b.{Variables.MBRACE} IS NOT NULL THEN
+                CASE
+                    WHEN b.{Variables.MBRACE} IN (1, 2, 3, 4) THEN b.{Variables.MBRACE}
+                END
+            WHEN b.{Variables.MRACE} IS NOT NULL THEN
+                CASE
+                    WHEN b.{Variables.MRACE} IN (1, 2, 3) THEN b.{Variables.MRACE}
+                    WHEN b.{Variables.MRACE} BETWEEN 4 AND 78 THEN 4
+                END
+        END""",
+        (Variables.MRACE15, Variables.MRACEREC, Variables.MBRACE, Variables.MRACE, Variables.YEAR),
+    ),
+    Variables.MHISP_C: DerivedColumn(
+        f"""CASE
+            WHEN b.{Variables.MHISP_R} IS NOT NULL THEN
+                CASE
+                    WHEN b.{Variables.MHISP_R} IN (0, 1, 2, 3) THEN b.{Variables.MHISP_R}
+                    WHEN b.{Variables.MHISP_R} BETWEEN 4 AND 5 THEN 4
+                    WHEN b.{Variables.MHISP_R} = 9 THEN 5
+                END
+            WHEN b.{Variables.MHISPX} IS NOT NULL THEN
+                CASE
+                    WHEN b.{Variables.MHISPX} IN (0, 1, 2, 3) THEN b.{Variables.MHISPX}
+                    WHEN b.{Variables.MHISPX} BETWEEN 4 AND 6 THEN 4
+                    WHEN b.{Variables.MHISPX} = 9 THEN 5
+                END
+            WHEN b.{Variables.UMHISP} IS NOT NULL THEN
+                CASE
+                    WHEN b.{Variables.UMHISP} IN (0, 1, 2, 3) THEN b.{Variables.UMHISP}
+                    WHEN b.{Variables.UMHISP} BETWEEN 4 AND 5 THEN 4
+                    WHEN b.{Variables.UMHISP} = 9 THEN 5
+                END
+            WHEN b.{Variables.ORRACEM} IS NOT NULL THEN
+                CASE
+                    WHEN b.{Variables.ORRACEM} IN (1, 2, 3) THEN b.{Variables.ORRACEM}
+                    WHEN b.{Variables.ORRACEM} BETWEEN 6 AND 8 THEN 0
+                    WHEN b.{Variables.ORRACEM} BETWEEN 4 AND 5 THEN 4
+                    WHEN b.{Variables.ORRACEM} = 9 THEN 5
+                END
+        END""",
+        (Variables.MHISP_R, Variables.MHISPX, Variables.UMHISP, Variables.ORRACEM),
+    ),
+    Variables.MRACEHISP_C: DerivedColumn(
+        f"""CASE
+            WHEN b.{Variables.MHISP_C} BETWEEN 1 AND 4 THEN 5
+            WHEN b.{Variables.MHISP_C} = 5 THEN NULL
+            ELSE b.{Variables.MRACE_C}
+        END""",
+        (Variables.MHISP_C, Variables.MRACE_C),
+    ),
+    Variables.P_DS_LB_WT_MAGE: DerivedColumn(
+        f"""CASE
+            WHEN b.{Variables.MAGE_C} < 35 THEN a.p_ds_lb_wt_lt35_sv
+            ELSE a.p_ds_lb_wt_gte35_sv
+        END""",
+        (Variables.MAGE_C, Variables.YEAR),
+        (Join("us_births_est_prevalence_age", "a"),),
+    ),
+    Variables.P_DS_LB_WT_MAGE_REDUC: DerivedColumn(
+        f"b.{Variables.P_DS_LB_NT} * (1 - r.reduction)",
+        (Variables.P_DS_LB_NT, Variables.YEAR),
+        (Join("reduction_rate_year", "r"),),
+    ),
+    "ds_case_weight": DerivedColumn(
+        f"""CASE
+            WHEN b.{Variables.DOWN_IND} = 1 AND b.{Variables.MRACEHISP_C} = 1 THEN w.nhw
+            WHEN b.{Variables.DOWN_IND} = 1 AND b.{Variables.MRACEHISP_C} = 2 THEN w.nhb
+            WHEN b.{Variables.DOWN_IND} = 1 AND b.{Variables.MRACEHISP_C} = 3 THEN w.ai_an
+            WHEN b.{Variables.DOWN_IND} = 1 AND b.{Variables.MRACEHISP_C} = 4 THEN w.as_pi
+            WHEN b.{Variables.DOWN_IND} = 1 AND b.{Variables.MRACEHISP_C} = 5 THEN w.his
+            WHEN b.{Variables.DOWN_IND} = 1 THEN w.total
+            ELSE 0
+        END""",
+        (Variables.DOWN_IND, Variables.MRACEHISP_C, Variables.YEAR),
+        (Join("ds_case_weights", "w"),),
+    ),
+}
+"""
+The derivations of the computed columns of the us_births table (see DUCKDB_COMPUTED; columns not
+here are null), the one place their logic is defined.
+"""
+
+
+def derived_layers(derived: dict[str, DerivedColumn] = DERIVED_COLUMNS) -> list[list[str]]:
+    """
+    Orders the derived columns topologically: each layer holds the columns whose dependencies are
+    all imported or in earlier layers. Raises ValueError on unknown or circular dependencies.
+    """
+
+    for col, column in derived.items():
+        unknown = [dep for dep in column.depends if dep not in derived and dep not in STORAGE_TYPES]
+        if unknown:
+            raise ValueError(f"Derived column {col} depends on unknown columns: {unknown}")
+
+    layers = []
+    done = set()
+    todo = list(derived)
+
+    while todo:
+        layer = [col for col in todo if all(dep in done or dep not in derived for dep in derived[col].depends)]
+        if not layer:
+            raise ValueError(f"Circular dependencies between derived columns: {todo}")
+        layers.append(layer)
+        done.update(layer)
+        todo = [col for col in todo if col not in done]
+
+    return layers
+
+
+def duckdb_select_sql(source: str, present: set[str], derived: dict[str, DerivedColumn] = DERIVED_COLUMNS) -> str:
+    """
+    Returns the query building the us_births table from source (SQL reading the prepared Parquet
+    files, whose columns are present) in one pass: imported columns cast to their DuckDB types
+    (nulls if not present; other Parquet columns are dropped), then each layer of derived columns
+    (see derived_layers) as a CTE over the previous one, left joined to its reference tables by
+    year, then the other computed columns as typed nulls.
+
+    The reference tables must exist, with at most one row per year. Derived columns with joins are
+    null for years not in their tables.
+    """
+
+    def imported(col: str, dtype: str) -> str:
+        return f"CAST({col} AS {dtype}) AS {col}" if col in present else f"NULL::{dtype} AS {col}"
+
+    def expression(col: str) -> str:
+        column = derived[col]
+        if not column.joins:
+            return f"CAST({column.sql} AS {DUCKDB_TYPES[col]}) AS {col}"
+        matched = " AND ".join(f"{join.alias}.{Variables.YEAR} IS NOT NULL" for join in column.joins)
+        return f"CAST(CASE WHEN {matched} THEN {column.sql} END AS {DUCKDB_TYPES[col]}) AS {col}"
+
+    ctes = [
+        "layer_0 AS (\nSELECT\n"
+        + ",\n".join(imported(col, dtype) for col, dtype in DUCKDB_TYPES.items() if col in STORAGE_TYPES)
+        + f"\nFROM {source}\n)"
+    ]
+
+    for i, layer in enumerate(derived_layers(derived), start=1):
+        joins = {join for col in layer for join in derived[col].joins}
+        ctes.append(
+            f"layer_{i} AS (\nSELECT\nb.*,\n"
+            + ",\n".join(expression(col) for col in layer)
+            + f"\nFROM layer_{i - 1} AS b"
+            + "".join(
+                f"\nLEFT JOIN {join.table} AS {join.alias} ON {join.alias}.{Variables.YEAR} = b.{Variables.YEAR}"
+                for join in sorted(joins)
+            )
+            + "\n)"
+        )
+
+    columns = [
+        col if col in STORAGE_TYPES or col in derived else f"NULL::{dtype} AS {col}"
+        for col, dtype in DUCKDB_TYPES.items()
+    ]
+
+    return "WITH " + ",\n".join(ctes) + "\nSELECT\n" + ",\n".join(columns) + f"\nFROM layer_{len(ctes) - 1}"
+
 
 def set_all_column_types(df: pd.DataFrame) -> pd.DataFrame:
     """Sets all (standard + computed) column types for the dataframe."""
@@ -566,9 +1070,72 @@ def set_computed_column_types(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def is_confirmed_or_pending(x: str):
-    """Combine C (confirmed) and P (pending) into Y value."""
-    return 1 if pd.isna(x) else 1 if x in {"P", "C"} else 0
+def arrow_type(col: str) -> pa.DataType:
+    """
+    Returns the Arrow type that set_all_column_types gives a column. Categories of strings become
+    dictionaries (Parquet keeps these as categories); categories of numbers keep their storage type,
+    as Parquet would read them back as plain numbers anyway (and dictionary-encodes them on disk).
+    """
+
+    dtype = IMPORTED[col] if col in IMPORTED else COMPUTED[col]
+
+    if isinstance(dtype, pd.CategoricalDtype):
+        if dtype.categories is not None:
+            return pa.dictionary(pa.int8(), pa.string())
+        value_type = pa.type_for_alias(STORAGE_TYPES[col]) if col in STORAGE_TYPES else pa.string()
+        return pa.dictionary(pa.int32(), value_type) if pa.types.is_string(value_type) else value_type
+
+    return pa.from_numpy_dtype(dtype.numpy_dtype)
+
+
+def arrow_schema() -> pa.Schema:
+    """Returns the Arrow schema of the id and all (standard + computed) columns, as set by set_all_column_types."""
+
+    return pa.schema(
+        [pa.field(Variables.ID, pa.int64())] + [pa.field(col, arrow_type(col)) for col in IMPORTED_VARS + COMPUTED_VARS]
+    )
+
+
+def set_all_column_types_arrow(batch: pa.RecordBatch, schema: pa.Schema) -> pa.RecordBatch:
+    """
+    Sets all (standard + computed) column types for a record batch, as set_all_column_types does for
+    a dataframe: missing columns are added as nulls, values outside fixed categories become null,
+    and integer casts raise if values do not fit.
+    """
+
+    arrays = []
+
+    for field in schema:
+        if field.name not in batch.schema.names:
+            arrays.append(pa.nulls(batch.num_rows, type=field.type))
+            continue
+
+        arr = batch.column(field.name)
+        dtype = IMPORTED.get(field.name, COMPUTED.get(field.name))
+
+        if pa.types.is_dictionary(field.type) and dtype.categories is not None:
+            categories = pa.array(dtype.categories, type=field.type.value_type)
+            indices = pc.cast(pc.index_in(pc.cast(arr, categories.type), value_set=categories), field.type.index_type)
+            arr = pa.DictionaryArray.from_arrays(indices, categories)
+        elif pa.types.is_dictionary(field.type):
+            arr = pc.dictionary_encode(pc.cast(arr, field.type.value_type))
+        else:
+            try:
+                arr = pc.cast(arr, field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                print(f"Warning: Could not convert column {field.name} to type {field.type}.")
+                raise e
+
+        arrays.append(arr)
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def code_label_sql(col: str) -> str:
+    """Returns a SQL expression giving the letters of a coded column (see CODED_VARS)."""
+
+    cases = " ".join(f"WHEN {code} THEN '{label}'" for label, code in CODED_VARS[col].items())
+    return f"CASE {col} {cases} END"
 
 
 def is_value(x: str, value: str):